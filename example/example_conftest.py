@@ -20,7 +20,9 @@ def collect_types_fixture():
     from pyannotate_runtime import collect_types
     collect_types.resume()
     yield
-    collect_types.pause()
+    # Don't wait for the collected events to be processed after every
+    # test (which would stall an asyncio event loop); dump_stats() does.
+    collect_types.pause(wait=False)
 
 
 def pytest_sessionfinish(session, exitstatus):
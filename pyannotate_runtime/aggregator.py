@@ -0,0 +1,364 @@
+"""
+Ship collected types from many processes to a single aggregator process.
+
+Instead of dumping a file per process and merging the files afterwards,
+each process can send what it collects to a 'pyannotate-aggregator'
+process, over a Unix domain socket or a localhost TCP port:
+
+    pyannotate-aggregator /tmp/pyannotate.sock -o type_info.json
+
+and in every process:
+
+    from pyannotate_runtime import aggregator, collect_types
+    collect_types.init_types_collection()
+    aggregator.start_sender('/tmp/pyannotate.sock')
+    collect_types.resume()
+
+A background thread sends the functions whose signatures changed every so
+often (and a last time on stop_sender() or at exit), as length-prefixed
+messages in the binary format of dump_stats().  Sending never blocks the
+program: if the aggregator is missing or slow, the batch is dropped (and
+counted in get_sender_stats()), and its data is sent again with the next
+one.  Forked children start sending their own data.
+
+The aggregator merges the data per function, with the same maximum number
+of type comments per function as the collector, and writes it in the
+format of dump_stats() on SIGUSR1, every --interval seconds if given, and
+when it exits.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import atexit
+import io
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from threading import Thread
+
+from six.moves import socketserver
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from pyannotate_runtime import collect_types
+from pyannotate_runtime.collect_types import FunctionData, FunctionKey
+from pyannotate_tools.annotations import formats
+
+# Each message is the length of the payload (4 bytes, big-endian) followed by
+# the payload, which is in the binary format of dump_stats().
+_HEADER = struct.Struct('>I')
+# Longer messages are refused, and the connection is closed.
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# How often (in seconds) the main loop of the aggregator checks for signals.
+_POLL_INTERVAL = 0.1
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_address(address):
+    # type: (str) -> Tuple[int, Address]
+    """Return the socket family and address for 'HOST:PORT' or the path of a Unix socket."""
+    host, sep, port = address.rpartition(':')
+    if sep and host and port.isdigit() and os.sep not in address:
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def encode_message(items):
+    # type: (List[FunctionData]) -> bytes
+    out = io.BytesIO()
+    formats.write_binary(out, items)
+    payload = out.getvalue()
+    return _HEADER.pack(len(payload)) + payload
+
+
+# The sender: its address, the thread and the event telling it to stop, and the
+# number of signatures and samples of each function when it was last sent.
+_address = None  # type: Optional[str]
+_interval = 5.0
+_timeout = 0.5
+_sender_thread = None  # type: Optional[Thread]
+_sender_stop = threading.Event()
+_sent = {}  # type: Dict[FunctionKey, Tuple[int, int]]
+_socket = None  # type: Optional[socket.socket]
+
+# Batches and functions sent and dropped.
+_sender_stats = {
+    'batches_sent': 0,
+    'batches_dropped': 0,
+    'functions_sent': 0,
+    'functions_dropped': 0,
+}
+
+
+def get_sender_stats():
+    # type: () -> Dict[str, int]
+    """Return the numbers of batches and functions sent to the aggregator and dropped."""
+    return dict(_sender_stats)
+
+
+def _connect():
+    # type: () -> socket.socket
+    assert _address is not None
+    family, address = parse_address(_address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(_timeout)
+    try:
+        sock.connect(address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def _send_delta():
+    # type: () -> None
+    """Send the functions whose signatures changed since they were last sent."""
+    global _socket
+    items, marks = collect_types._delta(_sent)
+    if not items:
+        return
+    try:
+        if _socket is None:
+            _socket = _connect()
+        _socket.sendall(encode_message(items))
+    except (socket.error, socket.timeout):
+        # Part of the message may have been sent, so start over.
+        if _socket is not None:
+            _socket.close()
+            _socket = None
+        _sender_stats['batches_dropped'] += 1
+        _sender_stats['functions_dropped'] += len(items)
+        return
+    _sent.update(marks)
+    _sender_stats['batches_sent'] += 1
+    _sender_stats['functions_sent'] += len(items)
+
+
+def _sender_loop(stop):
+    # type: (threading.Event) -> None
+    """Main loop of the sender thread."""
+    while not stop.wait(_interval):
+        _send_delta()
+    _send_delta()
+
+
+def _start_sender_thread():
+    # type: () -> None
+    global _sender_thread, _sender_stop
+    _sender_stop = threading.Event()
+    _sender_thread = Thread(target=_sender_loop, args=(_sender_stop,))
+    _sender_thread.daemon = True
+    _sender_thread.start()
+
+
+def start_sender(address, interval=5.0, timeout=0.5):
+    # type: (str, float, float) -> None
+    """
+    Send the collected types to the aggregator at address every interval seconds.
+
+    The address is the path of a Unix domain socket or 'HOST:PORT'.
+    Connecting and sending give up after timeout seconds, dropping the batch.
+    """
+    global _address, _interval, _timeout
+    if interval <= 0:
+        raise ValueError('interval must be positive: %r' % (interval,))
+    stop_sender()
+    if _address is None:
+        atexit.register(stop_sender)
+    _address = address
+    _interval = interval
+    _timeout = timeout
+    _sent.clear()
+    _start_sender_thread()
+
+
+def stop_sender():
+    # type: () -> None
+    """Stop sending, after sending the last changes."""
+    global _sender_thread, _socket
+    if _sender_thread is not None:
+        _sender_stop.set()
+        _sender_thread.join()
+        _sender_thread = None
+    if _socket is not None:
+        _socket.close()
+        _socket = None
+
+
+def _reinit_after_fork():
+    # type: () -> None
+    """Send the child's own data (the collector forgets the parent's; see collect_types)."""
+    global _socket
+    _socket = None  # Shared with the parent; don't close it.
+    _sent.clear()
+    for kind in _sender_stats:
+        _sender_stats[kind] = 0
+    if _sender_thread is not None:
+        _start_sender_thread()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+class Aggregator(object):
+    """The merged data received from all senders."""
+
+    def __init__(self):
+        # type: () -> None
+        self.functions = {}  # type: Dict[FunctionKey, FunctionData]
+        self.lock = threading.Lock()
+
+    def add(self, items):
+        # type: (List[FunctionData]) -> None
+        """Merge the data of some functions."""
+        with self.lock:
+            for item in items:
+                key = FunctionKey(item['path'], item['line'], item['func_name'])
+                if key in self.functions:
+                    collect_types._merge_function_data(self.functions[key], item)
+                else:
+                    item['type_comments'] = item['type_comments'][
+                        :collect_types.MAX_ITEMS_PER_FUNCTION]
+                    self.functions[key] = item
+
+    def add_message(self, payload):
+        # type: (bytes) -> None
+        if not payload.startswith(formats.BINARY_MAGIC):
+            raise ValueError('Invalid message')
+        self.add(formats.decode_binary(bytearray(payload)))
+
+    def dumps(self):
+        # type: () -> str
+        """Return the merged data as a JSON string, like collect_types.dumps_stats()."""
+        with self.lock:
+            items = [dict(item, type_comments=list(item['type_comments']))  # type: ignore
+                     for item in self.functions.values()]
+        items.sort(key=lambda item: (item['path'], item['line'], item['func_name']))
+        return json.dumps(items, indent=4)
+
+    def write(self, filename):
+        # type: (str) -> None
+        """Write the merged data, atomically (compressed if filename ends with .gz or .xz)."""
+        collect_types._write_atomically(filename, self.dumps())
+
+
+def _read_exactly(rfile, size):
+    # type: (Any, int) -> Optional[bytes]
+    """Read size bytes, or return None at the end of the stream."""
+    data = rfile.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Read the messages of a sender until it disconnects."""
+
+    def handle(self):
+        # type: () -> None
+        aggregator = self.server.aggregator  # type: ignore
+        while True:
+            header = _read_exactly(self.rfile, _HEADER.size)
+            if header is None:
+                return
+            (size,) = _HEADER.unpack(header)
+            if size > MAX_MESSAGE_SIZE:
+                return
+            payload = _read_exactly(self.rfile, size)
+            if payload is None:
+                return
+            try:
+                aggregator.add_message(payload)
+            except (ValueError, IndexError, UnicodeDecodeError):
+                return  # Not a sender; drop the connection.
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address, aggregator):
+    # type: (str, Aggregator) -> Any
+    """Return a server receiving messages at address into aggregator (see parse_address())."""
+    family, parsed = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.remove(address)  # Left over by an earlier aggregator.
+        server = _UnixServer(address, _Handler)  # type: Any
+    else:
+        server = _TCPServer(parsed, _Handler)
+    server.aggregator = aggregator
+    return server
+
+
+parser = argparse.ArgumentParser(prog='pyannotate-aggregator',
+                                 description="Collect types sent by many processes")
+parser.add_argument('address',
+                    help="Path of a Unix domain socket, or HOST:PORT to listen on")
+parser.add_argument('-o', '--output', metavar="FILE", default='type_info.json',
+                    help="Output file, compressed if it ends with .gz or .xz "
+                    "(default type_info.json)")
+parser.add_argument('--interval', type=float, metavar="SECONDS",
+                    help="Also write the output every SECONDS seconds")
+
+
+def main(args_override=None):
+    # type: (Optional[List[str]]) -> None
+    args = parser.parse_args(args_override)
+    aggregator = Aggregator()
+    server = make_server(args.address, aggregator)
+    # The signal handlers only set these flags.  They run in the main thread
+    # between any two bytecodes, possibly while it holds aggregator.lock for
+    # a write, so writing (or setting an Event) in them could deadlock.
+    requested = {'write': False, 'stop': False}
+
+    def request_write(*args_):
+        # type: (*Any) -> None
+        requested['write'] = True
+
+    def shut_down(*args_):
+        # type: (*Any) -> None
+        requested['stop'] = True
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, request_write)
+    signal.signal(signal.SIGTERM, shut_down)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('pyannotate-aggregator: listening on %s, writing %s' % (args.address, args.output),
+          file=sys.stderr)
+    next_write = time.time() + args.interval if args.interval else None
+    try:
+        while not requested['stop']:
+            # Sleep in short steps, so that signals are acted on promptly.
+            time.sleep(_POLL_INTERVAL)
+            if requested['write'] or (next_write is not None and time.time() >= next_write):
+                requested['write'] = False
+                aggregator.write(args.output)
+                if next_write is not None:
+                    next_write = time.time() + args.interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        if parse_address(args.address)[0] == socket.AF_UNIX:
+            os.remove(args.address)
+        aggregator.write(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,27 +23,45 @@ from __future__ import (
     print_function,
 )
 
+import atexit
+import codecs
 import collections
+import dis
+import functools
+import importlib
 import inspect
+import itertools
 import json
 import os
+import random
 import sys
 import threading
-from inspect import ArgInfo
+import time
+import types
+import weakref
 from threading import Thread
 
 from mypy_extensions import TypedDict
-from six import iteritems
+from six import iteritems, itervalues
 from six.moves import range
 from six.moves.queue import Queue  # type: ignore  # No library stub yet
+try:
+    import contextvars
+except ImportError:
+    # Python 2 and 3.6 have no contextvars module
+    contextvars = None  # type: ignore
 from typing import (
     Any,
     Callable,
     Dict,
     Iterator,
+    FrozenSet,
+    Iterable,
     List,
+    Mapping,
     NamedTuple,
     Optional,
+    Sequence,
     Set,
     Tuple,
     TypeVar,
@@ -51,16 +69,9 @@ from typing import (
 )
 from contextlib import contextmanager
 
-# pylint: disable=invalid-name
-
+from pyannotate_tools.annotations import formats, store
 
-def _my_hash(arg_list):
-    # type: (List[Any]) -> int
-    """Simple helper hash function"""
-    res = 0
-    for arg in arg_list:
-        res = res * 31 + hash(arg)
-    return res
+# pylint: disable=invalid-name
 
 
 # JSON object representing the collected data for a single function/method
@@ -75,295 +86,340 @@ class UnknownType(object):
     pass
 
 
-class TypeWasIncomparable(object):
-    pass
-
-
 _NONE_TYPE = type(None)
-InternalType = Union['DictType', 'ListType', 'TupleType', 'SetType', 'type']
-
-
-class DictType(object):
+InternalType = Union['DictType', 'ListType', 'TupleType', 'SetType', 'ScalarType']
+
+# All live type descriptors, indexed by their structure.  Descriptors are
+# immutable and hash-consed: there is exactly one descriptor for each
+# structure, so they can be compared by identity, and the memory they use
+# depends on the number of distinct types seen rather than on the number of
+# samples.  The table holds them weakly: they are kept alive by the
+# signatures using them (and the caches below), so that the descriptors of
+# types only seen in data that was evicted or reset, and the (possibly
+# generated at runtime) classes they refer to, are freed.
+_interned = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary[Tuple[Any, ...], InternedType]
+# Held while creating a descriptor, which is rare.
+_intern_lock = threading.Lock()
+
+# Maximum number of entries in each of the descriptor caches (_scalar_types
+# and _union_add_cache); a full cache is emptied.
+MAX_CACHED_TYPES = 4096
+
+
+class InternedType(object):
     """
-    Internal representation of Dict type.
+    Base class of the internal type descriptors.
+
+    Never instantiate descriptors directly but through the constructors of the
+    subclasses, which return the existing descriptor for a given structure.
+    Each descriptor carries a precomputed hash and PEP-484 name.
     """
 
-    def __init__(self, key_type, val_type):
-        # type: (TentativeType, TentativeType) -> None
-        self.key_type = key_type
-        self.val_type = val_type
+    __slots__ = ('_hash', '_name', '__weakref__')
+
+    def _intern(self, structure, name):
+        # type: (Tuple[Any, ...], str) -> Any
+        self._hash = hash(structure)
+        self._name = name
+        # The lock makes sure concurrent threads agree on the descriptor, even
+        # without a GIL.
+        with _intern_lock:
+            desc = _interned.get(structure)
+            if desc is None:
+                desc = _interned[structure] = self
+        return desc
 
     def __repr__(self):
         # type: () -> str
-        if repr(self.key_type) == 'None':
-            # We didn't see any values, so we don't know what's inside
-            return 'Dict'
-        else:
-            return 'Dict[%s, %s]' % (repr(self.key_type), repr(self.val_type))
+        return self._name
 
     def __hash__(self):
         # type: () -> int
-        return hash(self.key_type) if self.key_type else 0
+        return self._hash
 
     def __eq__(self, other):
         # type: (object) -> bool
-        if not isinstance(other, DictType):
-            return False
-
-        return self.val_type == other.val_type and self.key_type == other.key_type
+        return self is other
 
     def __ne__(self, other):
         # type: (object) -> bool
-        return not self.__eq__(other)
+        return self is not other
 
 
-class ListType(object):
+class ScalarType(InternedType):
     """
-    Internal representation of List type.
+    Internal representation of a type that is not a container we look into.
     """
 
-    def __init__(self, val_type):
-        # type: (TentativeType) -> None
-        self.val_type = val_type
-
-    def __repr__(self):
-        # type: () -> str
-        if repr(self.val_type) == 'None':
-            # We didn't see any values, so we don't know what's inside
-            return 'List'
-        else:
-            return 'List[%s]' % (repr(self.val_type))
-
-    def __hash__(self):
-        # type: () -> int
-        return hash(self.val_type) if self.val_type else 0
+    __slots__ = ('type',)
 
-    def __eq__(self, other):
-        # type: (object) -> bool
-        if not isinstance(other, ListType):
-            return False
+    def __new__(cls, type_):
+        # type: (type) -> ScalarType
+        desc = _scalar_types.get(type_)
+        if desc is None:
+            desc = object.__new__(cls)
+            desc.type = type_
+            desc = desc._intern((cls, type_), _type_name(type_))
+            if len(_scalar_types) >= MAX_CACHED_TYPES:
+                _scalar_types.clear()
+            desc = _scalar_types.setdefault(type_, desc)
+        return desc
 
-        return self.val_type == other.val_type
 
-    def __ne__(self, other):
-        # type: (object) -> bool
-        return not self.__eq__(other)
+# Descriptors of the scalar types seen recently, indexed by type; a shortcut
+# for _interned.
+_scalar_types = {}  # type: Dict[type, ScalarType]
 
 
-class SetType(object):
+class DictType(InternedType):
     """
-    Internal representation of Set type.
+    Internal representation of Dict type.
     """
 
-    def __init__(self, val_type):
-        # type: (TentativeType) -> None
-        self.val_type = val_type
-
-    def __repr__(self):
-        # type: () -> str
-        if repr(self.val_type) == 'None':
-            # We didn't see any values, so we don't know what's inside
-            return 'Set'
-        else:
-            return 'Set[%s]' % (repr(self.val_type))
-
-    def __hash__(self):
-        # type: () -> int
-        return hash(self.val_type) if self.val_type else 0
-
-    def __eq__(self, other):
-        # type: (object) -> bool
-        if not isinstance(other, SetType):
-            return False
-
-        return self.val_type == other.val_type
-
-    def __ne__(self, other):
-        # type: (object) -> bool
-        return not self.__eq__(other)
+    __slots__ = ('key_type', 'val_type')
+
+    def __new__(cls, key_type, val_type):
+        # type: (TentativeType, TentativeType) -> DictType
+        desc = _interned.get((cls, key_type, val_type))
+        if desc is None:
+            desc = object.__new__(cls)
+            desc.key_type = key_type
+            desc.val_type = val_type
+            if repr(key_type) == 'None':
+                # We didn't see any values, so we don't know what's inside
+                name = 'Dict'
+            else:
+                name = 'Dict[%s, %s]' % (repr(key_type), repr(val_type))
+            desc = desc._intern((cls, key_type, val_type), name)
+        return desc  # type: ignore
 
 
-class TupleType(object):
+class ListType(InternedType):
     """
-    Internal representation of Tuple type.
+    Internal representation of List type.
     """
 
-    def __init__(self, val_types):
-        #  type: (List[InternalType]) -> None
-        self.val_types = val_types
-
-    def __repr__(self):
-        # type: () -> str
-        return 'Tuple[%s]' % ', '.join([name_from_type(vt) for vt in self.val_types])
-
-    def __hash__(self):
-        # type: () -> int
-        return _my_hash(self.val_types)
-
-    def __eq__(self, other):
-        # type: (object) -> bool
-        if not isinstance(other, TupleType):
-            return False
-
-        if len(self.val_types) != len(other.val_types):
-            return False
+    __slots__ = ('val_type',)
+
+    def __new__(cls, val_type):
+        # type: (TentativeType) -> ListType
+        desc = _interned.get((cls, val_type))
+        if desc is None:
+            desc = object.__new__(cls)
+            desc.val_type = val_type
+            if repr(val_type) == 'None':
+                # We didn't see any values, so we don't know what's inside
+                name = 'List'
+            else:
+                name = 'List[%s]' % (repr(val_type))
+            desc = desc._intern((cls, val_type), name)
+        return desc  # type: ignore
 
-        for i, v in enumerate(self.val_types):
-            if v != other.val_types[i]:
-                return False
 
-        return True
+class SetType(InternedType):
+    """
+    Internal representation of Set type.
+    """
 
-    def __ne__(self, other):
-        # type: (object) -> bool
-        return not self.__eq__(other)
+    __slots__ = ('val_type',)
+
+    def __new__(cls, val_type):
+        # type: (TentativeType) -> SetType
+        desc = _interned.get((cls, val_type))
+        if desc is None:
+            desc = object.__new__(cls)
+            desc.val_type = val_type
+            if repr(val_type) == 'None':
+                # We didn't see any values, so we don't know what's inside
+                name = 'Set'
+            else:
+                name = 'Set[%s]' % (repr(val_type))
+            desc = desc._intern((cls, val_type), name)
+        return desc  # type: ignore
 
 
-class TentativeType(object):
+class TupleType(InternedType):
     """
-    This class serves as internal representation of type for a type collection process.
-    It can be merged with another instance of TentativeType to build up a broader sample.
+    Internal representation of Tuple type.
     """
 
-    def __init__(self):
-        # type: () -> None
-        self.types_hashable = set()  # type: Set[InternalType]
-        self.types = []  # type: List[InternalType]
-
-    def __hash__(self):
-        # type: () -> int
+    __slots__ = ('val_types',)
 
-        # These objects not immutable because there was a _large_ perf impact to being immutable.
-        # Having a hash on a mutable object is dangerous, but is was much faster.
-        # If you do change it, you need to
-        # (a) pull it out of the set/table
-        # (b) change it,
-        # (c) stuff it back in
-        return _my_hash([self.types, len(self.types_hashable)]) if self.types else 0
+    def __new__(cls, val_types):
+        #  type: (Iterable[InternalType]) -> TupleType
+        val_types = tuple(val_types)
+        desc = _interned.get((cls, val_types))
+        if desc is None:
+            desc = object.__new__(cls)
+            desc.val_types = val_types
+            name = 'Tuple[%s]' % ', '.join([name_from_type(vt) for vt in val_types])
+            desc = desc._intern((cls, val_types), name)
+        return desc  # type: ignore
 
-    def __eq__(self, other):
-        # type: (object) -> bool
-        if not isinstance(other, TentativeType):
-            return False
 
-        if self.types_hashable != other.types_hashable:
-            return False
+class TentativeType(InternedType):
+    """
+    This class serves as internal representation of type for a type collection process.
+    It is the union of the types seen so far, and can be extended with another type
+    or merged with another instance of TentativeType to build up a broader sample.
 
-        if len(self.types) != len(other.types):
-            return False
+    Like all descriptors it is immutable; add() and merge() return the descriptor
+    of the extended union.
+    """
 
-        for i in self.types:
-            if i not in other.types:
-                return False
+    __slots__ = ('types',)
 
-        return True
+    def __new__(cls, types=frozenset()):
+        # type: (FrozenSet[InternalType]) -> TentativeType
+        desc = _interned.get((cls, types))
+        if desc is None:
+            desc = object.__new__(cls)
+            desc.types = types
+            desc = desc._intern((cls, types), _union_name(types))
+        return desc  # type: ignore
 
-    def __ne__(self, other):
-        # type: (object) -> bool
-        return not self.__eq__(other)
+    def is_empty(self):
+        # type: () -> bool
+        """Return True if no types have been added."""
+        return not self.types
 
     def add(self, type):
-        # type: (InternalType) -> None
+        # type: (InternalType) -> TentativeType
         """
-        Add type to the runtime type samples.
+        Return the union of this type and another runtime type sample.
         """
-        try:
-            if isinstance(type, SetType):
-                if EMPTY_SET_TYPE in self.types_hashable:
-                    self.types_hashable.remove(EMPTY_SET_TYPE)
-            elif isinstance(type, ListType):
-                if EMPTY_LIST_TYPE in self.types_hashable:
-                    self.types_hashable.remove(EMPTY_LIST_TYPE)
-            elif isinstance(type, DictType):
-                if EMPTY_DICT_TYPE in self.types_hashable:
-                    self.types_hashable.remove(EMPTY_DICT_TYPE)
-                for item in self.types_hashable:
-                    if isinstance(item, DictType):
-                        if item.key_type == type.key_type:
-                            item.val_type.merge(type.val_type)
-                            return
-            self.types_hashable.add(type)
-
-        except (TypeError, AttributeError):
-            try:
-                if type not in self.types:
-                    self.types.append(type)
-            except AttributeError:
-                if TypeWasIncomparable not in self.types:
-                    self.types.append(TypeWasIncomparable)
+        result = _union_add_cache.get((self, type))
+        if result is not None:
+            return result
+        types = set(self.types)
+        added = type
+        if isinstance(type, SetType):
+            types.discard(EMPTY_SET_TYPE)
+        elif isinstance(type, ListType):
+            types.discard(EMPTY_LIST_TYPE)
+        elif isinstance(type, DictType):
+            types.discard(EMPTY_DICT_TYPE)
+            for item in types:
+                if isinstance(item, DictType) and item.key_type is type.key_type:
+                    # Merge the value types of dicts with the same key type.
+                    types.remove(item)
+                    added = DictType(item.key_type, item.val_type.merge(type.val_type))
+                    break
+        types.add(added)
+        result = TentativeType(frozenset(types))
+        if len(_union_add_cache) >= MAX_CACHED_TYPES:
+            _union_add_cache.clear()
+        _union_add_cache[(self, type)] = result
+        return result
 
     def merge(self, other):
-        # type: (TentativeType) -> None
+        # type: (TentativeType) -> TentativeType
         """
         Merge two TentativeType instances
         """
-        for hashables in other.types_hashable:
-            self.add(hashables)
-        for non_hashbles in other.types:
-            self.add(non_hashbles)
+        result = self
+        for type in other.types:
+            result = result.add(type)
+        return result
 
-    def __repr__(self):
-        # type: () -> str
-        if (len(self.types) + len(self.types_hashable) == 0) or (
-                len(self.types_hashable) == 1 and _NONE_TYPE in self.types_hashable):
-            return 'None'
+
+# Recent results of TentativeType.add(), indexed by (union, added type).
+_union_add_cache = {}  # type: Dict[Tuple[TentativeType, InternalType], TentativeType]
+
+
+def _clear_type_caches():
+    # type: () -> None
+    """Empty the descriptor caches, so that only the collected data keeps descriptors alive."""
+    _scalar_types.clear()
+    _union_add_cache.clear()
+
+
+def _union_name(types):
+    # type: (FrozenSet[InternalType]) -> str
+    """Return the PEP-484 name of a union of types."""
+    if not types or (len(types) == 1 and NONE_TYPE in types):
+        return 'None'
+    else:
+        type_format = '%s'
+        filtered_types = [i for i in types if i is not NONE_TYPE]
+        if NONE_TYPE in types:
+            type_format = 'Optional[%s]'
+        if len(filtered_types) == 1:
+            return type_format % name_from_type(filtered_types[0])
         else:
-            type_format = '%s'
-            filtered_types = self.types + [i for i in self.types_hashable if i != _NONE_TYPE]
-            if _NONE_TYPE in self.types_hashable:
-                type_format = 'Optional[%s]'
-            if len(filtered_types) == 1:
-                return type_format % name_from_type(filtered_types[0])
-            else:
-                # use sorted() for predictable type order in the Union
-                return type_format % (
-                    'Union[' + ', '.join(sorted([name_from_type(s) for s in filtered_types])) + ']')
+            # use sorted() for predictable type order in the Union
+            return type_format % (
+                'Union[' + ', '.join(sorted([name_from_type(s) for s in filtered_types])) + ']')
 
 
 FunctionKey = NamedTuple('FunctionKey', [('path', str), ('line', int), ('func_name', str)])
 
-# Inferred types for a function call
+# Inferred types for a function call.  The varargs and kwargs fields are None
+# if the function has no *args or **kwargs parameter, respectively.
 ResolvedTypes = NamedTuple('ResolvedTypes',
                            [('pos_args', List[InternalType]),
-                            ('varargs', Optional[List[InternalType]])])
+                            ('varargs', Optional[List[InternalType]]),
+                            ('kwonly_args', List[InternalType]),
+                            ('kwargs', Optional[List[InternalType]])])
 
-# Task queue entry for calling a function with specific argument types
-KeyAndTypes = NamedTuple('KeyAndTypes', [('key', FunctionKey), ('types', ResolvedTypes)])
+# Task queue entry for calling a function with specific argument types.  The
+# call_id identifies the call (it's the ID of the frame) so that the return can
+# be paired with it even if other calls of the function are in progress.
+KeyAndTypes = NamedTuple('KeyAndTypes', [('key', FunctionKey),
+                                         ('call_id', int),
+                                         ('types', ResolvedTypes)])
 
 # Task queue entry for returning from a function with a value
-KeyAndReturn = NamedTuple('KeyAndReturn', [('key', FunctionKey), ('return_type', InternalType)])
-
-# Combined argument and return types for a single function call
-Signature = NamedTuple('Signature', [('args', 'ArgTypes'), ('return_type', InternalType)])
+KeyAndReturn = NamedTuple('KeyAndReturn', [('key', FunctionKey),
+                                           ('call_id', int),
+                                           ('return_type', InternalType)])
 
 
 BUILTIN_MODULES = {'__builtin__', 'builtins', 'exceptions'}
 
 
+def _type_name(type_):
+    # type: (type) -> str
+    """Return the PEP-484 name of a Python type."""
+    if type_.__name__ != 'NoneType':
+        module = type_.__module__
+        if module in BUILTIN_MODULES or module == '<unknown>':
+            # Omit module prefix for known built-ins, for convenience. This
+            # makes unit tests for this module simpler.
+            # Also ignore '<uknown>' modules so pyannotate can parse these types
+            return type_.__name__
+        else:
+            return '%s.%s' % (module, type_.__name__)
+    else:
+        return 'None'
+
+
 def name_from_type(type_):
-    # type: (InternalType) -> str
+    # type: (Union[InternalType, type]) -> str
     """
     Helper function to get PEP-484 compatible string representation of our internal types.
     """
-    if isinstance(type_, (DictType, ListType, TupleType, SetType)):
+    if isinstance(type_, InternedType):
         return repr(type_)
     else:
-        if type_.__name__ != 'NoneType':
-            module = type_.__module__
-            if module in BUILTIN_MODULES or module == '<unknown>':
-                # Omit module prefix for known built-ins, for convenience. This
-                # makes unit tests for this module simpler.
-                # Also ignore '<uknown>' modules so pyannotate can parse these types
-                return type_.__name__
-            else:
-                return '%s.%s' % (module, type_.__name__)
-        else:
-            return 'None'
+        return _type_name(type_)
+
 
+NONE_TYPE = ScalarType(_NONE_TYPE)
+UNKNOWN_TYPE = ScalarType(UnknownType)
+EMPTY_TYPE = TentativeType()
+EMPTY_DICT_TYPE = DictType(EMPTY_TYPE, EMPTY_TYPE)
+EMPTY_LIST_TYPE = ListType(EMPTY_TYPE)
+EMPTY_SET_TYPE = SetType(EMPTY_TYPE)
 
-EMPTY_DICT_TYPE = DictType(TentativeType(), TentativeType())
-EMPTY_LIST_TYPE = ListType(TentativeType())
-EMPTY_SET_TYPE = SetType(TentativeType())
+# The types of containers whose items we don't know.  (A tuple of unknown
+# length and item types is a plain 'tuple'.)
+_BARE_TYPES = {
+    list: EMPTY_LIST_TYPE,
+    set: EMPTY_SET_TYPE,
+    dict: EMPTY_DICT_TYPE,
+    tuple: ScalarType(tuple),
+}  # type: Dict[type, InternalType]
 
 
 # TODO: Make this faster
@@ -375,6 +431,15 @@ def get_function_name_from_frame(frame):
     For instance methods we return "ClassName.method_name"
     For functions we return "function_name"
     """
+    return _function_name(frame.f_code, lambda: frame.f_locals)
+
+
+def _function_name(code, get_locals):
+    # type: (Any, Callable[[], Mapping[str, Any]]) -> str
+    """Return the name of a function, given its code object and a function returning its locals.
+
+    See get_function_name_from_frame().
+    """
 
     def bases_to_mro(cls, bases):
         # type: (type, List[type]) -> List[type]
@@ -392,13 +457,12 @@ def get_function_name_from_frame(frame):
                     mro.extend(bases_to_mro(base, sub_bases))
         return mro
 
-    code = frame.f_code
     # This ought to be aggressively cached with the code object as key.
     funcname = code.co_name
     if code.co_varnames:
         varname = code.co_varnames[0]
         if varname == 'self':
-            inst = frame.f_locals.get(varname)
+            inst = get_locals().get(varname)
             if inst is not None:
                 try:
                     mro = inst.__class__.__mro__
@@ -414,11 +478,36 @@ def get_function_name_from_frame(frame):
                 if mro:
                     for cls in mro:
                         bare_method = cls.__dict__.get(funcname)
+                        if getattr(bare_method, '_pyannotate_traced', False):
+                            bare_method = bare_method.__wrapped__  # See trace().
                         if bare_method and getattr(bare_method, '__code__', None) is code:
                             return '%s.%s' % (cls.__name__, funcname)
     return funcname
 
 
+# Limits on the work resolve_type() does for a single value: how deeply nested
+# containers it looks into, and how many containers it looks into in total.
+# Containers beyond these limits, and containers that contain themselves, are
+# resolved without their item types (e.g. as 'List').
+MAX_RESOLVE_DEPTH = 8
+MAX_RESOLVE_NODES = 64
+
+# The item types of a list, set or dict are found by looking at the types of
+# up to _SCAN_ITEMS items spread over it (for sets and dicts, which can't be
+# indexed, over its first _SCAN_WINDOW items), so that a container of mixed
+# types is caught even if it starts with many items of one type.  Items that
+# are containers themselves are resolved recursively, up to _RESOLVE_ITEMS of
+# them for a list or set and _RESOLVE_DICT_ITEMS keys and values for a dict.
+_SCAN_ITEMS = 16
+_SCAN_WINDOW = 256
+_RESOLVE_ITEMS = 4
+_RESOLVE_DICT_ITEMS = 5
+# Tuple items are positional, so the leading ones are resolved.
+_RESOLVE_TUPLE_ITEMS = 10
+
+_CONTAINER_TYPES = frozenset([list, set, dict, tuple])
+
+
 def resolve_type(arg):
     # type: (object) -> InternalType
     """
@@ -428,161 +517,566 @@ def resolve_type(arg):
         arg: object to resolve
     """
     arg_type = type(arg)
-    if arg_type == list:
-        assert isinstance(arg, list)  # this line helps mypy figure out types
-        sample = arg[:min(4, len(arg))]
-        tentative_type = TentativeType()
-        for sample_item in sample:
-            tentative_type.add(resolve_type(sample_item))
-        return ListType(tentative_type)
-    elif arg_type == set:
-        assert isinstance(arg, set)  # this line helps mypy figure out types
-        sample = []
-        iterator = iter(arg)
-        for i in range(0, min(4, len(arg))):
-            sample.append(next(iterator))
-        tentative_type = TentativeType()
-        for sample_item in sample:
-            tentative_type.add(resolve_type(sample_item))
-        return SetType(tentative_type)
-    elif arg_type == tuple:
-        assert isinstance(arg, tuple)  # this line helps mypy figure out types
-        sample = list(arg[:min(10, len(arg))])
-        return TupleType([resolve_type(sample_item) for sample_item in sample])
-    elif arg_type == dict:
-        assert isinstance(arg, dict)  # this line helps mypy figure out types
-        key_tt = TentativeType()
-        val_tt = TentativeType()
-        for i, (k, v) in enumerate(iteritems(arg)):
-            if i > 4:
-                break
-            key_tt.add(resolve_type(k))
-            val_tt.add(resolve_type(v))
-        return DictType(key_tt, val_tt)
-    else:
-        return type(arg)
+    if arg_type in _CONTAINER_TYPES:
+        return _resolve_container(arg, arg_type, [MAX_RESOLVE_NODES], [])
+    return _scalar_types.get(arg_type) or ScalarType(arg_type)
 
 
-def prep_args(arg_info):
-    # type: (ArgInfo) -> ResolvedTypes
-    """
-    Resolve types from ArgInfo
+def _resolve_container(arg, arg_type, budget, path):
+    # type: (Any, type, List[int], List[int]) -> InternalType
+    """Resolve a list, set, dict or tuple.
+
+    The budget holds the number of containers we may still look into, and
+    the path the IDs of the containers we are looking into.
     """
+    arg_id = id(arg)
+    if budget[0] <= 0 or len(path) >= MAX_RESOLVE_DEPTH or arg_id in path:
+        return _BARE_TYPES[arg_type]
+    budget[0] -= 1
+    path.append(arg_id)
+    if arg_type is list:
+        result = ListType(_resolve_items(_spread(arg), _RESOLVE_ITEMS, budget, path))  # type: InternalType
+    elif arg_type is dict:
+        size = len(arg)
+        if size <= _SCAN_ITEMS:
+            keys = arg  # type: Any
+            values = arg.values()  # type: Any
+        else:
+            keys = _spread_iter(arg, size)
+            values = _spread_iter(itervalues(arg), size)
+        result = DictType(_resolve_items(keys, _RESOLVE_DICT_ITEMS, budget, path),
+                          _resolve_items(values, _RESOLVE_DICT_ITEMS, budget, path))
+    elif arg_type is set:
+        result = SetType(_resolve_items(_spread_iter(arg, len(arg)), _RESOLVE_ITEMS,
+                                        budget, path))
+    else:
+        item_types = []  # type: List[InternalType]
+        for item in arg[:_RESOLVE_TUPLE_ITEMS]:
+            item_type = type(item)
+            if item_type in _CONTAINER_TYPES:
+                item_types.append(_resolve_container(item, item_type, budget, path))
+            else:
+                item_types.append(_scalar_types.get(item_type) or ScalarType(item_type))
+        result = TupleType(item_types)
+    path.pop()
+    return result
 
-    # pull out any varargs declarations
-    filtered_args = [a for a in arg_info.args if getattr(arg_info, 'varargs', None) != a]
 
-    # we don't care about self/cls first params (perhaps we can test if it's an instance/class method another way?)
-    if filtered_args and (filtered_args[0] in ('self', 'cls')):
-        filtered_args = filtered_args[1:]
-
-    pos_args = []  # type: List[InternalType]
-    if filtered_args:
-        for arg in filtered_args:
-            if isinstance(arg, str) and arg in arg_info.locals:
-                # here we know that return type will be of type "type"
-                resolved_type = resolve_type(arg_info.locals[arg])
-                pos_args.append(resolved_type)
+def _resolve_items(items, max_containers, budget, path):
+    # type: (Any, int, List[int], List[int]) -> TentativeType
+    """Return the union of the types of some items of a container (a list or dict view).
+
+    The types of items that aren't containers are found without looking at
+    the items one by one; only the first max_containers containers are
+    resolved recursively.
+    """
+    tentative_type = EMPTY_TYPE
+    if len(items) <= max_containers:
+        # Few enough to look at one by one.
+        for item in items:
+            item_type = type(item)
+            if item_type in _CONTAINER_TYPES:
+                tentative_type = tentative_type.add(
+                    _resolve_container(item, item_type, budget, path))
             else:
-                pos_args.append(type(UnknownType()))
+                tentative_type = tentative_type.add(_scalar_types.get(item_type) or
+                                                    ScalarType(item_type))
+        return tentative_type
+    has_containers = False
+    for item_type in set(map(type, items)):
+        if item_type in _CONTAINER_TYPES:
+            has_containers = True
+        else:
+            tentative_type = tentative_type.add(_scalar_types.get(item_type) or
+                                                ScalarType(item_type))
+    if has_containers:
+        if tentative_type is EMPTY_TYPE:
+            containers = items
+        else:
+            containers = [item for item in items if type(item) in _CONTAINER_TYPES]
+        for item in itertools.islice(containers, max_containers):
+            tentative_type = tentative_type.add(
+                _resolve_container(item, type(item), budget, path))
+    return tentative_type
+
 
-    varargs = None  # type: Optional[List[InternalType]]
-    if arg_info.varargs:
-        varargs_tuple = arg_info.locals[arg_info.varargs]
-        # It's unclear what all the possible values for 'varargs_tuple' are,
-        # so perform a defensive type check since we don't want to crash here.
-        if isinstance(varargs_tuple, tuple):
-            varargs = [resolve_type(arg) for arg in varargs_tuple[:4]]
+def _spread(items):
+    # type: (Sequence[Any]) -> Sequence[Any]
+    """Return up to _SCAN_ITEMS items spread evenly over a list."""
+    size = len(items)
+    if size <= _SCAN_ITEMS:
+        return items
+    return items[::-(-size // _SCAN_ITEMS)]
 
-    return ResolvedTypes(pos_args=pos_args, varargs=varargs)
 
+def _spread_iter(iterable, size):
+    # type: (Iterable[Any], int) -> List[Any]
+    """Return up to _SCAN_ITEMS items spread evenly over the start of a set or dict."""
+    if size <= _SCAN_ITEMS:
+        return list(iterable)
+    window = min(size, _SCAN_WINDOW)
+    return list(itertools.islice(iterable, 0, window, -(-window // _SCAN_ITEMS)))
 
-class ArgTypes(object):
+
+def make_arg_extractor(code):
+    # type: (Any) -> Callable[[Mapping[str, Any]], ResolvedTypes]
     """
-    Internal representation of argument types in a single call
+    Build a function resolving the argument types of a call from its locals.
+
+    The parameter layout is computed once from the code object, so the
+    returned function only has to look up the parameter slots.
+
+    Args:
+        code: code object of the called function
     """
+    names = code.co_varnames
+    argcount = code.co_argcount
+    kwonlyargcount = getattr(code, 'co_kwonlyargcount', 0)  # Python 3 only
 
-    def __init__(self, resolved_types):
-        # type: (ResolvedTypes) -> None
-        self.pos_args = [TentativeType() for _ in range(len(resolved_types.pos_args))]
-        if resolved_types.pos_args:
-            for i, arg in enumerate(resolved_types.pos_args):
-                self.pos_args[i].add(arg)
-
-        self.varargs = None  # type: Optional[TentativeType]
-        if resolved_types.varargs:
-            self.varargs = TentativeType()
-            for arg in resolved_types.varargs:
-                self.varargs.add(arg)
+    # we don't care about self/cls first params (perhaps we can test if it's an instance/class method another way?)
+    pos_names = names[:argcount]
+    if pos_names and pos_names[0] in ('self', 'cls'):
+        pos_names = pos_names[1:]
+    kwonly_names = names[argcount:argcount + kwonlyargcount]
+    i = argcount + kwonlyargcount
+    varargs_name = None  # type: Optional[str]
+    if code.co_flags & inspect.CO_VARARGS:
+        varargs_name = names[i]
+        i += 1
+    kwargs_name = None  # type: Optional[str]
+    if code.co_flags & inspect.CO_VARKEYWORDS:
+        kwargs_name = names[i]
+
+    def extract(local_vars):
+        # type: (Mapping[str, Any]) -> ResolvedTypes
+        pos_args = [resolve_type(local_vars[name]) if name in local_vars else UNKNOWN_TYPE
+                    for name in pos_names]
+        kwonly_args = [resolve_type(local_vars[name]) if name in local_vars else UNKNOWN_TYPE
+                       for name in kwonly_names]
+        varargs = None  # type: Optional[List[InternalType]]
+        if varargs_name is not None:
+            varargs_tuple = local_vars.get(varargs_name)
+            # It's unclear what all the possible values for 'varargs_tuple' are,
+            # so perform a defensive type check since we don't want to crash here.
+            if isinstance(varargs_tuple, tuple):
+                varargs = [resolve_type(arg) for arg in varargs_tuple[:4]]
+            else:
+                varargs = []
+        kwargs = None  # type: Optional[List[InternalType]]
+        if kwargs_name is not None:
+            kwargs_dict = local_vars.get(kwargs_name)
+            kwargs = []
+            if isinstance(kwargs_dict, dict):
+                for j, value in enumerate(itervalues(kwargs_dict)):
+                    if j >= 4:
+                        break
+                    kwargs.append(resolve_type(value))
+        return ResolvedTypes(pos_args=pos_args, varargs=varargs,
+                             kwonly_args=kwonly_args, kwargs=kwargs)
+
+    return extract
+
+
+class FrozenTypes(object):
+    """
+    Base class for the argument types of a call, with or without return type.
+
+    The types are stored as a tuple of descriptors, in declaration order,
+    along with the layout of the arguments: (number of positional
+    arguments, whether there is a *args parameter, number of keyword-only
+    arguments, whether there is a **kwargs parameter).  Instances are
+    immutable and compact, and their hash is computed once.
+    """
+
+    __slots__ = ('layout', 'types', '_hash')
+
+    def __init__(self, layout, types):
+        # type: (Tuple[int, bool, int, bool], Tuple[InternedType, ...]) -> None
+        self.layout = layout
+        self.types = types
+        self._hash = hash(types) ^ hash(layout)
 
     def __repr__(self):
         # type: () -> str
-        return str({'pos_args': self.pos_args, 'varargs': self.varargs})
+        return '%s(%r, %r)' % (type(self).__name__, self.layout, self.types)
 
     def __hash__(self):
         # type: () -> int
-        return _my_hash(self.pos_args) + hash(self.varargs)
+        return self._hash
 
     def __eq__(self, other):
         # type: (object) -> bool
-        return (isinstance(other, ArgTypes)
-                and other.pos_args == self.pos_args and other.varargs == self.varargs)
+        return (type(other) is type(self) and self._hash == other._hash  # type: ignore
+                and self.types == other.types  # type: ignore
+                and self.layout == other.layout)  # type: ignore
 
     def __ne__(self, other):
         # type: (object) -> bool
         return not self.__eq__(other)
 
 
+class ArgTypes(FrozenTypes):
+    """
+    Internal representation of argument types in a single call
+    """
+
+    __slots__ = ()
+
+    def __init__(self, resolved_types):
+        # type: (ResolvedTypes) -> None
+        types = list(resolved_types.pos_args)  # type: List[InternedType]
+        if resolved_types.varargs is not None:
+            varargs = EMPTY_TYPE
+            for arg in resolved_types.varargs:
+                varargs = varargs.add(arg)
+            types.append(varargs)
+        types.extend(resolved_types.kwonly_args)
+        if resolved_types.kwargs is not None:
+            kwargs = EMPTY_TYPE
+            for arg in resolved_types.kwargs:
+                kwargs = kwargs.add(arg)
+            types.append(kwargs)
+        layout = (len(resolved_types.pos_args), resolved_types.varargs is not None,
+                  len(resolved_types.kwonly_args), resolved_types.kwargs is not None)
+        super(ArgTypes, self).__init__(layout, tuple(types))
+
+    def with_return(self, return_type):
+        # type: (InternalType) -> Signature
+        """Combine with the return type into a complete signature."""
+        return Signature(self.layout, self.types + (return_type,))
+
+
+class Signature(FrozenTypes):
+    """
+    Combined argument and return types for a single function call.
+
+    The last item of 'types' is the return type.
+    """
+
+    __slots__ = ()
+
+
 # Collect at most this many type comments for each function.
-MAX_ITEMS_PER_FUNCTION = 8
+MAX_ITEMS_PER_FUNCTION = formats.MAX_ITEMS_PER_FUNCTION
 
-# The most recent argument types collected for each function. Once we encounter
-# a corresponding return event, an item will be flushed and moved to
-# 'collected_comments'.
-collected_args = {}  # type: Dict[FunctionKey, ArgTypes]
+# The argument types of each call in progress, by function and call ID. Once we
+# encounter a corresponding return event, an item will be flushed and moved to
+# 'collected_signatures'.
+collected_args = {}  # type: Dict[Tuple[FunctionKey, int], ArgTypes]
 
 # Collected unique type comments for each function, of form '(arg, ...) -> ret'.
 # There at most MAX_ITEMS_PER_FUNCTION items.
-collected_signatures = {}  # type: Dict[FunctionKey, Set[Tuple[ArgTypes, InternalType]]]
+collected_signatures = {}  # type: Dict[FunctionKey, Set[Signature]]
 
 # Number of samples collected per function (we also count ones ignored after reaching
 # the maximum comment count per function).
 num_samples = {}  # type: Dict[FunctionKey, int]
 
+# The data of a previous run that collection was seeded with (see
+# init_types_collection()), by function.  It is merged into the dumped data,
+# and functions that already have MAX_ITEMS_PER_FUNCTION type comments in it
+# are not sampled again.
+_seeded = {}  # type: Dict[FunctionKey, FunctionData]
 
-def _make_type_comment(args_info, return_type):
-    # type: (ArgTypes, InternalType) -> str
-    """Generate a type comment of form '(arg, ...) -> ret'."""
-    if not args_info.pos_args:
-        args_string = ''
-    else:
-        args_string = ', '.join([repr(t) for t in args_info.pos_args])
-    if args_info.varargs:
-        varargs = '*%s' % repr(args_info.varargs)
-        if args_string:
-            args_string += ', %s' % varargs
-        else:
-            args_string = varargs
-    return_name = name_from_type(return_type)
-    return '(%s) -> %s' % (args_string, return_name)
 
+def _make_type_comment(signature):
+    # type: (Signature) -> str
+    """Generate a type comment of form '(arg, ...) -> ret'.
 
-def _flush_signature(key, return_type):
-    # type: (FunctionKey, InternalType) -> None
+    Arguments are listed in declaration order: positional arguments, *args,
+    keyword-only arguments and **kwargs.  Empty *args or **kwargs are left
+    out, except that *args is kept (as an unknown type) if anything follows
+    it, so that every comment for a function lists its arguments in the same
+    positions.
+    """
+    num_pos, has_varargs, num_kwonly, has_kwargs = signature.layout
+    types = signature.types
+    args = [repr(t) for t in types[:num_pos]]
+    i = num_pos
+    varargs = None  # type: Optional[InternedType]
+    if has_varargs:
+        varargs = types[i]
+        i += 1
+    kwonly_args = [repr(t) for t in types[i:i + num_kwonly]]
+    i += num_kwonly
+    kwargs = None  # type: Optional[str]
+    if has_kwargs and types[i] is not EMPTY_TYPE:
+        kwargs = '**%s' % repr(types[i])
+    if varargs is not None:
+        if varargs is not EMPTY_TYPE:
+            args.append('*%s' % repr(varargs))
+        elif kwonly_args or kwargs:
+            args.append('*%s' % name_from_type(UNKNOWN_TYPE))
+    args.extend(kwonly_args)
+    if kwargs:
+        args.append(kwargs)
+    return '(%s) -> %s' % (', '.join(args), repr(types[-1]))
+
+
+def _flush_signature(key, call_id, return_type):
+    # type: (FunctionKey, int, InternalType) -> None
     """Store signature for a function.
 
     Assume that argument types have been stored previously to
     'collected_args'. As the 'return_type' argument provides the return
     type, we now have a complete signature.
 
-    As a side effect, removes the argument types for the function from
+    As a side effect, removes the argument types for the call from
     'collected_args'.
     """
-    signatures = collected_signatures.setdefault(key, set())
-    args_info = collected_args.pop(key)
-    if len(signatures) < MAX_ITEMS_PER_FUNCTION:
-        signatures.add((args_info, return_type))
+    args_info = collected_args.pop((key, call_id))
+    signatures = collected_signatures.get(key)
+    if signatures is None:
+        signatures = collected_signatures[key] = set()
+        if _memory_budget is not None:
+            _enforce_memory_budget()
+    num_signatures = len(signatures)
+    if num_signatures < MAX_ITEMS_PER_FUNCTION:
+        signatures.add(args_info.with_return(return_type))
     num_samples[key] = num_samples.get(key, 0) + 1
+    if _stable_samples is not None:
+        _count_stable_sample(key, len(signatures) == num_signatures, len(signatures))
+    if _memory_budget is not None:
+        # Move the function to the end of the eviction order.
+        _recently_updated.pop(key, None)
+        _recently_updated[key] = None
+
+
+def _function_data(key, signatures, samples):
+    # type: (FunctionKey, Iterable[Signature], int) -> FunctionData
+    """Return the JSON object for the data collected for a function."""
+    return {
+        'path': key.path,
+        'line': key.line,
+        'func_name': key.func_name,
+        'type_comments': [_make_type_comment(signature) for signature in signatures],
+        'samples': samples,
+    }
+
+
+def _merge_function_data(item, other):
+    # type: (FunctionData, FunctionData) -> None
+    """Merge the data collected for the same function at different times into item."""
+    comments = item['type_comments']
+    for comment in other['type_comments']:
+        if len(comments) >= MAX_ITEMS_PER_FUNCTION:
+            break
+        if comment not in comments:
+            comments.append(comment)
+    item['samples'] += other['samples']
+
+
+# A memory budget for the collected data (see set_memory_budget()).
+MemoryBudget = NamedTuple('MemoryBudget', [('max_functions', Optional[int]),
+                                           ('max_bytes', Optional[int]),
+                                           ('spill_filename', Optional[str])])
+
+_memory_budget = None  # type: Optional[MemoryBudget]
+
+# When over budget, evict functions until this fraction of the budget is used,
+# so that we don't evict again for every new function.
+_EVICTION_LOW_WATER = 0.9
+
+# Measuring the memory used walks all collected data, so the byte budget is
+# only checked every so many new functions.
+_SIZE_CHECK_INTERVAL = 64
+_new_functions = 0
+
+# Functions with collected signatures, least recently updated first.  Only
+# maintained while there is a memory budget.
+_recently_updated = collections.OrderedDict()  # type: Dict[FunctionKey, None]
+
+# Number of functions evicted because they were saturated (had the maximum
+# number of signatures) or cold (least recently updated), and how many of
+# those were spilled to disk rather than dropped.
+evictions = {'saturated': 0, 'cold': 0, 'spilled': 0}
+
+
+def _collected_size():
+    # type: () -> int
+    """Estimate the memory held by the collected data, in bytes."""
+    return (_container_size(collected_signatures) + _container_size(num_samples) +
+            _container_size(collected_args))
+
+
+def _enforce_memory_budget():
+    # type: () -> None
+    """Evict functions if the collected data exceeds the memory budget."""
+    global _new_functions
+    budget = _memory_budget
+    assert budget is not None
+    count = len(collected_signatures)
+    target = count
+    if budget.max_functions is not None and count > budget.max_functions:
+        target = int(budget.max_functions * _EVICTION_LOW_WATER)
+    if budget.max_bytes is not None:
+        _new_functions += 1
+        if _new_functions >= _SIZE_CHECK_INTERVAL:
+            _new_functions = 0
+            size = _collected_size()
+            if size > budget.max_bytes:
+                target = min(target, int(count * budget.max_bytes * _EVICTION_LOW_WATER / size))
+    if target < count:
+        _evict(count - target)
+
+
+def _evict(count):
+    # type: (int) -> None
+    """Evict count functions from memory, spilling them to disk if configured.
+
+    Saturated functions go first, as sampling them again can't add
+    signatures.  Then the functions that were updated least recently.
+    """
+    victims = []  # type: List[FunctionKey]
+    for key, signatures in iteritems(collected_signatures):
+        if len(victims) >= count:
+            break
+        if len(signatures) >= MAX_ITEMS_PER_FUNCTION:
+            victims.append(key)
+    evictions['saturated'] += len(victims)
+    if len(victims) < count:
+        saturated = set(victims)
+        num_cold = 0
+        for key in _recently_updated:
+            if len(victims) >= count:
+                break
+            if key in collected_signatures and key not in saturated:
+                victims.append(key)
+                num_cold += 1
+        evictions['cold'] += num_cold
+    records = []
+    for key in victims:
+        signatures = collected_signatures.pop(key)
+        samples = num_samples.pop(key, 0)
+        _recently_updated.pop(key, None)
+        records.append(_function_data(key, signatures, samples))
+    spill_filename = _memory_budget.spill_filename if _memory_budget else None
+    if spill_filename and records:
+        with open(spill_filename, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        evictions['spilled'] += len(records)
+
+
+# Held by dumps while they read the spill file, which they may compact.  Taken
+# before _data_lock.
+_spill_lock = threading.Lock()
+
+
+def _spilled_size():
+    # type: () -> Tuple[Optional[str], int]
+    """Return the spill file and its size.
+
+    Call with _data_lock held, so that no record is half written.
+    """
+    spill_filename = _memory_budget.spill_filename if _memory_budget else None
+    if not spill_filename or not os.path.exists(spill_filename):
+        return None, 0
+    return spill_filename, os.path.getsize(spill_filename)
+
+
+def _read_spilled(spill_filename, size):
+    # type: (Optional[str], int) -> Dict[FunctionKey, FunctionData]
+    """Read the data of the functions spilled to disk, merged per function.
+
+    Call with _spill_lock held, but not _data_lock: the file is read a
+    record at a time, up to size (see _spilled_size()), while functions
+    may be spilled after that.  If some functions were spilled more than
+    once, the file is compacted to a record per function.
+    """
+    result = {}  # type: Dict[FunctionKey, FunctionData]
+    if not spill_filename or not size:
+        return result
+    num_records = 0
+    with open(spill_filename, 'rb') as f:
+        while f.tell() < size:
+            item = json.loads(f.readline().decode('utf-8'))  # type: FunctionData
+            num_records += 1
+            key = FunctionKey(item['path'], item['line'], item['func_name'])
+            if key in result:
+                _merge_function_data(result[key], item)
+            else:
+                result[key] = item
+    if num_records > len(result):
+        _compact_spilled(spill_filename, size, result)
+    return result
+
+
+def _compact_spilled(spill_filename, size, merged):
+    # type: (str, int, Dict[FunctionKey, FunctionData]) -> None
+    """Replace the first size bytes of the spill file with the merged records."""
+    tmp_filename = '%s.%d.tmp' % (spill_filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        for record in itervalues(merged):
+            f.write(json.dumps(record) + '\n')
+    with _data_lock:
+        # Keep what was spilled since the file was read.
+        with open(spill_filename, 'rb') as f:
+            f.seek(size)
+            tail = f.read()
+        with open(tmp_filename, 'ab') as f:
+            f.write(tail)
+        getattr(os, 'replace', os.rename)(tmp_filename, spill_filename)
+
+
+def set_memory_budget(max_functions=None, max_bytes=None, spill_filename=None):
+    # type: (Optional[int], Optional[int], Optional[str]) -> None
+    """
+    Limit the memory used by the collected data.
+
+    When more than max_functions functions have collected data, or the
+    collected data takes more than about max_bytes bytes, functions are
+    evicted from memory in batches: first those that already have the
+    maximum number of signatures, then the least recently updated ones.
+    Evicted data is appended to spill_filename (which is truncated first),
+    and merged back when dumping; without a spill file it is dropped.  The
+    number of evictions is reported by get_stats().
+
+    Call without arguments to remove the budget.
+    """
+    global _memory_budget, _new_functions
+    for name, value in ('max_functions', max_functions), ('max_bytes', max_bytes):
+        if value is not None and value < 1:
+            raise ValueError('%s must be positive: %r' % (name, value))
+    if max_functions is None and max_bytes is None:
+        if spill_filename is not None:
+            raise ValueError('spill_filename requires max_functions or max_bytes')
+        with _data_lock:
+            _memory_budget = None
+            _recently_updated.clear()
+        return
+    if spill_filename:
+        open(spill_filename, 'w').close()
+    with _data_lock:
+        _new_functions = 0
+        _recently_updated.clear()
+        for key in collected_signatures:
+            _recently_updated[key] = None
+        _memory_budget = MemoryBudget(max_functions, max_bytes, spill_filename)
+
+
+def _process_call(key, call_id, resolved_types):
+    # type: (FunctionKey, int, ResolvedTypes) -> None
+    """Record the argument types of a call, pending its return."""
+    if (key, call_id) in collected_args:
+        # An earlier call in a frame with the same ID didn't get a
+        # corresponding return, perhaps because we stopped collecting types
+        # in the middle of the call.
+        _flush_signature(key, call_id, UNKNOWN_TYPE)
+    collected_args[key, call_id] = ArgTypes(resolved_types)
+
+
+def _process_return(key, call_id, return_type):
+    # type: (FunctionKey, int, InternalType) -> None
+    """Complete the signature of a pending call with its return type."""
+    if (key, call_id) in collected_args:
+        _flush_signature(key, call_id, return_type)
+
+
+# Held while updating the collected data, so that it can be read (for example
+# by the snapshot thread) while collection continues.  In buffered mode several
+# threads may also process their buffers concurrently.
+_data_lock = threading.Lock()
 
 
 def type_consumer():
@@ -596,31 +1090,214 @@ def type_consumer():
     # but we start it before any other thread
     while True:
         item = _task_queue.get()
-        if isinstance(item, KeyAndTypes):
-            if item.key in collected_args:
-                # Previous call didn't get a corresponding return, perhaps because we
-                # stopped collecting types in the middle of a call or because of
-                # a recursive function.
-                _flush_signature(item.key, UnknownType)
-            collected_args[item.key] = ArgTypes(item.types)
-        else:
-            assert isinstance(item, KeyAndReturn)
-            if item.key in collected_args:
-                _flush_signature(item.key, item.return_type)
+        with _data_lock:
+            if isinstance(item, KeyAndTypes):
+                _process_call(item.key, item.call_id, item.types)
+            else:
+                assert isinstance(item, KeyAndReturn)
+                _process_return(item.key, item.call_id, item.return_type)
         _task_queue.task_done()
 
 
+def _start_consumer_thread():
+    # type: () -> None
+    global _consumer_thread
+    _consumer_thread = Thread(target=type_consumer)
+    _consumer_thread.daemon = True
+    _consumer_thread.start()
+
+
 _task_queue = Queue()  # type: Queue[Union[KeyAndTypes, KeyAndReturn]]
-_consumer_thread = Thread(target=type_consumer)
-_consumer_thread.daemon = True
-_consumer_thread.start()
+_start_consumer_thread()
+
+
+def _drain_queue(deadline=None):
+    # type: (Optional[float]) -> bool
+    """Wait until the consumer thread has processed the queued events, or the deadline.
+
+    This is _task_queue.join() with a deadline (a time.time() value).
+    Returns whether the queue was drained.
+    """
+    queue = _task_queue
+    with queue.all_tasks_done:
+        while queue.unfinished_tasks:
+            if deadline is None:
+                queue.all_tasks_done.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                queue.all_tasks_done.wait(remaining)
+    return True
+
+
+def _acquire(lock, deadline):
+    # type: (Any, Optional[float]) -> bool
+    """Acquire a lock, giving up at the deadline (a time.time() value) if given."""
+    if deadline is None:
+        return lock.acquire()
+    remaining = max(deadline - time.time(), 0)
+    if sys.version_info < (3,):
+        return lock.acquire(False)  # No timeout on Python 2.
+    return lock.acquire(True, remaining)
+
+
+def _queue_call(key, call_id, resolved_types):
+    # type: (FunctionKey, int, ResolvedTypes) -> None
+    _task_queue.put(KeyAndTypes(key, call_id, resolved_types))
+    if _stats is not None:
+        _stats.record_queue_depth(_task_queue.qsize())
+
+
+def _queue_return(key, call_id, return_type):
+    # type: (FunctionKey, int, InternalType) -> None
+    _task_queue.put(KeyAndReturn(key, call_id, return_type))
+    if _stats is not None:
+        _stats.record_queue_depth(_task_queue.qsize())
+
+
+# Buffered mode: instead of going through '_task_queue', each thread appends
+# events to its own buffer, as compact (tag, key, call_id, types) tuples.
+# Buffers are processed in batches when they fill up, on pause() and before
+# dumping.
+_CALL = 0
+_RETURN = 1
+
+# Number of events a thread buffers before processing them; None selects the
+# queue and consumer thread instead.
+_flush_size = None  # type: Optional[int]
+
+# All thread buffers, paired with their thread (so buffers of dead threads can be
+# dropped once processed), and the lock protecting the list.
+_buffers = []  # type: List[Tuple[Thread, List[Tuple[int, FunctionKey, int, Any]]]]
+_buffers_lock = threading.Lock()
+
+
+class _ThreadBuffer(threading.local):
+    """The calling thread's event buffer (registered on first use)."""
+
+    def __init__(self):
+        # type: () -> None
+        super(_ThreadBuffer, self).__init__()
+        self.items = []  # type: List[Tuple[int, FunctionKey, int, Any]]
+        with _buffers_lock:
+            _buffers.append((threading.current_thread(), self.items))
+
+
+_thread_buffer = _ThreadBuffer()
+
+
+def _process_buffer(items, deadline=None):
+    # type: (List[Tuple[int, FunctionKey, int, Any]], Optional[float]) -> bool
+    """Process and remove the events currently in a thread buffer.
+
+    The owning thread may keep appending while we do this.  Returns False
+    if the collected data couldn't be locked before the deadline.
+    """
+    if not _acquire(_data_lock, deadline):
+        return False
+    try:
+        count = len(items)
+        if _stats is not None:
+            _stats.record_queue_depth(count)
+        batch = items[:count]
+        del items[:count]
+        for tag, key, call_id, value in batch:
+            if tag == _CALL:
+                _process_call(key, call_id, value)
+            else:
+                _process_return(key, call_id, value)
+    finally:
+        _data_lock.release()
+    return True
+
+
+def _buffer_call(key, call_id, resolved_types):
+    # type: (FunctionKey, int, ResolvedTypes) -> None
+    items = _thread_buffer.items
+    items.append((_CALL, key, call_id, resolved_types))
+    if len(items) >= _flush_size:  # type: ignore  # Not None in buffered mode
+        _process_buffer(items)
+
+
+def _buffer_return(key, call_id, return_type):
+    # type: (FunctionKey, int, InternalType) -> None
+    items = _thread_buffer.items
+    items.append((_RETURN, key, call_id, return_type))
+    if len(items) >= _flush_size:  # type: ignore  # Not None in buffered mode
+        _process_buffer(items)
+
+
+def _flush_buffers(deadline=None):
+    # type: (Optional[float]) -> bool
+    """Process the events in all thread buffers, and drop buffers of dead threads.
+
+    Returns False if the deadline (a time.time() value) passed first.
+    """
+    with _buffers_lock:
+        buffers = list(_buffers)
+    for thread, items in buffers:
+        if items and not _process_buffer(items, deadline):
+            return False
+    with _buffers_lock:
+        _buffers[:] = [(thread, items) for thread, items in _buffers
+                       if thread.is_alive() or items]
+    return True
+
+
+# How the hooks hand over events: to the queue (the default) or to thread buffers.
+_emit_call = _queue_call  # type: Callable[[FunctionKey, int, ResolvedTypes], None]
+_emit_return = _queue_return  # type: Callable[[FunctionKey, int, InternalType], None]
 
 running = False
 
+# Scopes accepted by collect() and init_types_collection().  A process scope
+# collects in every thread (while running); a context scope only collects
+# code running in the contextvars context that entered it, i.e. the current
+# thread or asyncio task and the tasks it creates.
+SCOPE_PROCESS = 'process'
+SCOPE_CONTEXT = 'context'
+
+# The scope given to init_types_collection(), and the profiler hook that
+# context scopes install in their thread with the setprofile backend.
+_scope = SCOPE_PROCESS
+_profile_hook = None  # type: Optional[Callable[[Any, str, Any], None]]
+# A _ScopeMarker in contexts inside a context scope (false outside them).
+_in_scope = (contextvars.ContextVar('pyannotate_in_scope', default=False)
+             if contextvars is not None else None)  # type: Any
+
+
+class _ScopeMarker(object):
+    """The value of _in_scope in a context scope and the contexts copied from it.
+
+    A context scope lasts as long as its marker: asyncio tasks created in
+    the scope keep it alive until they are done, even if the scope was
+    exited before.
+    """
+
+    __slots__ = ('__weakref__',)
+
+
+# The live scope markers (weak references to them), with the thread that
+# created each, and their number.  The hooks only look at _in_scope while
+# there are any.  The lock is reentrant, as a marker may be freed while it
+# is held.
+_scope_markers = {}  # type: Dict[weakref.ref, Thread]
+_context_scopes = 0
+_scopes_lock = threading.RLock()
+
 TOP_DIR = os.path.join(os.getcwd(), '')     # current dir with trailing slash
 TOP_DIR_DOT = os.path.join(TOP_DIR, '.')
 TOP_DIR_LEN = len(TOP_DIR)
 
+# The filenames without extension of this module, of the aggregator module,
+# which runs a thread in the collected process, and of the pyannotate_tools
+# modules used to write the data; the collector never collects itself.
+_THIS_FILE = os.path.splitext(__file__)[0]
+_COLLECTOR_FILES = frozenset([_THIS_FILE, os.path.join(os.path.dirname(_THIS_FILE), 'aggregator'),
+                              os.path.splitext(formats.__file__)[0],
+                              os.path.splitext(store.__file__)[0]])
+
 
 def _make_sampling_sequence(n):
     # type: (int) -> List[int]
@@ -646,40 +1323,535 @@ MAX_SAMPLES_PER_FUNC = 500
 sampling_sequence = frozenset(_make_sampling_sequence(MAX_SAMPLES_PER_FUNC))
 LAST_SAMPLE = max(sampling_sequence)
 
-# Array of counters indexed by ID of code object.
+# Array of counters indexed by ID of code object.  Entries are removed when
+# the code object is freed (see _forget_code()).
 sampling_counters = {}  # type: Dict[int, Optional[int]]
-# IDs of code objects for which the previous event was a call (awaiting return).
+# IDs of the frames of sampled calls awaiting their return.
 call_pending = set()  # type: Set[int]
 
+# Adaptive saturation (see init_types_collection()): a function is saturated
+# once _stable_samples samples in a row added no signature, or once it has
+# MAX_ITEMS_PER_FUNCTION signatures.  The consumer then stores None in
+# 'sampling_counters' for its code objects, so that the hooks stop sampling it
+# (and sys.monitoring disables it).  With _detach_when_saturated, the hooks are
+# removed altogether once all functions seen so far are saturated.
+_stable_samples = None  # type: Optional[int]
+_detach_when_saturated = False
+_detached = False
+# Samples in a row that added no signature, by function.
+_stable_counts = {}  # type: Dict[FunctionKey, int]
+_saturated = set()  # type: Set[FunctionKey]
+_unsaturated = set()  # type: Set[FunctionKey]
+# The IDs of the code objects of each function seen (normally just one).
+_function_codes = {}  # type: Dict[FunctionKey, Set[int]]
+# Reentrant, since _forget_code() may run during garbage collection.
+_saturation_lock = threading.RLock()
+
+
+def _count_stable_sample(key, stable, num_signatures):
+    # type: (FunctionKey, bool, int) -> None
+    """Count a sample of a function, and saturate it if its signatures are stable.
+
+    Called by the consumer, with the number of signatures after the sample
+    and whether the sample left them unchanged.
+    """
+    count = _stable_counts.get(key, 0) + 1 if stable else 0
+    _stable_counts[key] = count
+    # A saturated function can still get a sample if a hook raced with us
+    # updating its counter; saturating it again fixes that.
+    if count >= _stable_samples or num_signatures >= MAX_ITEMS_PER_FUNCTION:  # type: ignore
+        _saturate(key)
+
+
+def _saturate(key):
+    # type: (FunctionKey) -> None
+    """Stop sampling a function, and remove the hooks if it was the last one sampled."""
+    with _saturation_lock:
+        _saturated.add(key)
+        _unsaturated.discard(key)
+        code_ids = list(_function_codes.get(key, ()))
+        detach = _detach_when_saturated and not _unsaturated and not _detached
+    with _fold_lock:
+        for code_id in code_ids:
+            sampling_counters[code_id] = None
+    if detach:
+        _detach_hooks()
+
+
+def _detach_hooks():
+    # type: () -> None
+    """Remove the hooks because all functions seen are saturated.
 
-@contextmanager
-def collect():
-    # type: () -> Iterator[None]
-    resume()
-    try:
-        yield
-    finally:
-        pause()
+    The next resume() reattaches them; the functions stay saturated until
+    the next init_types_collection().
+    """
+    global _detached  # pylint: disable=global-statement
+    _detached = True
+    if _profile_hook is not None:
+        # The profiler hook removes itself from each thread on its next event.
+        threading.setprofile(None)  # type: ignore
+    _update_monitoring_events()
 
 
-def pause():
+def _attach_hooks():
     # type: () -> None
-    """
-    Pause the type collection
-    """
-    global running  # pylint: disable=global-statement
-    running = False
-    _task_queue.join()
+    """Undo _detach_hooks(), except that the profiler hook only returns to this thread and new ones."""
+    global _detached  # pylint: disable=global-statement
+    _detached = False
+    if _profile_hook is not None and _scope == SCOPE_PROCESS:
+        sys.setprofile(_profile_hook)
+        threading.setprofile(_profile_hook)
+    _update_monitoring_events()
 
 
-def resume():
-    # type: () -> None
+class SamplingPolicy(object):
     """
-    Resume the type collection
+    Base class for policies deciding which calls of a function are sampled.
+
+    Pass an instance to init_types_collection() to replace the default
+    schedule (calls 0-4 and every 50th call up to MAX_SAMPLES_PER_FUNC).
+    Policies are consulted from the profiler hook, in every thread, so
+    should_sample() must be cheap.
     """
-    global running  # pylint: disable=global-statement
-    running = True
-    sampling_counters.clear()
+
+    def should_sample(self, n, code):
+        # type: (int, Any) -> Optional[bool]
+        """
+        Decide whether to sample call number n (counting from 0) of a code object.
+
+        Return True to sample the call, False to skip it, or None to stop
+        sampling the code object altogether (until the next resume()).
+        """
+        raise NotImplementedError
+
+    def record_overhead(self, seconds):
+        # type: (float) -> None
+        """Called with the time the hook spent on each sampled event."""
+        pass
+
+
+class SequenceSamplingPolicy(SamplingPolicy):
+    """Sample the calls whose numbers are in a given finite sequence."""
+
+    def __init__(self, sequence):
+        # type: (Iterable[int]) -> None
+        self.sequence = frozenset(sequence)
+        self.last = max(self.sequence)
+
+    def should_sample(self, n, code):
+        # type: (int, Any) -> Optional[bool]
+        if n in self.sequence:
+            return True
+        elif n > self.last:
+            return None
+        return False
+
+
+class ExponentialBackoffPolicy(SequenceSamplingPolicy):
+    """
+    Sample the first calls, then calls first * factor**k, up to max_samples samples.
+
+    For example, the defaults sample calls 0-4, 10, 20, 40, 80, ...
+    """
+
+    def __init__(self, first=5, factor=2, max_samples=20):
+        # type: (int, int, int) -> None
+        if first < 1 or factor < 2 or max_samples < first:
+            raise ValueError('Invalid exponential backoff parameters')
+        sequence = list(range(first))
+        n = first * factor
+        while len(sequence) < max_samples:
+            sequence.append(n)
+            n *= factor
+        super(ExponentialBackoffPolicy, self).__init__(sequence)
+
+
+class ProbabilisticPolicy(SamplingPolicy):
+    """
+    Sample the first calls, then each call with probability 1/n.
+
+    If max_calls is given, stop sampling a function after that many calls.
+    """
+
+    def __init__(self, n, first=1, max_calls=None, seed=None):
+        # type: (int, int, Optional[int], Optional[int]) -> None
+        if n < 1:
+            raise ValueError('Invalid sampling rate: 1 in %r' % (n,))
+        self.probability = 1.0 / n
+        self.first = first
+        self.max_calls = max_calls
+        self.random = random.Random(seed).random
+
+    def should_sample(self, n, code):
+        # type: (int, Any) -> Optional[bool]
+        if n < self.first:
+            return True
+        elif self.max_calls is not None and n >= self.max_calls:
+            return None
+        return self.random() < self.probability
+
+
+class ModuleRatePolicy(SamplingPolicy):
+    """
+    Use a different policy per module.
+
+    The 'policies' argument maps dotted module or package names to policies;
+    the policy for the longest matching name applies (a package name matches
+    all its submodules).  Functions in other modules use the default policy,
+    which is the standard schedule if not given.  Modules are identified by
+    the filename that the filename filter produces, e.g. 'pkg/mod.py'.
+    """
+
+    def __init__(self, policies, default=None):
+        # type: (Mapping[str, SamplingPolicy], Optional[SamplingPolicy]) -> None
+        self.policies = dict(policies)
+        self.default = default or SequenceSamplingPolicy(sampling_sequence)
+        # Policy by code.co_filename.
+        self.cache = {}  # type: Dict[str, SamplingPolicy]
+
+    def policy_for_filename(self, filename):
+        # type: (str) -> SamplingPolicy
+        policy = self.cache.get(filename)
+        if policy is None:
+            policy = self.default
+            path = _filter_filename(filename)
+            if path:
+                module = os.path.splitext(path)[0].replace(os.sep, '.')
+                while module:
+                    if module in self.policies:
+                        policy = self.policies[module]
+                        break
+                    module = module.rpartition('.')[0]
+            self.cache[filename] = policy
+        return policy
+
+    def should_sample(self, n, code):
+        # type: (int, Any) -> Optional[bool]
+        return self.policy_for_filename(code.co_filename).should_sample(n, code)
+
+    def record_overhead(self, seconds):
+        # type: (float) -> None
+        for policy in set(self.policies.values()) | {self.default}:
+            policy.record_overhead(seconds)
+
+
+class OverheadBudgetPolicy(SamplingPolicy):
+    """
+    Throttle another policy when sampling takes too much of the wall time.
+
+    While the time spent by the hook on sampled events exceeds max_fraction
+    of the wall time since the first call, calls are skipped (but not
+    counted as done).  Only sampled events are timed; timing every event
+    would itself add too much overhead.
+    """
+
+    def __init__(self, policy=None, max_fraction=0.01):
+        # type: (Optional[SamplingPolicy], float) -> None
+        if not 0 < max_fraction < 1:
+            raise ValueError('max_fraction must be between 0 and 1: %r' % (max_fraction,))
+        self.policy = policy or SequenceSamplingPolicy(sampling_sequence)
+        self.max_fraction = max_fraction
+        self.start = None  # type: Optional[float]
+        self.overhead = 0.0
+
+    def over_budget(self):
+        # type: () -> bool
+        now = _timer()
+        if self.start is None:
+            self.start = now
+        return self.overhead > (now - self.start) * self.max_fraction
+
+    def should_sample(self, n, code):
+        # type: (int, Any) -> Optional[bool]
+        sample = self.policy.should_sample(n, code)
+        if sample and self.over_budget():
+            return False
+        return sample
+
+    def record_overhead(self, seconds):
+        # type: (float) -> None
+        self.overhead += seconds
+        self.policy.record_overhead(seconds)
+
+
+# The sampling policy; None selects the default schedule, which is inlined
+# in _should_sample() for speed.
+_sampling_policy = None  # type: Optional[SamplingPolicy]
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def _should_sample(n, code):
+    # type: (int, Any) -> Optional[bool]
+    """Ask the sampling policy about call number n of a code object."""
+    if _sampling_policy is None:
+        # Each function gets traced at most MAX_SAMPLES_PER_FUNC times per run.
+        if n in sampling_sequence:
+            return True
+        return None if n > LAST_SAMPLE else False
+    return _sampling_policy.should_sample(n, code)
+
+
+# Per-thread mode, for free-threaded Python (PEP 703) where the hooks run in
+# parallel.  Updating 'sampling_counters' and 'call_pending' on every call
+# would make the threads contend for them, so instead each thread counts calls
+# and keeps its pending calls in its own state.  'sampling_counters' then holds
+# the calls folded in from all threads (or None as usual).  A thread folds in
+# its count of a function every _FOLD_INTERVAL calls and on every sampled call,
+# so the call numbers passed to the sampling policy lag behind by at most
+# _FOLD_INTERVAL calls per other thread.  Samples are claimed under a lock and
+# no call number is sampled twice, so a function never gets more samples than
+# when counting exactly.
+_per_thread = False
+_FOLD_INTERVAL = 16
+_fold_lock = threading.Lock()
+# The highest call number sampled so far, by ID of code object.
+_sampled_upto = {}  # type: Dict[int, int]
+
+
+class _ThreadState(threading.local):
+    """The collector state of a thread in per-thread mode."""
+
+    def __init__(self):
+        # type: () -> None
+        super(_ThreadState, self).__init__()
+        # Calls not yet folded into 'sampling_counters', by ID of code object.
+        self.counts = {}  # type: Dict[int, int]
+        # IDs of the frames of sampled calls awaiting their return.
+        self.pending = set()  # type: Set[int]
+        # The number of context scopes entered in this thread and not yet
+        # exited, and the profiler hook to restore when there are none.
+        self.scopes = 0
+        self.previous_profile = None  # type: Any
+        with _thread_states_lock:
+            _thread_states.append((threading.current_thread(), self.counts))
+
+
+# The call counts of all threads, so that resume() can reset them.
+_thread_states = []  # type: List[Tuple[Thread, Dict[int, int]]]
+_thread_states_lock = threading.Lock()
+_thread_state = _ThreadState()
+
+
+def _count_call_per_thread(key, folded, code):
+    # type: (int, int, Any) -> Optional[bool]
+    """Count a call in per-thread mode and ask the sampling policy about it.
+
+    The folded count is the one read from 'sampling_counters'.  Returns
+    True, False or None like _should_sample().
+    """
+    counts = _thread_state.counts
+    local = counts.get(key, 0)
+    n = folded + local
+    sample = _should_sample(n, code)
+    if sample is None:
+        return None
+    local += 1
+    if not sample and local < _FOLD_INTERVAL:
+        counts[key] = local
+        return False
+    counts[key] = 0
+    with _fold_lock:
+        folded = sampling_counters.get(key, 0)  # type: ignore  # Not None until stopped
+        if folded is None:
+            return None
+        sampling_counters[key] = folded + local
+        if sample:
+            if _sampled_upto.get(key, -1) >= n:
+                return False  # Another thread sampled this call number.
+            _sampled_upto[key] = n
+    return sample
+
+
+@contextmanager
+def collect(scope=None):
+    # type: (Optional[str]) -> Iterator[None]
+    """Collect types while running the block.
+
+    With SCOPE_PROCESS this is resume() before the block and pause() after
+    it.  With SCOPE_CONTEXT only the calls made in the block's contextvars
+    context are collected: those of the current thread, or in asyncio those
+    of the current task and of the tasks it creates.  A context scope
+    neither resets the sampling counters nor waits for the collected events
+    to be processed, so that it can be entered for e.g. one request in a
+    hundred in a server.  The default is the scope given to
+    init_types_collection().
+    """
+    if scope is None:
+        scope = _scope
+    _check_scope(scope)
+    if scope == SCOPE_PROCESS:
+        resume()
+        try:
+            yield
+        finally:
+            pause()
+        return
+    token = _enter_context_scope()
+    try:
+        yield
+    finally:
+        _exit_context_scope(token)
+
+
+class _Completed(object):
+    """An awaitable that is already done (and whose result is None)."""
+
+    def __await__(self):
+        # type: () -> Iterator[Any]
+        return iter(())
+
+
+class acollect(object):  # pylint: disable=invalid-name
+    """Collect types while running the block of an async with statement.
+
+    Like collect(), except that leaving a process scope doesn't block the
+    event loop: the events collected are processed while awaiting, using
+    the loop's default executor.  Requires Python 3.5 or later.
+    """
+
+    def __init__(self, scope=None):
+        # type: (Optional[str]) -> None
+        if scope is None:
+            scope = _scope
+        _check_scope(scope)
+        self.scope = scope
+        self.token = None  # type: Any
+
+    def __aenter__(self):
+        # type: () -> Any
+        if self.scope == SCOPE_PROCESS:
+            resume()
+        else:
+            self.token = _enter_context_scope()
+        return _Completed()
+
+    def __aexit__(self, exc_type, exc_value, traceback):
+        # type: (Any, Any, Any) -> Any
+        if self.scope == SCOPE_CONTEXT:
+            _exit_context_scope(self.token)
+            return _Completed()
+        pause(wait=False)
+        import asyncio  # Not on Python 2.
+        # get_event_loop() is deprecated in coroutines on Python 3.12.
+        get_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+        return get_loop().run_in_executor(None, _finish_pause)
+
+
+def _check_scope(scope):
+    # type: (str) -> None
+    if scope not in (SCOPE_PROCESS, SCOPE_CONTEXT):
+        raise ValueError('Unknown scope: %r' % (scope,))
+    if scope == SCOPE_CONTEXT and contextvars is None:
+        raise ValueError('The %r scope requires Python 3.7 or later' % (scope,))
+
+
+def _new_scope_marker():
+    # type: () -> _ScopeMarker
+    global _context_scopes  # pylint: disable=global-statement
+    marker = _ScopeMarker()
+    with _scopes_lock:
+        _scope_markers[weakref.ref(marker, _scope_marker_freed)] = threading.current_thread()
+        _context_scopes = len(_scope_markers)
+        if _context_scopes == 1:
+            _update_monitoring_events()
+    return marker
+
+
+def _scope_marker_freed(ref):
+    # type: (weakref.ref) -> None
+    """Called when the last context in a context scope is gone."""
+    global _context_scopes  # pylint: disable=global-statement
+    with _scopes_lock:
+        if _scope_markers.pop(ref, None) is None:
+            return  # Created before a fork, in another thread.
+        _context_scopes = len(_scope_markers)
+        if _context_scopes == 0:
+            _update_monitoring_events()
+
+
+def _enter_context_scope():
+    # type: () -> Any
+    """Enter a context scope, and return the token for leaving it."""
+    token = _in_scope.set(_in_scope.get() or _new_scope_marker())
+    state = _thread_state
+    state.scopes += 1
+    if (state.scopes == 1 and _scope == SCOPE_CONTEXT and _profile_hook is not None and
+            not _detached and sys.getprofile() is not _profile_hook):
+        # Only threads inside a context scope have the profiler hook.
+        state.previous_profile = sys.getprofile()
+        sys.setprofile(_profile_hook)
+    return token
+
+
+def _exit_context_scope(token):
+    # type: (Any) -> None
+    _in_scope.reset(token)
+    state = _thread_state
+    state.scopes -= 1
+    if not _context_scopes:
+        _remove_context_hook(state)
+    # Otherwise tasks created in the scope may still be running in this
+    # thread; the hook removes itself once all context scopes are gone.
+
+
+def _remove_context_hook(state):
+    # type: (_ThreadState) -> None
+    """Remove the profiler hook that context scopes installed in this thread, unless in one."""
+    if state.scopes == 0 and _scope == SCOPE_CONTEXT and sys.getprofile() is _profile_hook:
+        sys.setprofile(state.previous_profile)
+        state.previous_profile = None
+
+
+def pause(wait=True, timeout=None):
+    # type: (bool, Optional[float]) -> bool
+    """
+    Pause the type collection
+
+    By default this waits until the events collected so far have been
+    processed, for at most timeout seconds if given.  With wait=False it
+    returns right away, and the consumer thread keeps processing queued
+    events in the background; dumping waits for them, and processes the
+    thread buffers.  Returns whether all events have been processed.
+    """
+    global running  # pylint: disable=global-statement
+    running = False
+    if not wait:
+        return not _task_queue.unfinished_tasks and not any(items for _, items in _buffers)
+    deadline = None if timeout is None else time.time() + timeout
+    return _drain_queue(deadline) and _flush_buffers(deadline)
+
+
+def _finish_pause():
+    # type: () -> None
+    """Wait for the events collected before pause(wait=False) to be processed."""
+    _drain_queue()
+    _flush_buffers()
+
+
+def resume():
+    # type: () -> None
+    """
+    Resume the type collection
+    """
+    global running  # pylint: disable=global-statement
+    with _thread_states_lock:
+        _thread_states[:] = [(thread, counts) for thread, counts in _thread_states
+                             if thread.is_alive()]
+        for _, counts in _thread_states:
+            counts.clear()
+    _sampled_upto.clear()
+    running = True
+    sampling_counters.clear()
+    with _saturation_lock:
+        for key in _saturated:
+            for code_id in _function_codes.get(key, ()):
+                sampling_counters[code_id] = None
+    if _detached:
+        _attach_hooks()
+    if _monitoring is not None and _monitoring.get_tool(MONITORING_TOOL_ID) == 'pyannotate':
+        # Code objects disabled during the previous run are interesting again.
+        _monitoring.restart_events()
 
 
 def default_filter_filename(filename):
@@ -708,6 +1880,219 @@ def default_filter_filename(filename):
 _filter_filename = default_filter_filename  # type: Callable[[Optional[str]], Optional[str]]
 
 
+# Code flags of generator functions and coroutines, whose frames are suspended
+# and resumed (which the profiler reports as returns and calls).
+CO_GENERATOR = inspect.CO_GENERATOR
+CO_COROUTINE = getattr(inspect, 'CO_COROUTINE', 0)
+CO_ASYNC_GENERATOR = getattr(inspect, 'CO_ASYNC_GENERATOR', 0)
+_SUSPENDABLE = CO_GENERATOR | CO_COROUTINE | CO_ASYNC_GENERATOR
+
+# Calling a generator function returns a generator without running any code;
+# we record that as the return type when the generator starts, and ignore the
+# values it yields and returns.
+_GENERATOR_TYPES = {
+    CO_GENERATOR: ScalarType(types.GeneratorType),
+}  # type: Dict[int, InternalType]
+if CO_ASYNC_GENERATOR:
+    _GENERATOR_TYPES[CO_ASYNC_GENERATOR] = ScalarType(types.AsyncGeneratorType)  # type: ignore
+
+# The instruction offset (frame.f_lasti) when a frame starts running.
+if sys.version_info >= (3, 11):
+    _START_OFFSET = None  # type: Optional[int]  # The offset of the first RESUME
+else:
+    _START_OFFSET = -1
+
+
+def _suspension_info(code):
+    # type: (Any) -> Tuple[int, FrozenSet[int]]
+    """Return the start offset of a generator or coroutine, and the offsets at which it suspends.
+
+    A 'call' profiler event is for a resumed frame unless frame.f_lasti is at
+    the start offset, and a 'return' event is for a suspended frame if
+    frame.f_lasti is at a suspending instruction: a yield, the instruction
+    before a YIELD_FROM (before Python 3.11, f_lasti is rewound to it) or a
+    RESUME other than the first (Python 3.13 reports it after a yield).
+    """
+    instructions = list(dis.get_instructions(code))
+    resumes = [instr.offset for instr in instructions if instr.opname == 'RESUME']
+    start = resumes[0] if _START_OFFSET is None else _START_OFFSET
+    suspend_offsets = set(resumes[1:])
+    previous = None
+    for instr in instructions:
+        if instr.opname in ('YIELD_VALUE', 'YIELD_FROM'):
+            suspend_offsets.add(instr.offset)
+            if instr.opname == 'YIELD_FROM' and previous is not None:
+                suspend_offsets.add(previous.offset)
+        previous = instr
+    return start, frozenset(suspend_offsets)
+
+
+# Metadata about a code object that we only need to compute once: a weak
+# reference to the code object itself, the key its types are collected under
+# (None if we're not interested in it), its argument extractor (see
+# make_arg_extractor()), for generator functions the type of the generator,
+# and for generators and coroutines the start offset and suspending offsets
+# (see _suspension_info()).
+CodeInfo = NamedTuple('CodeInfo', [('ref', Any),
+                                   ('function_key', Optional[FunctionKey]),
+                                   ('extract_args', Callable[[Mapping[str, Any]], ResolvedTypes]),
+                                   ('generator_type', Optional[InternalType]),
+                                   ('start_offset', int),
+                                   ('suspend_offsets', FrozenSet[int])])
+
+# CodeInfo for each code object seen, indexed by ID of code object.
+# An entry is only valid if its weak reference still points to the same code
+# object; entries are removed when their code object is freed, so code generated
+# at runtime doesn't make this table (or 'sampling_counters') grow without bound.
+_code_info = {}  # type: Dict[int, CodeInfo]
+
+
+def _forget_code(key, ref):
+    # type: (int, Any) -> None
+    """Weak reference callback: drop all state for a code object being freed."""
+    info = _code_info.get(key)
+    if info is not None and info.ref is ref:
+        del _code_info[key]
+        sampling_counters.pop(key, None)
+        _sampled_upto.pop(key, None)
+        if info.function_key is not None:
+            with _saturation_lock:
+                code_ids = _function_codes.get(info.function_key)
+                if code_ids is not None:
+                    code_ids.discard(key)
+                    if not code_ids:
+                        del _function_codes[info.function_key]
+                        _unsaturated.discard(info.function_key)
+
+
+def _get_code_info(code, frame):
+    # type: (Any, Any) -> CodeInfo
+    """Return the (cached) CodeInfo for a code object executing in a frame.
+
+    If we are not interested in the code object, stop sampling it.
+    """
+    key = id(code)
+    info = _code_info.get(key)
+    if info is None or info.ref() is not code:
+        # Track calls under current directory only, and never the collector itself.
+        filename = _filter_filename(code.co_filename)
+        if os.path.splitext(code.co_filename)[0] in _COLLECTOR_FILES:
+            filename = None
+        info = _make_code_info(code, filename, lambda: get_function_name_from_frame(frame))
+    if info.function_key is None:
+        sampling_counters[key] = None  # We're not interested in this function.
+    return info
+
+
+def _make_code_info(code, filename, get_function_name):
+    # type: (Any, Optional[str], Callable[[], str]) -> CodeInfo
+    """Compute and cache the CodeInfo for a code object.
+
+    The filename is the one its types are collected under, or None if we
+    are not interested in it.
+    """
+    key = id(code)
+    function_key = None  # type: Optional[FunctionKey]
+    if filename:
+        func_name = get_function_name()
+        # Could be a lambda or a comprehension; we're not interested.
+        if func_name and func_name[0] != '<':
+            function_key = FunctionKey(filename, code.co_firstlineno, func_name)
+            seeded = _seeded.get(function_key)
+            if seeded is not None and len(seeded['type_comments']) >= MAX_ITEMS_PER_FUNCTION:
+                function_key = None  # Sampling it again can't add type comments.
+    if function_key is not None:
+        with _saturation_lock:
+            _function_codes.setdefault(function_key, set()).add(key)
+            if function_key not in _saturated:
+                _unsaturated.add(function_key)
+    ref = weakref.ref(code, lambda ref: _forget_code(key, ref))
+    flags = code.co_flags
+    generator_type = None  # type: Optional[InternalType]
+    start_offset, suspend_offsets = -1, frozenset()  # type: Tuple[int, FrozenSet[int]]
+    if flags & _SUSPENDABLE:
+        generator_type = _GENERATOR_TYPES.get(flags & (CO_GENERATOR | CO_ASYNC_GENERATOR))
+        if sys.version_info >= (3,):
+            start_offset, suspend_offsets = _suspension_info(code)
+    info = CodeInfo(ref, function_key, make_arg_extractor(code), generator_type,
+                    start_offset, suspend_offsets)
+    _code_info[key] = info
+    return info
+
+
+class CollectorStats(object):
+    """
+    Counters describing the work done by the collector itself.
+
+    Only kept if init_types_collection() is called with collect_stats=True.
+    The counters are updated without locking from all threads, so they may
+    be slightly off when several threads are busy.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        # Hook invocations while running: profiler events for the setprofile
+        # backend (including C calls), or PY_START/PY_RETURN/PY_UNWIND events.
+        self.events_seen = 0
+        # Events handed over to the consumer (calls and returns).
+        self.events_sampled = 0
+        # Events ignored because the function is filtered out, or because it
+        # has been sampled enough.  (With the monitoring backend most of these
+        # events are disabled rather than ignored.)
+        self.events_skipped_filter = 0
+        self.events_skipped_saturated = 0
+        # The largest number of events waiting in the queue, or processed in
+        # a single batch in buffered mode.
+        self.queue_high_water = 0
+        # Time spent in the hook for sampled events, and the part of that
+        # spent resolving types.
+        self.hook_seconds = 0.0
+        self.resolve_type_seconds = 0.0
+        self.function_hook_seconds = {}  # type: Dict[FunctionKey, float]
+
+    def record_event(self, code):
+        # type: (Any) -> None
+        self.events_seen += 1
+        key = id(code)
+        if sampling_counters.get(key, 0) is None:
+            info = _code_info.get(key)
+            if info is not None and info.function_key is None:
+                self.events_skipped_filter += 1
+            else:
+                self.events_skipped_saturated += 1
+
+    def record_sample(self, function_key, hook_seconds, resolve_seconds):
+        # type: (FunctionKey, float, float) -> None
+        self.events_sampled += 1
+        self.hook_seconds += hook_seconds
+        self.resolve_type_seconds += resolve_seconds
+        function_seconds = self.function_hook_seconds
+        function_seconds[function_key] = function_seconds.get(function_key, 0.0) + hook_seconds
+
+    def record_queue_depth(self, depth):
+        # type: (int) -> None
+        if depth > self.queue_high_water:
+            self.queue_high_water = depth
+
+
+# Statistics about the collector, or None if we're not keeping them.
+_stats = None  # type: Optional[CollectorStats]
+
+
+def _record_overhead(function_key, start, resolving, resolved):
+    # type: (FunctionKey, float, float, float) -> None
+    """Account for the time the hook spent on a sampled event.
+
+    The event was handled from 'start' until now, and spent the time from
+    'resolving' to 'resolved' resolving types.
+    """
+    seconds = _timer() - start
+    if _sampling_policy is not None:
+        _sampling_policy.record_overhead(seconds)
+    if _stats is not None:
+        _stats.record_sample(function_key, seconds, resolved - resolving)
+
+
 def _trace_dispatch(frame, event, arg):
     # type: (Any, str, Optional[Any]) -> None
     """
@@ -717,7 +2102,13 @@ def _trace_dispatch(frame, event, arg):
     Arguments are described in https://docs.python.org/2/library/sys.html#sys.settrace
     """
     # Bail if we're not tracing.
-    if not running:
+    if not running and not (_context_scopes and _in_scope.get()):
+        if not _context_scopes and _scope == SCOPE_CONTEXT:
+            _remove_context_hook(_thread_state)
+        return
+    if _detached:
+        # All functions are saturated (see _detach_hooks()).
+        sys.setprofile(None)
         return
 
     # Get counter for this code object.  Bail if we don't care about this function.
@@ -728,56 +2119,383 @@ def _trace_dispatch(frame, event, arg):
     if n is None:
         return
 
+    # Calls and returns are paired by frame, so that recursive calls, calls in
+    # other threads and interleaved coroutines don't get mixed up.
+    frame_id = id(frame)
+    pending = _thread_state.pending if _per_thread else call_pending
     if event == 'call':
-        # Bump counter and bail depending on sampling sequence.
-        sampling_counters[key] = n + 1
-        # Each function gets traced at most MAX_SAMPLES_PER_FUNC times per run.
-        # NOTE: There's a race condition if two threads call the same function.
-        # I don't think we should care, so what if it gets probed an extra time.
-        if n not in sampling_sequence:
-            if n > LAST_SAMPLE:
+        if not n or code.co_flags & _SUSPENDABLE:
+            # Get the CodeInfo when the code object is first seen rather than
+            # sampled, so that its weak reference drops the counter.
+            info = _get_code_info(code, frame)
+            if info.function_key is None:
+                return
+            if code.co_flags & _SUSPENDABLE and frame.f_lasti != info.start_offset:
+                # Resuming a generator or coroutine is not a call.
+                return
+        # Bump counter and bail depending on sampling policy.
+        if _per_thread:
+            sample = _count_call_per_thread(key, n, code)
+        else:
+            sampling_counters[key] = n + 1
+            # NOTE: There's a race condition if two threads call the same function.
+            # I don't think we should care, so what if it gets probed an extra time.
+            sample = _should_sample(n, code)
+        if not sample:
+            if sample is None:
                 sampling_counters[key] = None  # We're no longer interested in this function.
-            call_pending.discard(key)  # Avoid getting events out of sync
+            pending.discard(frame_id)  # Avoid getting events out of sync
             return
-        # Mark that we are looking for a return from this code object.
-        call_pending.add(key)
+        # Mark that we are looking for a return from this frame.
+        pending.add(frame_id)
     elif event == 'return':
-        if key not in call_pending:
+        if frame_id not in pending:
             # No pending call event -- ignore this event. We only collect
             # return events when we know the corresponding call event.
             return
-        call_pending.remove(key)
+        if (code.co_flags & _SUSPENDABLE and
+                frame.f_lasti in _get_code_info(code, frame).suspend_offsets):
+            # Suspending a coroutine is not a return.
+            return
+        pending.remove(frame_id)
     else:
         # Ignore other events, such as c_call and c_return.
         return
 
-    # Track calls under current directory only.
-    filename = _filter_filename(code.co_filename)
-    if filename:
-        func_name = get_function_name_from_frame(frame)
-        if not func_name or func_name[0] == '<':
-            # Could be a lambda or a comprehension; we're not interested.
+    timed = _sampling_policy is not None or _stats is not None
+    if timed:
+        start = _timer()
+    info = _get_code_info(code, frame)
+    function_key = info.function_key
+    if function_key is None:
+        return
+    if timed:
+        resolving = _timer()
+    if event == 'call':
+        resolved_types = info.extract_args(frame.f_locals)
+        if timed:
+            resolved = _timer()
+        _emit_call(function_key, frame_id, resolved_types)
+        if info.generator_type is not None:
+            pending.discard(frame_id)
+            _emit_return(function_key, frame_id, info.generator_type)
+    else:
+        # This event is also triggered if a function raises an exception,
+        # and in this case the return value is 'None'.  There doesn't seem
+        # to be a way to distinguish an exception from a None return,
+        # unfortunately.  (The sys.monitoring backend can tell them apart.)
+        return_type = resolve_type(arg)
+        if timed:
+            resolved = _timer()
+        _emit_return(function_key, frame_id, return_type)
+    if timed:
+        _record_overhead(function_key, start, resolving, resolved)
+
+
+def _counting_trace_dispatch(frame, event, arg):
+    # type: (Any, str, Optional[Any]) -> None
+    """The profiler hook used when collecting statistics about the collector."""
+    stats = _stats
+    if stats is not None and (running or _context_scopes and _in_scope.get()):
+        stats.record_event(frame.f_code)
+    _trace_dispatch(frame, event, arg)
+
+
+# sys.monitoring (PEP 669) is available on Python 3.12 and later.  Unlike the
+# profiler hook it only reports Python function events, and a callback can
+# return DISABLE to stop receiving events for a code object altogether.
+_monitoring = getattr(sys, 'monitoring', None)
+_DISABLE = getattr(_monitoring, 'DISABLE', None)
+MONITORING_TOOL_ID = getattr(_monitoring, 'PROFILER_ID', None)
+
+
+def _monitor_py_start(code, instruction_offset):
+    # type: (Any, int) -> Any
+    """Handle a PY_START event (the sys.monitoring counterpart of 'call')."""
+    if not running and not (_context_scopes and _in_scope.get()):
+        return None
+    if _stats is not None:
+        _stats.record_event(code)
+    key = id(code)
+    n = sampling_counters.get(key, 0)
+    if n is None:
+        return _DISABLE
+    if not n:
+        # Get the CodeInfo when first seen, as in _trace_dispatch().
+        frame = sys._getframe(1)  # pylint: disable=protected-access
+        if _get_code_info(code, frame).function_key is None:
+            return _DISABLE
+    if _per_thread:
+        sample = _count_call_per_thread(key, n, code)
+    else:
+        sampling_counters[key] = n + 1
+        sample = _should_sample(n, code)
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    frame_id = id(frame)
+    pending = _thread_state.pending if _per_thread else call_pending
+    if not sample:
+        pending.discard(frame_id)
+        if sample is None:
             sampling_counters[key] = None
-        else:
-            function_key = FunctionKey(filename, code.co_firstlineno, func_name)
-            if event == 'call':
-                # TODO(guido): Make this faster
-                arg_info = inspect.getargvalues(frame)  # type: ArgInfo
-                resolved_types = prep_args(arg_info)
-                _task_queue.put(KeyAndTypes(function_key, resolved_types))
-            elif event == 'return':
-                # This event is also triggered if a function raises an exception,
-                # and in this case the return value is 'None'.  There doesn't seem
-                # to be a way to distinguish an exception from a None return,
-                # unfortunately.
-                _task_queue.put(KeyAndReturn(function_key, resolve_type(arg)))
+            return _DISABLE
+        return None
+    timed = _sampling_policy is not None or _stats is not None
+    if timed:
+        start = _timer()
+    info = _get_code_info(code, frame)
+    if info.function_key is None:
+        return _DISABLE
+    if timed:
+        resolving = _timer()
+    resolved_types = info.extract_args(frame.f_locals)
+    if timed:
+        resolved = _timer()
+    _emit_call(info.function_key, frame_id, resolved_types)
+    if info.generator_type is not None:
+        _emit_return(info.function_key, frame_id, info.generator_type)
     else:
-        sampling_counters[key] = None  # We're not interested in this function.
+        pending.add(frame_id)
+    if timed:
+        _record_overhead(info.function_key, start, resolving, resolved)
+    return None
+
+
+def _monitor_py_return(code, instruction_offset, retval):
+    # type: (Any, int, Any) -> Any
+    """Handle a PY_RETURN event."""
+    if not running and not (_context_scopes and _in_scope.get()):
+        return None
+    if _stats is not None:
+        _stats.record_event(code)
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    frame_id = id(frame)
+    pending = _thread_state.pending if _per_thread else call_pending
+    if frame_id not in pending:
+        if sampling_counters.get(id(code), 0) is None:
+            return _DISABLE
+        return None
+    pending.discard(frame_id)
+    timed = _sampling_policy is not None or _stats is not None
+    if timed:
+        start = _timer()
+    info = _get_code_info(code, frame)
+    if info.function_key is not None:
+        if timed:
+            resolving = _timer()
+        return_type = resolve_type(retval)
+        if timed:
+            resolved = _timer()
+        _emit_return(info.function_key, frame_id, return_type)
+        if timed:
+            _record_overhead(info.function_key, start, resolving, resolved)
+    return None
+
+
+def _monitor_py_unwind(code, instruction_offset, exception):
+    # type: (Any, int, BaseException) -> None
+    """Handle a PY_UNWIND event, i.e. a function exiting with an exception.
+
+    The return type of such a call is unknown, rather than None.  (PY_UNWIND
+    is not a local event, so we can't return DISABLE here.)
+    """
+    if not running and not (_context_scopes and _in_scope.get()):
+        return
+    if _stats is not None:
+        _stats.record_event(code)
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    frame_id = id(frame)
+    pending = _thread_state.pending if _per_thread else call_pending
+    if frame_id in pending:
+        pending.discard(frame_id)
+        info = _get_code_info(code, frame)
+        if info.function_key is not None:
+            _emit_return(info.function_key, frame_id, UNKNOWN_TYPE)
+
+
+def _start_monitoring():
+    # type: () -> None
+    """Register the sys.monitoring callbacks and enable their events."""
+    assert _monitoring is not None
+    events = _monitoring.events
+    if _monitoring.get_tool(MONITORING_TOOL_ID) != 'pyannotate':
+        _monitoring.use_tool_id(MONITORING_TOOL_ID, 'pyannotate')
+    callbacks = [(events.PY_START, _monitor_py_start),
+                 (events.PY_RETURN, _monitor_py_return),
+                 (events.PY_UNWIND, _monitor_py_unwind)]
+    # The callbacks count events themselves when collecting statistics: they
+    # find the frame of the function with sys._getframe(1), so they can't be
+    # wrapped.
+    for event, callback in callbacks:
+        _monitoring.register_callback(MONITORING_TOOL_ID, event, callback)
+    _update_monitoring_events()
+
+
+def _update_monitoring_events():
+    # type: () -> None
+    """Enable the sys.monitoring events, unless detached or only context scopes collect and none is active."""
+    if _monitoring is None or _monitoring.get_tool(MONITORING_TOOL_ID) != 'pyannotate':
+        return
+    events = _monitoring.events
+    if _detached or _scope == SCOPE_CONTEXT and not _context_scopes:
+        _monitoring.set_events(MONITORING_TOOL_ID, 0)
+    else:
+        _monitoring.set_events(MONITORING_TOOL_ID,
+                               events.PY_START | events.PY_RETURN | events.PY_UNWIND)
+
+
+def _stop_monitoring():
+    # type: () -> None
+    """Undo _start_monitoring(), if it was called."""
+    if _monitoring is None or _monitoring.get_tool(MONITORING_TOOL_ID) != 'pyannotate':
+        return
+    _monitoring.set_events(MONITORING_TOOL_ID, 0)
+    for event in (_monitoring.events.PY_START,
+                  _monitoring.events.PY_RETURN,
+                  _monitoring.events.PY_UNWIND):
+        _monitoring.register_callback(MONITORING_TOOL_ID, event, None)
+    _monitoring.free_tool_id(MONITORING_TOOL_ID)
 
 
 T = TypeVar('T')
 
 
+def _container_size(container):
+    # type: (Any) -> int
+    """Estimate the memory held by a dict or set of collector data, in bytes.
+
+    Type descriptors are shared by all signatures and are not included.
+    """
+    size = sys.getsizeof(container)
+    if isinstance(container, dict):
+        items = list(container.items())  # type: List[Any]
+    else:
+        items = [(item, None) for item in list(container)]
+    for key, value in items:
+        size += sys.getsizeof(key)
+        if isinstance(value, (set, dict)):
+            size += _container_size(value)
+        elif isinstance(value, FrozenTypes):
+            size += sys.getsizeof(value) + sys.getsizeof(value.types)
+        elif value is not None:
+            size += sys.getsizeof(value)
+        if isinstance(key, FrozenTypes):
+            size += sys.getsizeof(key.types)
+    return size
+
+
+def get_stats(top=10):
+    # type: (int) -> Dict[str, Any]
+    """
+    Return statistics about the overhead of type collection, as a JSON-compatible dict.
+
+    The event and timing counters are only kept if init_types_collection()
+    was called with collect_stats=True (otherwise they are zero).  The
+    'top_functions' entry lists the top functions by time spent in the hook.
+    """
+    stats = _stats or CollectorStats()
+    function_seconds = sorted(iteritems(stats.function_hook_seconds),
+                              key=lambda item: (-item[1], item[0]))
+    return {
+        'events_seen': stats.events_seen,
+        'events_sampled': stats.events_sampled,
+        'events_skipped_filter': stats.events_skipped_filter,
+        'events_skipped_saturated': stats.events_skipped_saturated,
+        'queue_high_water': stats.queue_high_water,
+        'hook_seconds': stats.hook_seconds,
+        'resolve_type_seconds': stats.resolve_type_seconds,
+        'memory_bytes': {
+            'collected_signatures': _container_size(collected_signatures),
+            'collected_args': _container_size(collected_args),
+            'sampling_counters': _container_size(sampling_counters),
+        },
+        'num_functions': len(collected_signatures),
+        'num_type_descriptors': len(_interned),
+        'evictions': dict(evictions),
+        'top_functions': [
+            {
+                'path': function_key.path,
+                'line': function_key.line,
+                'func_name': function_key.func_name,
+                'hook_seconds': seconds,
+                'samples': num_samples.get(function_key, 0),
+            }
+            for function_key, seconds in function_seconds[:top]
+        ],
+    }
+
+
+def _write_atomically(filename, data):
+    # type: (str, str) -> None
+    """Write a file through a temporary file, so readers never see a partial file.
+
+    The file is compressed according to its suffix, like with dump_stats().
+    """
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with formats.open_output(tmp_filename, filename) as f:
+        f.write(data.encode('utf-8'))
+    getattr(os, 'replace', os.rename)(tmp_filename, filename)
+
+
+def _openmetrics_label(value):
+    # type: (Any) -> str
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_openmetrics(top=10):
+    # type: (int) -> str
+    """Return the statistics from get_stats() in the OpenMetrics text format."""
+    stats = get_stats(top)
+    lines = []  # type: List[str]
+
+    def family(name, metric_type, help_text, samples):
+        # type: (str, str, str, List[Tuple[str, Dict[str, Any], Any]]) -> None
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines.append('# HELP %s %s' % (name, help_text))
+        for suffix, labels, value in samples:
+            label_text = ','.join('%s=%s' % (label, _openmetrics_label(labels[label]))
+                                  for label in sorted(labels))
+            if label_text:
+                label_text = '{%s}' % label_text
+            lines.append('%s%s%s %r' % (name, suffix, label_text, value))
+
+    family('pyannotate_events', 'counter', 'Events seen by the type collection hooks.',
+           [('_total', {'outcome': outcome}, stats['events_' + outcome])
+            for outcome in ('seen', 'sampled', 'skipped_filter', 'skipped_saturated')])
+    family('pyannotate_queue_high_water', 'gauge',
+           'Largest number of events pending processing.',
+           [('', {}, stats['queue_high_water'])])
+    family('pyannotate_hook_seconds', 'counter', 'Time spent in the hooks on sampled events.',
+           [('_total', {}, stats['hook_seconds'])])
+    family('pyannotate_resolve_type_seconds', 'counter', 'Time spent resolving types.',
+           [('_total', {}, stats['resolve_type_seconds'])])
+    family('pyannotate_memory_bytes', 'gauge', 'Estimated memory held by collected data.',
+           [('', {'structure': structure}, size)
+            for structure, size in sorted(iteritems(stats['memory_bytes']))])
+    family('pyannotate_functions', 'gauge', 'Number of functions with collected types.',
+           [('', {}, stats['num_functions'])])
+    family('pyannotate_evictions', 'counter',
+           'Functions evicted from memory (and how many of them were spilled to disk).',
+           [('_total', {'kind': kind}, count)
+            for kind, count in sorted(iteritems(stats['evictions']))])
+    family('pyannotate_function_hook_seconds', 'counter',
+           'Time spent in the hooks on sampled events, for the top functions.',
+           [('_total', {'path': item['path'], 'line': item['line'],
+                        'func_name': item['func_name']}, item['hook_seconds'])
+            for item in stats['top_functions']])
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def write_openmetrics(filename, top=10):
+    # type: (str, int) -> None
+    """
+    Write statistics about the collector to a file in the OpenMetrics text format.
+
+    The file is replaced atomically, so it can be rewritten while scrapers read it.
+    """
+    _write_atomically(filename, format_openmetrics(top))
+
+
 def _filter_types(types_dict):
     # type: (Dict[FunctionKey, T]) -> Dict[FunctionKey, T]
     """Filter type info before dumping it to the file."""
@@ -790,52 +2508,266 @@ def _filter_types(types_dict):
     return {k: v for k, v in iteritems(types_dict) if not exclude(k)}
 
 
+def _iter_dump():
+    # type: () -> Iterator[FunctionData]
+    """Generate the collected information for each function, sorted by location.
+
+    Only the signatures are copied up front; the JSON objects are built
+    as they are consumed.
+    """
+    if not running and not _context_scopes:
+        # Collection is paused, but maybe without waiting for the consumer.
+        _drain_queue()
+    _flush_buffers()
+    with _spill_lock:
+        with _data_lock:
+            functions = {
+                function_key: (list(signatures), num_samples.get(function_key, 0))
+                for function_key, signatures in iteritems(collected_signatures)
+            }
+            spill_filename, spilled_size = _spilled_size()
+        spilled = _read_spilled(spill_filename, spilled_size)
+    keys = (set(_filter_types(functions)) | set(_filter_types(spilled)) |
+            set(_filter_types(_seeded)))
+    for function_key in sorted(keys, key=lambda k: (k.path, k.line, k.func_name)):
+        item = None  # type: Optional[FunctionData]
+        if function_key in functions:
+            signatures, samples = functions.pop(function_key)
+            item = _function_data(function_key, signatures, samples)
+        for other in spilled.get(function_key), _seeded.get(function_key):
+            if other is None:
+                continue
+            if item is None:
+                item = dict(other, type_comments=list(other['type_comments']))  # type: ignore
+            else:
+                _merge_function_data(item, other)
+        yield item  # type: ignore
+
+
 def _dump_impl():
     # type: () -> List[FunctionData]
     """Internal implementation for dump_stats and dumps_stats"""
-    filtered_signatures = _filter_types(collected_signatures)
-    sorted_by_file = sorted(iteritems(filtered_signatures),
-                            key=(lambda p: (p[0].path, p[0].line, p[0].func_name)))
-    res = []  # type: List[FunctionData]
-    for function_key, signatures in sorted_by_file:
-        comments = [_make_type_comment(args, ret_type) for args, ret_type in signatures]
-        res.append(
-            {
-                'path': function_key.path,
-                'line': function_key.line,
-                'func_name': function_key.func_name,
-                'type_comments': comments,
-                'samples': num_samples.get(function_key, 0),
-            }
-        )
+    return list(_iter_dump())
+
+
+# Output formats of dump_stats().
+FORMAT_JSON = 'json'
+FORMAT_JSONL = 'jsonl'
+FORMAT_BINARY = 'binary'
+FORMAT_SQLITE = 'sqlite'
+
+
+def load_stats(filename):
+    # type: (str) -> List[FunctionData]
+    """
+    Read a file written by dump_stats(), in any format.
+
+    Statistics included in the file are ignored.
+    """
+    return formats.load_entries(filename)
+
+
+def _dump_data(include_stats):
+    # type: (bool) -> Any
+    """The data to dump: a list of FunctionData, or an object also holding statistics."""
+    res = _dump_impl()
+    if include_stats:
+        return {'type_info': res, 'collector_stats': get_stats()}
     return res
 
 
-def dump_stats(filename):
-    # type: (str) -> None
+def dump_stats(filename, include_stats=False, format=FORMAT_JSON):
+    # type: (str, bool, str) -> None
     """
     Write collected information to file.
 
     Args:
         filename: absolute filename
+        include_stats: if true, also write the result of get_stats(); for
+            JSON, write an object with the list of functions under
+            'type_info' and the statistics under 'collector_stats' instead
+            of just the list; for JSON Lines, add a last line holding an
+            object with just 'collector_stats'
+        format: FORMAT_JSON (a JSON list), FORMAT_JSONL (JSON Lines, one
+            function per line), FORMAT_BINARY (a compact binary format)
+            or FORMAT_SQLITE (an SQLite store); the latter three are
+            written as they are generated
+
+    If the filename ends with .gz or .xz, the output is compressed with
+    gzip or lzma (as it is written).
+
+    An SQLite store is not overwritten: the data is merged into it (type
+    comments are united and samples added), so that several processes
+    can dump into the same store.  It can't be compressed.
     """
-    res = _dump_impl()
-    f = open(filename, 'w')
-    json.dump(res, f, indent=4)
-    f.close()
+    # pylint: disable=redefined-builtin
+    if format not in (FORMAT_JSON, FORMAT_JSONL, FORMAT_BINARY, FORMAT_SQLITE):
+        raise ValueError('Unknown format: %r' % (format,))
+    if format in (FORMAT_BINARY, FORMAT_SQLITE) and include_stats:
+        raise ValueError('The %s format cannot include statistics' % format)
+    if format == FORMAT_SQLITE:
+        if filename.endswith(('.gz', '.xz')):
+            raise ValueError('An SQLite store cannot be compressed: %s' % filename)
+        store.write_store(filename, _iter_dump(), MAX_ITEMS_PER_FUNCTION)
+        return
+    with formats.open_output(filename) as f:
+        if format == FORMAT_BINARY:
+            formats.write_binary(f, _iter_dump())
+            return
+        # The JSON module writes ASCII (unicode or str on Python 2).
+        writer = codecs.getwriter('utf-8')(f)
+        if format == FORMAT_JSON:
+            json.dump(_dump_data(include_stats), writer, indent=4)
+        else:
+            for item in _iter_dump():
+                writer.write(json.dumps(item) + '\n')
+            if include_stats:
+                writer.write(json.dumps({'collector_stats': get_stats()}) + '\n')
 
 
-def dumps_stats():
-    # type: () -> str
+def dumps_stats(include_stats=False):
+    # type: (bool) -> str
     """
     Return collected information as a json string.
     """
-    res = _dump_impl()
+    res = _dump_data(include_stats)
     return json.dumps(res, indent=4)
 
 
-def init_types_collection(filter_filename=default_filter_filename):
-    # type: (Callable[[Optional[str]], Optional[str]]) -> None
+# The snapshot thread, the event telling it to stop, and for delta snapshots
+# the number of signatures and samples of each function in the last snapshot
+# that included it.
+_snapshot_thread = None  # type: Optional[Thread]
+_snapshot_stop = threading.Event()
+_snapshot_written = {}  # type: Dict[FunctionKey, Tuple[int, int]]
+_snapshot_sequence = itertools.count()
+
+
+def _delta(written):
+    # type: (Dict[FunctionKey, Tuple[int, int]]) -> Tuple[List[FunctionData], Dict[FunctionKey, Tuple[int, int]]]
+    """Return the data of the functions whose signatures changed since they were last written.
+
+    The written dict holds the number of signatures and samples of each
+    function when it was last written.  Each item has all signatures of
+    the function, but only the samples collected since then.  Also return
+    the entries to update written with once the data has been written.
+    """
+    _flush_buffers()
+    res = []  # type: List[FunctionData]
+    marks = {}  # type: Dict[FunctionKey, Tuple[int, int]]
+    with _data_lock:
+        for function_key, signatures in iteritems(_filter_types(collected_signatures)):
+            samples = num_samples.get(function_key, 0)
+            num_written, samples_written = written.get(function_key, (0, 0))
+            if len(signatures) == num_written:
+                continue
+            if samples < samples_written:
+                samples_written = 0  # The function was evicted since.
+            res.append(_function_data(function_key, signatures, samples - samples_written))
+            marks[function_key] = (len(signatures), samples)
+    res.sort(key=lambda item: (item['path'], item['line'], item['func_name']))
+    return res, marks
+
+
+def _snapshot_delta():
+    # type: () -> List[FunctionData]
+    """Return the data of the functions whose signatures changed since the last snapshot."""
+    res, marks = _delta(_snapshot_written)
+    _snapshot_written.update(marks)
+    return res
+
+
+def _write_snapshot(filename, delta):
+    # type: (str, bool) -> None
+    """Write a snapshot: the full data to filename, or a delta to a new file filename.N."""
+    if delta:
+        res = _snapshot_delta()
+        if not res:
+            return
+        filename = '%s.%d' % (filename, next(_snapshot_sequence))
+    else:
+        res = _dump_impl()
+    _write_atomically(filename, json.dumps(res))
+
+
+def _snapshot_loop(filename, interval, delta, stop):
+    # type: (str, float, bool, threading.Event) -> None
+    """Main loop of the snapshot thread."""
+    while not stop.wait(interval):
+        _write_snapshot(filename, delta)
+    _write_snapshot(filename, delta)
+
+
+def _next_snapshot_number(filename):
+    # type: (str) -> int
+    """Return the number following those of the existing delta snapshots filename.N."""
+    directory, prefix = os.path.split(os.path.abspath(filename))
+    prefix += '.'
+    if not os.path.isdir(directory):
+        return 0
+    numbers = [int(name[len(prefix):]) for name in os.listdir(directory)
+               if name.startswith(prefix) and name[len(prefix):].isdigit()]
+    return max(numbers) + 1 if numbers else 0
+
+
+def start_snapshots(filename, interval=60.0, delta=False):
+    # type: (str, float, bool) -> None
+    """
+    Write snapshots of the collected information every interval seconds.
+
+    Snapshots are written by a background thread while collection continues,
+    in the format of dump_stats().  Files are replaced atomically, so a crashed
+    or killed process leaves the previous snapshot intact.
+
+    By default each snapshot contains all collected information and replaces
+    filename.  With delta=True each snapshot only contains the functions whose
+    signatures changed since the previous one (with the samples collected in
+    between), and is written to a new file named filename.0, filename.1, etc.
+    Numbering continues after the existing files, if any, so that the
+    snapshots of earlier runs are kept.  Functions evicted to a spill file (see set_memory_budget()) may be left
+    out of delta snapshots.
+    """
+    global _snapshot_thread, _snapshot_stop, _snapshot_sequence
+    if interval <= 0:
+        raise ValueError('interval must be positive: %r' % (interval,))
+    stop_snapshots()
+    _snapshot_stop = threading.Event()
+    if delta:
+        _snapshot_written.clear()
+        _snapshot_sequence = itertools.count(_next_snapshot_number(filename))
+    _snapshot_thread = Thread(target=_snapshot_loop,
+                              args=(filename, interval, delta, _snapshot_stop))
+    _snapshot_thread.daemon = True
+    _snapshot_thread.start()
+
+
+def stop_snapshots():
+    # type: () -> None
+    """Stop writing snapshots, after writing a final one."""
+    global _snapshot_thread
+    if _snapshot_thread is not None:
+        _snapshot_stop.set()
+        _snapshot_thread.join()
+        _snapshot_thread = None
+
+
+# Backends accepted by init_types_collection().
+BACKEND_SETPROFILE = 'setprofile'
+BACKEND_MONITORING = 'monitoring'
+BACKEND_TARGETED = 'targeted'
+
+# The thread buffer size used in per-thread mode, unless given.
+DEFAULT_FLUSH_SIZE = 256
+
+# sys._is_gil_enabled() exists on Python 3.13 and later.
+_is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)
+
+
+def init_types_collection(filter_filename=default_filter_filename, backend=BACKEND_SETPROFILE,
+                          flush_size=None, sampling_policy=None, collect_stats=False,
+                          per_thread=None, scope=SCOPE_PROCESS, seed=None, stable_samples=None,
+                          detach_when_saturated=False):
+    # type: (Callable[[Optional[str]], Optional[str]], str, Optional[int], Optional[SamplingPolicy], bool, Optional[bool], str, Optional[str], Optional[int], bool) -> None
     """
     Setup profiler hooks to enable type collection.
     Call this one time from the main thread.
@@ -843,11 +2775,116 @@ def init_types_collection(filter_filename=default_filter_filename):
     The optional argument is a filter that maps a filename (from
     code.co_filename) to either a normalized filename or None.
     For the default filter see default_filter_filename().
+
+    The backend is either BACKEND_SETPROFILE (a sys.setprofile() hook in
+    every thread) or, on Python 3.12 and later, BACKEND_MONITORING, which
+    uses sys.monitoring so that functions we are no longer interested in
+    cost nothing, and which records calls that raise as returning an
+    unknown type instead of None.  BACKEND_TARGETED installs no hook at
+    all: only functions wrapped with trace() or trace_functions() are
+    collected, and the rest of the program runs at full speed.
+
+    By default sampled events are passed to a consumer thread through a
+    queue.  If flush_size is given, each thread instead buffers up to that
+    many events and processes them itself, which avoids contention on the
+    queue when many threads are busy.  Buffers are also processed by
+    pause() and before dumping.
+
+    The sampling_policy (a SamplingPolicy instance) decides which calls
+    of each function are sampled; see e.g. ExponentialBackoffPolicy,
+    ProbabilisticPolicy, ModuleRatePolicy and OverheadBudgetPolicy.
+
+    If collect_stats is true, the collector also counts events and measures
+    its own overhead; see get_stats() and write_openmetrics().
+
+    If per_thread is true, each thread counts calls and tracks pending calls
+    in its own state, folding its counts together with those of the other
+    threads now and then, and buffers events as if flush_size were given
+    (DEFAULT_FLUSH_SIZE unless it is).  Threads then don't contend for the
+    collector's state when running in parallel, at the cost of the sampling
+    policy seeing approximate call numbers.  The default is to do this when
+    running on a free-threaded Python build with the GIL disabled.
+
+    The scope is the default for collect().  With SCOPE_CONTEXT, types are
+    only collected in context scopes, and the hooks are only enabled while
+    there are any: the setprofile backend installs its hook only in threads
+    that are inside a context scope, and the monitoring backend disables its
+    events when no context scope is active.  A context scope is active until
+    the asyncio tasks created in it are done.
+
+    If seed is the name of a file written by dump_stats() in an earlier
+    run, collection starts from its data: it is merged into what is
+    dumped, and functions that already have MAX_ITEMS_PER_FUNCTION type
+    comments in it are not sampled at all.
+
+    If stable_samples is given, a function is saturated once that many
+    samples in a row added no new signature, or once it has
+    MAX_ITEMS_PER_FUNCTION signatures, and it is no longer sampled
+    whatever the sampling policy says.  Saturation lasts until the next
+    init_types_collection(), across pause() and resume().  If
+    detach_when_saturated is also true, the hooks are removed as soon as
+    all functions seen so far are saturated, so that the program then runs
+    at full speed; functions first called after that are not collected.
+    The next resume() reinstalls them (the profiler hook in the calling
+    thread and in threads started later), but saturated functions are
+    still not sampled.
     """
-    global _filter_filename
+    global _filter_filename, _flush_size, _emit_call, _emit_return, _sampling_policy, _stats
+    global _per_thread, _targeted, _scope, _profile_hook, _seeded
+    global _stable_samples, _detach_when_saturated, _detached
+    if backend not in (BACKEND_SETPROFILE, BACKEND_MONITORING, BACKEND_TARGETED):
+        raise ValueError('Unknown backend: %r' % (backend,))
+    if backend == BACKEND_MONITORING and _monitoring is None:
+        raise ValueError('The %r backend requires Python 3.12 or later' % (backend,))
+    if flush_size is not None and flush_size < 1:
+        raise ValueError('flush_size must be positive: %r' % (flush_size,))
+    _check_scope(scope)
+    if stable_samples is not None and stable_samples < 1:
+        raise ValueError('stable_samples must be positive: %r' % (stable_samples,))
+    if detach_when_saturated and stable_samples is None:
+        raise ValueError('detach_when_saturated requires stable_samples')
+    seeded = {}  # type: Dict[FunctionKey, FunctionData]
+    if seed is not None:
+        for item in load_stats(seed):
+            key = FunctionKey(item['path'], item['line'], item['func_name'])
+            if key in seeded:
+                _merge_function_data(seeded[key], item)
+            else:
+                seeded[key] = item
+    if per_thread is None:
+        per_thread = not _is_gil_enabled()
+    if per_thread and flush_size is None:
+        flush_size = DEFAULT_FLUSH_SIZE
     _filter_filename = filter_filename
-    sys.setprofile(_trace_dispatch)
-    threading.setprofile(_trace_dispatch)
+    _per_thread = per_thread
+    _code_info.clear()  # Cached function keys depend on the filter and the seed.
+    _clear_type_caches()
+    _seeded = seeded
+    _stable_samples = stable_samples
+    _detach_when_saturated = detach_when_saturated
+    _detached = False
+    with _saturation_lock:
+        _stable_counts.clear()
+        _saturated.clear()
+        _unsaturated.clear()
+        _function_codes.clear()
+    _sampling_policy = sampling_policy
+    _stats = CollectorStats() if collect_stats else None
+    _flush_size = flush_size
+    if flush_size is None:
+        _emit_call, _emit_return = _queue_call, _queue_return
+    else:
+        _emit_call, _emit_return = _buffer_call, _buffer_return
+    _targeted = backend == BACKEND_TARGETED
+    _scope = scope
+    _profile_hook = None
+    if backend == BACKEND_MONITORING:
+        _start_monitoring()
+    elif backend == BACKEND_SETPROFILE:
+        _profile_hook = _counting_trace_dispatch if collect_stats else _trace_dispatch
+        if scope == SCOPE_PROCESS:
+            sys.setprofile(_profile_hook)
+            threading.setprofile(_profile_hook)
 
 
 def stop_types_collection():
@@ -855,5 +2892,334 @@ def stop_types_collection():
     """
     Remove profiler hooks.
     """
+    global _targeted, _profile_hook  # pylint: disable=global-statement
     sys.setprofile(None)
     threading.setprofile(None)  # type: ignore
+    _stop_monitoring()
+    _targeted = False
+    _profile_hook = None
+
+
+# Targeted collection: instead of hooking every call in the process, wrap the
+# functions we are interested in.  The wrappers feed the same sampling and
+# aggregation as the hooks, but only with the BACKEND_TARGETED backend (so
+# that calls aren't recorded twice when a hook is installed too).
+_targeted = False
+
+# The attributes replaced by trace_functions(), with their original values.
+_traced_attributes = []  # type: List[Tuple[Any, str, Any]]
+
+
+def trace(func):
+    # type: (Callable[..., T]) -> Callable[..., T]
+    """Decorator collecting the types of calls of a function with the targeted backend.
+
+    A traced function is collected even if the filename filter isn't
+    interested in its file.  The return type of a coroutine function is
+    unknown, since the wrapper only sees the coroutine object.
+    """
+    if getattr(func, '_pyannotate_traced', False):
+        return func
+    code = func.__code__  # type: ignore
+    key = id(code)
+
+    @functools.wraps(func)
+    def traced(*args, **kwargs):
+        # type: (*Any, **Any) -> Any
+        if not _targeted or not (running or _context_scopes and _in_scope.get()):
+            return func(*args, **kwargs)
+        if _stats is not None:
+            _stats.record_event(code)
+        n = sampling_counters.get(key, 0)
+        if n is None:
+            return func(*args, **kwargs)
+        if _per_thread:
+            sample = _count_call_per_thread(key, n, code)
+        else:
+            sampling_counters[key] = n + 1
+            sample = _should_sample(n, code)
+        if not sample:
+            if sample is None:
+                sampling_counters[key] = None  # We're no longer interested in this function.
+            return func(*args, **kwargs)
+        return _call_traced(func, code, args, kwargs)
+
+    traced._pyannotate_traced = True  # type: ignore
+    traced.__wrapped__ = func  # type: ignore  # functools.wraps() doesn't set it on Python 2
+    return traced
+
+
+def _call_traced(func, code, args, kwargs):
+    # type: (Callable[..., Any], Any, Tuple[Any, ...], Dict[str, Any]) -> Any
+    """Make a sampled call of a traced function, and record its types."""
+    timed = _sampling_policy is not None or _stats is not None
+    if timed:
+        start = _timer()
+    try:
+        call_args = inspect.getcallargs(func, *args, **kwargs)
+    except TypeError:
+        # Let the call itself report the bad arguments.
+        return func(*args, **kwargs)
+    info = _code_info.get(id(code))
+    if info is None or info.ref() is not code:
+        filename = _filter_filename(code.co_filename) or code.co_filename
+        info = _make_code_info(code, filename, lambda: _function_name(code, lambda: call_args))
+    function_key = info.function_key
+    if function_key is None:
+        sampling_counters[id(code)] = None  # A lambda, for instance.
+        return func(*args, **kwargs)
+    # The arguments stay alive during the call, so their ID identifies it.
+    call_id = id(call_args)
+    if timed:
+        resolving = _timer()
+    resolved_types = info.extract_args(call_args)
+    if timed:
+        resolved = _timer()
+    _emit_call(function_key, call_id, resolved_types)
+    if timed:
+        _record_overhead(function_key, start, resolving, resolved)
+    if info.generator_type is not None:
+        _emit_return(function_key, call_id, info.generator_type)
+        return func(*args, **kwargs)
+    try:
+        result = func(*args, **kwargs)
+    except BaseException:
+        _emit_return(function_key, call_id, UNKNOWN_TYPE)
+        raise
+    if timed:
+        start = resolving = _timer()
+    if code.co_flags & CO_COROUTINE:
+        return_type = UNKNOWN_TYPE
+    else:
+        return_type = resolve_type(result)
+    if timed:
+        resolved = _timer()
+    _emit_return(function_key, call_id, return_type)
+    if timed:
+        _record_overhead(function_key, start, resolving, resolved)
+    return result
+
+
+def _find_object(name):
+    # type: (str) -> Tuple[Any, Any]
+    """Import the object with a dotted name, and return it with the object it's an attribute of."""
+    parts = name.split('.')
+    for i in range(len(parts), 0, -1):
+        try:
+            obj = importlib.import_module('.'.join(parts[:i]))
+        except ImportError:
+            continue
+        owner = None
+        for part in parts[i:]:
+            owner = obj
+            obj = getattr(obj, part, None)
+            if obj is None:
+                break
+        else:
+            return owner, obj
+        break
+    raise ValueError('Cannot find %r' % (name,))
+
+
+def _trace_attribute(owner, name):
+    # type: (Any, str) -> None
+    """Replace a function (or static or class method) attribute with a traced one."""
+    value = vars(owner).get(name)
+    func = value.__func__ if isinstance(value, (staticmethod, classmethod)) else value
+    if not inspect.isfunction(func) or getattr(func, '_pyannotate_traced', False):
+        return
+    if func is value:
+        traced = trace(func)  # type: Any
+    else:
+        traced = type(value)(trace(func))
+    _traced_attributes.append((owner, name, value))
+    setattr(owner, name, traced)
+
+
+def _trace_class(cls):
+    # type: (type) -> None
+    for name, value in list(vars(cls).items()):
+        if isinstance(value, (staticmethod, classmethod)) or inspect.isfunction(value):
+            _trace_attribute(cls, name)
+
+
+def trace_functions(names):
+    # type: (Iterable[str]) -> None
+    """Trace functions, methods, classes and modules given by dotted names.
+
+    For a class all its methods are traced, and for a module all the
+    functions and classes defined in it.  Functions are replaced by traced
+    ones (see trace()) where they are defined, so references to them taken
+    earlier (e.g. with 'from module import function') are not traced.
+    Raise ValueError if a name can't be found.
+    """
+    for name in names:
+        owner, obj = _find_object(name)
+        if inspect.ismodule(obj):
+            for attr, value in list(vars(obj).items()):
+                if getattr(value, '__module__', None) != obj.__name__:
+                    continue
+                if inspect.isclass(value):
+                    _trace_class(value)
+                elif inspect.isfunction(value):
+                    _trace_attribute(obj, attr)
+        elif inspect.isclass(obj):
+            _trace_class(obj)
+        elif owner is not None and name.rsplit('.', 1)[-1] in vars(owner):
+            _trace_attribute(owner, name.rsplit('.', 1)[-1])
+        else:
+            raise ValueError('Cannot trace %r' % (name,))
+
+
+def untrace_functions():
+    # type: () -> None
+    """Undo trace_functions()."""
+    while _traced_attributes:
+        owner, name, value = _traced_attributes.pop()
+        setattr(owner, name, value)
+
+
+def _reinit_after_fork():
+    # type: () -> None
+    """
+    Reset the collector in a child process created by os.fork().
+
+    Only the forking thread survives a fork: the consumer and snapshot
+    threads are gone, locks may have been held by other threads, and the
+    data collected so far belongs to the parent (which dumps it itself).
+    Collection continues in the child if it was running in the parent.
+    """
+    global _task_queue, _buffers_lock, _data_lock, _snapshot_thread, _stats, _memory_budget
+    global _fold_lock, _thread_states_lock, _intern_lock, _scopes_lock, _context_scopes
+    global _saturation_lock, _spill_lock
+    _task_queue = Queue()
+    _buffers_lock = threading.Lock()
+    _data_lock = threading.Lock()
+    _fold_lock = threading.Lock()
+    _thread_states_lock = threading.Lock()
+    _intern_lock = threading.Lock()
+    _scopes_lock = threading.RLock()
+    _spill_lock = threading.Lock()
+    _saturation_lock = threading.RLock()
+    current_thread = threading.current_thread()
+    # Only the context scopes of the forking thread are still active.
+    for ref, thread in list(_scope_markers.items()):
+        if thread is not current_thread:
+            del _scope_markers[ref]
+    _context_scopes = len(_scope_markers)
+    _buffers[:] = [(thread, items) for thread, items in _buffers if thread is current_thread]
+    for _, items in _buffers:
+        del items[:]
+    _thread_states[:] = [(thread, counts) for thread, counts in _thread_states
+                         if thread is current_thread]
+    for _, counts in _thread_states:
+        counts.clear()
+    for data in (collected_args, collected_signatures, num_samples, sampling_counters,
+                 _sampled_upto, _recently_updated, _snapshot_written, _stable_counts):
+        data.clear()
+    # The child has no signatures yet, so no function is saturated.
+    _unsaturated.update(_saturated)
+    _saturated.clear()
+    _clear_type_caches()
+    call_pending.clear()
+    _thread_state.pending.clear()
+    for kind in evictions:
+        evictions[kind] = 0
+    if _stats is not None:
+        _stats = CollectorStats()
+    if _memory_budget is not None and _memory_budget.spill_filename:
+        # Spill to a file of our own.
+        spill_filename = '%s.%d' % (_memory_budget.spill_filename, os.getpid())
+        open(spill_filename, 'w').close()
+        _memory_budget = _memory_budget._replace(spill_filename=spill_filename)
+    _snapshot_thread = None
+    _start_consumer_thread()
+    if _monitoring is not None and _monitoring.get_tool(MONITORING_TOOL_ID) == 'pyannotate':
+        _monitoring.restart_events()
+        _update_monitoring_events()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+# If this environment variable is set when this module is imported, type
+# collection starts right away, and the process dumps its data at exit to a
+# shard file named by the variable's value (see dump_shards_at_exit()).
+SHARD_ENV_VAR = 'PYANNOTATE_SHARD_FILENAME'
+
+# The pattern for shard file names, and the process that dumped its shard.
+_shard_pattern = None  # type: Optional[str]
+_shard_dumped_pid = None  # type: Optional[int]
+
+
+def _dump_shard():
+    # type: () -> None
+    """Dump the collected information to this process's shard file, once."""
+    global _shard_dumped_pid
+    pid = os.getpid()
+    if _shard_pattern is None or _shard_dumped_pid == pid:
+        return
+    _shard_dumped_pid = pid
+    pause()
+    dump_stats(_shard_pattern % {'pid': pid})
+
+
+def _register_shard_finalizer(dump):
+    # type: (Callable[[], None]) -> None
+    """Dump the shard when a multiprocessing child exits (it doesn't run atexit handlers)."""
+    from multiprocessing import util
+    util.Finalize(None, dump, exitpriority=10)
+
+
+def dump_shards_at_exit(filename_pattern):
+    # type: (str) -> None
+    """
+    Dump the collected information at exit, to a file per process.
+
+    The filename_pattern must contain '%(pid)d', which is replaced with the
+    process ID, e.g. 'type_info.%(pid)d.json'.  This also applies to child
+    processes forked later, including multiprocessing workers (which start
+    with no collected information of their own).  Use the 'pyannotate
+    merge' command to combine the shards.
+    """
+    global _shard_pattern
+    try:
+        filename_pattern % {'pid': 0}
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Invalid shard file name pattern: %r' % (filename_pattern,))
+    if filename_pattern == filename_pattern % {'pid': 0}:
+        raise ValueError('Shard file name pattern must contain %%(pid)d: %r' %
+                         (filename_pattern,))
+    if _shard_pattern is None:
+        atexit.register(_dump_shard)
+        from multiprocessing import util
+        util.register_after_fork(_dump_shard, _register_shard_finalizer)
+    _shard_pattern = filename_pattern
+
+
+def enable_child_collection(filename_pattern):
+    # type: (str) -> None
+    """
+    Collect types in child processes, each dumping to its own shard at exit.
+
+    Forked children continue collecting as the parent does.  Children
+    started some other way (e.g. with the multiprocessing 'spawn' method)
+    inherit the SHARD_ENV_VAR environment variable, and start collecting
+    with the default settings when they import this module (which happens
+    if the main module imports it).  This process dumps its own shard too.
+    """
+    dump_shards_at_exit(filename_pattern)
+    os.environ[SHARD_ENV_VAR] = filename_pattern
+
+
+def _bootstrap_from_environment():
+    # type: () -> None
+    filename_pattern = os.environ.get(SHARD_ENV_VAR)
+    if filename_pattern:
+        init_types_collection()
+        dump_shards_at_exit(filename_pattern)
+        resume()
+
+
+_bootstrap_from_environment()
@@ -0,0 +1,184 @@
+"""
+Instrument selected modules for type collection when they are imported.
+
+This is an alternative to the profiler hook: a meta path finder rewrites
+the modules whose names match the include patterns so that their functions
+and methods are wrapped with collect_types.trace().  Other modules are left
+alone and pay nothing, and there is no filtering at call time.  Collect with
+the targeted backend:
+
+    from pyannotate_runtime import collect_types, import_hook
+    import_hook.install_import_hook(['mypkg', 'mypkg.*'])
+    collect_types.init_types_collection(backend=collect_types.BACKEND_TARGETED)
+    with collect_types.collect():
+        import mypkg.main
+        mypkg.main.run()
+    collect_types.dump_stats('type_info.json')
+
+Only module-level functions and methods of module-level classes are
+instrumented, except for generator functions and coroutines (wrapping them
+would hide what they are from e.g. inspect.isgeneratorfunction()).
+Modules imported before the hook is installed are not instrumented.
+Requires Python 3.
+"""
+
+from __future__ import absolute_import
+
+import ast
+import fnmatch
+import importlib.abc
+import importlib.machinery
+import sys
+
+from typing import Any, List, Optional, Sequence
+
+# The name under which instrumented modules import collect_types.trace().
+TRACE_NAME = '_pyannotate_trace'
+
+
+class _Instrumenter(ast.NodeTransformer):
+    """Add the trace decorator to functions and methods, innermost."""
+
+    def __init__(self):
+        # type: () -> None
+        self.count = 0
+
+    def visit_FunctionDef(self, node):
+        # type: (ast.FunctionDef) -> ast.FunctionDef
+        if not _is_generator(node):
+            decorator = ast.copy_location(ast.Name(id=TRACE_NAME, ctx=ast.Load()), node)
+            node.decorator_list.append(decorator)
+            self.count += 1
+        # Nested functions are not instrumented.
+        return node
+
+    def visit_AsyncFunctionDef(self, node):
+        # type: (Any) -> Any
+        return node
+
+    def visit_Lambda(self, node):
+        # type: (ast.Lambda) -> ast.Lambda
+        return node
+
+
+class _YieldFinder(ast.NodeVisitor):
+
+    def __init__(self):
+        # type: () -> None
+        self.found = False
+
+    def visit_Yield(self, node):
+        # type: (Any) -> None
+        self.found = True
+
+    visit_YieldFrom = visit_Yield
+
+    def visit_FunctionDef(self, node):
+        # type: (Any) -> None
+        pass  # A yield in a nested function doesn't count.
+
+    visit_AsyncFunctionDef = visit_ClassDef = visit_Lambda = visit_FunctionDef
+
+
+def _is_generator(node):
+    # type: (ast.FunctionDef) -> bool
+    finder = _YieldFinder()
+    for statement in node.body:
+        finder.visit(statement)
+    return finder.found
+
+
+def instrument(tree):
+    # type: (ast.Module) -> int
+    """Instrument a module's AST in place, and return the number of functions instrumented."""
+    instrumenter = _Instrumenter()
+    instrumenter.visit(tree)
+    if instrumenter.count:
+        # Import trace() after the docstring and any __future__ imports.
+        body = tree.body
+        index = 1 if ast.get_docstring(tree, clean=False) is not None else 0
+        while (index < len(body) and isinstance(body[index], ast.ImportFrom) and
+               body[index].module == '__future__'):
+            index += 1
+        node = ast.ImportFrom(module='pyannotate_runtime.collect_types',
+                              names=[ast.alias(name='trace', asname=TRACE_NAME)], level=0)
+        body.insert(index, ast.copy_location(node, body[index] if index < len(body) else tree))
+        ast.fix_missing_locations(tree)
+    return instrumenter.count
+
+
+class InstrumentingLoader(importlib.machinery.SourceFileLoader):
+    """Load a module from source, instrumenting it.
+
+    Bytecode is neither read from nor written to the cache, which holds the
+    uninstrumented code.
+    """
+
+    def get_code(self, fullname):
+        # type: (str) -> Any
+        path = self.get_filename(fullname)
+        source = self.get_data(path)
+        tree = ast.parse(source, path)
+        instrument(tree)
+        return compile(tree, path, 'exec', dont_inherit=True)
+
+
+class InstrumentingFinder(importlib.abc.MetaPathFinder):
+    """Find modules matching the include patterns and have them instrumented."""
+
+    def __init__(self, include, exclude=()):
+        # type: (Sequence[str], Sequence[str]) -> None
+        self.include = list(include)
+        self.exclude = list(exclude)
+
+    def matches(self, fullname):
+        # type: (str) -> bool
+        return (any(fnmatch.fnmatchcase(fullname, pattern) for pattern in self.include) and
+                not any(fnmatch.fnmatchcase(fullname, pattern) for pattern in self.exclude))
+
+    def find_spec(self, fullname, path, target=None):
+        # type: (str, Optional[Sequence[str]], Any) -> Any
+        if not self.matches(fullname):
+            return None
+        for finder in sys.meta_path:
+            if finder is self or isinstance(finder, InstrumentingFinder):
+                continue
+            find_spec = getattr(finder, 'find_spec', None)
+            if find_spec is None:
+                continue
+            spec = find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if type(spec.loader) is not importlib.machinery.SourceFileLoader:
+            return spec  # E.g. an extension module.
+        spec.loader = InstrumentingLoader(spec.loader.name, spec.loader.path)
+        return spec
+
+
+# The installed finders.
+_finders = []  # type: List[InstrumentingFinder]
+
+
+def install_import_hook(include, exclude=()):
+    # type: (Sequence[str], Sequence[str]) -> InstrumentingFinder
+    """Instrument modules imported from now on whose names match the include patterns.
+
+    Patterns are shell-style wildcards matched against the full module
+    name, e.g. 'mypkg' and 'mypkg.*'.  Modules matching an exclude pattern
+    are left alone.
+    """
+    finder = InstrumentingFinder(include, exclude)
+    sys.meta_path.insert(0, finder)
+    _finders.append(finder)
+    return finder
+
+
+def uninstall_import_hook():
+    # type: () -> None
+    """Remove the installed import hooks.  Modules already instrumented stay so."""
+    while _finders:
+        finder = _finders.pop()
+        if finder in sys.meta_path:
+            sys.meta_path.remove(finder)
@@ -0,0 +1,200 @@
+"""Tests for aggregator"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+)
+
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+from typing import Any, List
+
+from pyannotate_runtime import aggregator, collect_types
+
+# pylint:disable=missing-docstring
+
+
+def shipped(arg):
+    # type: (Any) -> Any
+    return [arg]
+
+
+def item(func_name, type_comments, samples=1):
+    # type: (str, List[str], int) -> collect_types.FunctionData
+    return {'path': 'mod.py', 'line': 1, 'func_name': func_name,
+            'type_comments': type_comments, 'samples': samples}
+
+
+class TestAddress(unittest.TestCase):
+
+    def test_parse_address(self):
+        # type: () -> None
+        assert aggregator.parse_address('localhost:7777') == (socket.AF_INET, ('localhost', 7777))
+        assert aggregator.parse_address('/tmp/agg.sock') == (socket.AF_UNIX, '/tmp/agg.sock')
+        assert aggregator.parse_address('agg.sock') == (socket.AF_UNIX, 'agg.sock')
+
+
+class TestAggregator(unittest.TestCase):
+
+    def test_merge(self):
+        # type: () -> None
+        agg = aggregator.Aggregator()
+        agg.add_message(aggregator.encode_message([item('f', ['(int) -> None'])])[4:])
+        agg.add_message(aggregator.encode_message([item('f', ['(str) -> None'], 2),
+                                                   item('g', ['() -> int'])])[4:])
+        assert json.loads(agg.dumps()) == [
+            item('f', ['(int) -> None', '(str) -> None'], 3),
+            item('g', ['() -> int']),
+        ]
+
+    def test_caps(self):
+        # type: () -> None
+        agg = aggregator.Aggregator()
+        comments = ['(C%d) -> None' % i for i in range(collect_types.MAX_ITEMS_PER_FUNCTION + 2)]
+        agg.add([item('f', comments[:2])])
+        agg.add([item('f', comments)])
+        [merged] = json.loads(agg.dumps())
+        assert merged['type_comments'] == comments[:collect_types.MAX_ITEMS_PER_FUNCTION]
+
+    def test_bad_message(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            aggregator.Aggregator().add_message(b'[]')
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix domain sockets are not available')
+class TestSender(unittest.TestCase):
+
+    def setUp(self):
+        # type: () -> None
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmpdir, 'agg.sock')
+        collect_types.init_types_collection()
+        collect_types.collected_args = {}
+        collect_types.collected_signatures = {}
+        collect_types.num_samples = {}
+        collect_types.sampling_counters = {}
+        self.stats = aggregator.get_sender_stats()
+
+    def tearDown(self):
+        # type: () -> None
+        aggregator.stop_sender()
+        collect_types.stop_types_collection()
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for(self, agg, samples):
+        # type: (aggregator.Aggregator, int) -> None
+        """Wait until the aggregator has received the samples (it's handled in another thread)."""
+        deadline = time.time() + 10
+        while (sum(item['samples'] for item in list(agg.functions.values())) < samples and
+               time.time() < deadline):
+            time.sleep(0.01)
+
+    def new_stats(self, kind):
+        # type: (str) -> int
+        return aggregator.get_sender_stats()[kind] - self.stats[kind]
+
+    def test_send(self):
+        # type: () -> None
+        agg = aggregator.Aggregator()
+        server = aggregator.make_server(self.address, agg)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            aggregator.start_sender(self.address, interval=1000)
+            with collect_types.collect():
+                shipped(1)
+            aggregator._send_delta()
+            with collect_types.collect():
+                shipped('x')
+            aggregator._send_delta()
+            aggregator._send_delta()  # Nothing changed; not sent.
+            aggregator.stop_sender()
+            self.wait_for(agg, 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        assert self.new_stats('batches_sent') == 2
+        assert self.new_stats('batches_dropped') == 0
+        [merged] = json.loads(agg.dumps())
+        assert merged['func_name'] == 'shipped'
+        assert merged['type_comments'] == ['(int) -> List[int]', '(str) -> List[str]'] or \
+            merged['type_comments'] == ['(str) -> List[str]', '(int) -> List[int]']
+        assert merged['samples'] == 2
+        output = os.path.join(self.tmpdir, 'type_info.json')
+        agg.write(output)
+        assert collect_types.load_stats(output) == [merged]
+
+    def test_missing_aggregator(self):
+        # type: () -> None
+        aggregator.start_sender(self.address, interval=1000, timeout=0.1)
+        with collect_types.collect():
+            shipped(1)
+        aggregator._send_delta()
+        assert self.new_stats('batches_dropped') == 1
+        assert self.new_stats('functions_dropped') == 1
+        # The dropped data is sent once the aggregator is there.
+        agg = aggregator.Aggregator()
+        server = aggregator.make_server(self.address, agg)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            aggregator.stop_sender()
+            self.wait_for(agg, 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        assert self.new_stats('batches_sent') == 1
+        assert [item['func_name'] for item in json.loads(agg.dumps())] == ['shipped']
+
+    def test_bad_interval(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            aggregator.start_sender(self.address, interval=0)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'SIGUSR1 is not available')
+    def test_main(self):
+        # type: () -> None
+        output = os.path.join(self.tmpdir, 'type_info.json')
+        top_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        proc = subprocess.Popen([sys.executable, '-m', 'pyannotate_runtime.aggregator',
+                                 self.address, '-o', output, '--interval', '0.05'],
+                                cwd=top_dir, stderr=subprocess.PIPE)
+        try:
+            # Printed once the signal handlers are installed.
+            assert b'listening' in proc.stderr.readline()
+            deadline = time.time() + 10
+            aggregator.start_sender(self.address, interval=1000)
+            with collect_types.collect():
+                shipped(1)
+            aggregator.stop_sender()
+            # Written on request (also while periodic writes are going on),
+            # and when shutting down.
+            for _ in range(20):
+                proc.send_signal(signal.SIGUSR1)
+                time.sleep(0.01)
+            while not os.path.exists(output) and time.time() < deadline:
+                time.sleep(0.01)
+            proc.send_signal(signal.SIGTERM)
+            while proc.poll() is None and time.time() < deadline:
+                time.sleep(0.01)
+            assert proc.poll() == 0
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stderr.close()
+        [merged] = collect_types.load_stats(output)
+        assert merged['func_name'] == 'shipped'
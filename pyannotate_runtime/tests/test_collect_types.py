@@ -6,11 +6,20 @@ from __future__ import (
 )
 
 import contextlib
+import gc
+import gzip
 import json
 import os
 import sched
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
 import time
 import unittest
+import weakref
 from collections import namedtuple
 from threading import Thread
 
@@ -31,6 +40,7 @@ except ImportError:
     Text = str  # type: ignore
 
 from pyannotate_runtime import collect_types
+from pyannotate_tools.annotations import formats, store
 
 # A bunch of random functions and classes to test out type collection
 # Disable a whole bunch of lint warnings for simplicity
@@ -171,6 +181,161 @@ def two_dict_comprehensions():
     }
 
 
+class TestTypeDescriptors(unittest.TestCase):
+
+    def test_structurally_equal_types_are_identical(self):
+        # type: () -> None
+        assert collect_types.resolve_type([1, 2]) is collect_types.resolve_type([3])
+        assert collect_types.resolve_type({'a': (1, None)}) is \
+            collect_types.resolve_type({'b': (2, None)})
+        assert collect_types.resolve_type(1) is collect_types.ScalarType(int)
+        assert collect_types.resolve_type([1]) is not collect_types.resolve_type(['x'])
+
+    def test_names(self):
+        # type: () -> None
+        assert repr(collect_types.resolve_type([])) == 'List'
+        assert repr(collect_types.resolve_type({1: [None]})) == 'Dict[int, List]'
+        assert repr(collect_types.resolve_type((1, 'x'))) == 'Tuple[int, str]'
+        assert repr(collect_types.resolve_type([1, None])) == 'List[Optional[int]]'
+        assert collect_types.name_from_type(collect_types.resolve_type(set([1.5]))) == \
+            'Set[float]'
+
+    def test_union_add(self):
+        # type: () -> None
+        empty = collect_types.TentativeType()
+        assert empty.is_empty()
+        int_type = collect_types.resolve_type(1)
+        union = empty.add(int_type)
+        assert union is empty.add(int_type)
+        assert union.add(int_type) is union
+        # A non-empty list replaces the empty list.
+        union = empty.add(collect_types.resolve_type([])).add(collect_types.resolve_type([1]))
+        assert repr(union) == 'List[int]'
+        # Dicts with the same key type have their value types merged.
+        union = empty.add(collect_types.resolve_type({1: 'a'})).add(
+            collect_types.resolve_type({1: 2}))
+        assert repr(union) == 'Dict[int, Union[int, str]]'
+
+    def test_union_add_cache_key(self):
+        # type: () -> None
+        union = collect_types.TentativeType().add(collect_types.resolve_type({1: 'a'}))
+        added = collect_types.resolve_type({1: 2})
+        merged = union.add(added)
+        # Cached under the added type, not the merged dict type.
+        assert collect_types._union_add_cache[(union, added)] is merged
+
+    def test_caches_are_bounded(self):
+        # type: () -> None
+        max_cached = collect_types.MAX_CACHED_TYPES
+        collect_types.MAX_CACHED_TYPES = 10
+        try:
+            classes = [type('Generated%d' % i, (object,), {}) for i in range(25)]
+            union = collect_types.TentativeType()
+            for cls in classes:
+                union = union.add(collect_types.resolve_type(cls()))
+        finally:
+            collect_types.MAX_CACHED_TYPES = max_cached
+        assert len(collect_types._scalar_types) <= 10
+        assert len(collect_types._union_add_cache) <= 10
+        assert len(union.types) == 25
+
+    def test_unused_descriptors_are_freed(self):
+        # type: () -> None
+        cls = type('Generated', (object,), {})
+        desc = collect_types.resolve_type([cls()])
+        assert collect_types.resolve_type([cls()]) is desc
+        cls_ref = weakref.ref(cls)
+        desc_ref = weakref.ref(desc)
+        del cls, desc
+        collect_types._clear_type_caches()
+        gc.collect()
+        assert cls_ref() is None
+        assert desc_ref() is None
+
+
+class TestResolveBudget(unittest.TestCase):
+
+    def test_depth_limit(self):
+        # type: () -> None
+        nested = []  # type: List[Any]
+        innermost = nested
+        for _ in range(100):
+            innermost.append([])
+            innermost = innermost[0]
+        depth = collect_types.MAX_RESOLVE_DEPTH
+        assert repr(collect_types.resolve_type(nested)) == 'List[' * depth + 'List' + ']' * depth
+        assert repr(collect_types.resolve_type(((((1,),),),))) == 'Tuple[Tuple[Tuple[Tuple[int]]]]'
+
+    def test_self_reference(self):
+        # type: () -> None
+        cycle = [1]  # type: List[Any]
+        cycle.append(cycle)
+        assert repr(collect_types.resolve_type(cycle)) == 'List[Union[List, int]]'
+        d = {}  # type: Dict[str, Any]
+        d['self'] = d
+        assert repr(collect_types.resolve_type(d)) == 'Dict[str, Dict]'
+        t = ([],)  # type: Tuple[List[Any]]
+        t[0].append(t)
+        assert repr(collect_types.resolve_type(t)) == 'Tuple[List[tuple]]'
+
+    def test_node_limit(self):
+        # type: () -> None
+        max_nodes = collect_types.MAX_RESOLVE_NODES
+        collect_types.MAX_RESOLVE_NODES = 3
+        try:
+            resolved = collect_types.resolve_type([(1,), (2,), ('x',), (1.5,)])
+        finally:
+            collect_types.MAX_RESOLVE_NODES = max_nodes
+        # The budget ran out after the first two tuples.
+        assert repr(resolved) == 'List[Union[Tuple[int], tuple]]'
+
+    def test_items_spread_over_container(self):
+        # type: () -> None
+        assert repr(collect_types.resolve_type([1] * 100 + ['x'] * 10)) == 'List[Union[int, str]]'
+        assert repr(collect_types.resolve_type([1] * 100 + [[1.5]] * 10)) == \
+            'List[Union[List[float], int]]'
+        d = dict((i, 'x') for i in range(1000))
+        d[1000] = None
+        # Only the start of a dict is looked at.
+        assert repr(collect_types.resolve_type(d)) == 'Dict[int, str]'
+        d = dict((i, 'x' if i % 3 else 1.5) for i in range(100))
+        assert repr(collect_types.resolve_type(d)) == 'Dict[int, Union[float, str]]'
+        assert repr(collect_types.resolve_type(set(range(10)) | set(['x']))) == \
+            'Set[Union[int, str]]'
+
+
+class TestSignatures(unittest.TestCase):
+
+    def make_signature(self, args, varargs, ret):
+        # type: (List[Any], Optional[List[Any]], Any) -> collect_types.Signature
+        resolved = collect_types.ResolvedTypes(
+            pos_args=[collect_types.resolve_type(arg) for arg in args],
+            varargs=None if varargs is None else [collect_types.resolve_type(arg)
+                                                  for arg in varargs],
+            kwonly_args=[],
+            kwargs=None)
+        return collect_types.ArgTypes(resolved).with_return(collect_types.resolve_type(ret))
+
+    def test_equal_signatures(self):
+        # type: () -> None
+        sig1 = self.make_signature([1, 'x'], None, None)
+        sig2 = self.make_signature([2, 'y'], None, None)
+        assert sig1 == sig2
+        assert hash(sig1) == hash(sig2)
+        assert len({sig1, sig2}) == 1
+        assert sig1 != self.make_signature([2, 2], None, None)
+        # The same types with a different argument layout are different.
+        assert sig1 != self.make_signature([1], ['x'], None)
+
+    def test_type_comment(self):
+        # type: () -> None
+        sig = self.make_signature([1], [{1: 'a'}, {1: 2}], [])
+        assert collect_types._make_type_comment(sig) == \
+            '(int, *Dict[int, Union[int, str]]) -> List'
+        assert collect_types._make_type_comment(self.make_signature([], [], 1.5)) == \
+            '() -> float'
+
+
 class TestBaseClass(unittest.TestCase):
 
     def setUp(self):
@@ -200,6 +365,13 @@ class TestBaseClass(unittest.TestCase):
         collect_types.pause()
         self.load_stats()
 
+    def raw_type_comments(self, func_name):
+        # type: (str) -> List[str]
+        return sorted(collect_types._make_type_comment(signature)
+                      for key, signatures in collect_types.collected_signatures.items()
+                      if key.func_name == func_name
+                      for signature in signatures)
+
     def assert_type_comments(self, func_name, comments):
         # type: (str, List[str]) -> None
         """Assert that we generated expected comment for the func_name function in self.stats"""
@@ -487,8 +659,31 @@ class TestCollectTypes(TestBaseClass):
         with self.collecting_types():
             star_star_args(1, y='', z=True)
             star_star_args(**{'x': True, 'a': 1.1})
-        self.assert_type_comments('star_star_args', ['(int) -> int',
-                                                     '(bool) -> int'])
+            star_star_args('')
+        self.assert_type_comments('star_star_args', ['(int, **Union[bool, str]) -> int',
+                                                     '(bool, **float) -> int',
+                                                     '(str) -> int'])
+
+    @unittest.skipIf(PY2, 'keyword-only arguments require Python 3')
+    def test_keyword_only_args(self):
+        # type: () -> None
+        ns = {}  # type: Dict[str, Any]
+        exec('def kw_only(x, *args, y, **kw):\n'
+             '    return 0\n', ns)
+        kw_only = ns['kw_only']
+
+        with self.collecting_types():
+            kw_only(1, y='')
+            kw_only(1, 1.1, y='', z=True)
+            kw_only(1, y=1.1, z=True)
+        # exec'd code is reported under '<string>', so look at the raw signatures.
+        comments = set(collect_types._make_type_comment(signature)
+                       for signatures in collect_types.collected_signatures.values()
+                       for signature in signatures)
+        assert comments == {'(int, *pyannotate_runtime.collect_types.UnknownType, str) -> int',
+                            '(int, *float, str, **bool) -> int',
+                            '(int, *pyannotate_runtime.collect_types.UnknownType, float, **bool)'
+                            ' -> int'}
 
     def test_fully_qualified_type_name_with_sub_package(self):
         # type: () -> None
@@ -520,9 +715,9 @@ class TestCollectTypes(TestBaseClass):
         self.assert_type_comments(
             'recurse',
             ['(Tuple[]) -> float',
-             '(Tuple[bool]) -> pyannotate_runtime.collect_types.UnknownType',
-             '(Tuple[str, bool]) -> pyannotate_runtime.collect_types.UnknownType',
-             '(Tuple[int, str, bool]) -> pyannotate_runtime.collect_types.UnknownType'])
+             '(Tuple[bool]) -> bool',
+             '(Tuple[str, bool]) -> str',
+             '(Tuple[int, str, bool]) -> int'])
 
     def test_recursive_function_2(self):
         # type: () -> None
@@ -537,14 +732,129 @@ class TestCollectTypes(TestBaseClass):
                 return x
 
         with self.collecting_types():
-            # The return event for the initial call is mismatched because of
-            # the recursive calls, so we'll have to drop the return type.
+            # Returns are paired with calls by frame, so the recursive calls
+            # don't get in the way of the initial call's return.
             recurse(0)
         self.assert_type_comments(
             'recurse',
             ['(str) -> str',
              '(float) -> float',
-             '(int) -> pyannotate_runtime.collect_types.UnknownType'])
+             '(int) -> bool'])
+
+    def test_generator_function(self):
+        # type: () -> None
+
+        def gen(n):
+            # type: (Any) -> Any
+            for i in range(n):
+                yield str(i)
+            return
+
+        def consume(n):
+            # type: (Any) -> Any
+            return len(list(gen(n)))
+
+        with self.collecting_types():
+            consume(3)
+            consume(0)
+        # Yields are not returns, and resuming is not calling.
+        self.assert_type_comments('gen', ['(int) -> generator'])
+        self.assert_type_comments('consume', ['(int) -> int'])
+
+    def test_interleaved_generators(self):
+        # type: () -> None
+
+        def running_total(start):
+            # type: (Any) -> Any
+            total = start
+            while True:
+                total += yield total
+
+        def helper(x):
+            # type: (Any) -> Any
+            return x
+
+        with self.collecting_types():
+            g1 = running_total(1)
+            g2 = running_total(1.5)
+            next(g1)
+            next(g2)
+            for i in range(3):
+                g1.send(helper(i))
+                g2.send(helper(float(i)))
+        self.assert_type_comments('running_total',
+                                  ['(int) -> generator', '(float) -> generator'])
+        self.assert_type_comments('helper', ['(int) -> int', '(float) -> float'])
+
+    def test_interleaved_threads(self):
+        # type: () -> None
+        barrier = threading.Event()
+
+        def wait_and_return(x):
+            # type: (Any) -> Any
+            barrier.wait(5)
+            return x
+
+        with self.collecting_types():
+            t = Thread(target=wait_and_return, args=('a',))
+            t.start()
+            time.sleep(0.01)
+            # This call starts while the one in the thread is still pending.
+            done = Thread(target=barrier.set)
+            done.start()
+            wait_and_return(1)
+            t.join()
+            done.join()
+        self.assert_type_comments('wait_and_return', ['(str) -> str', '(int) -> int'])
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'async/await requires Python 3.5')
+    def test_coroutines(self):
+        # type: () -> None
+        namespace = {}  # type: Dict[str, Any]
+        exec(textwrap.dedent('''
+            import asyncio
+
+            async def fetch(x, delay):
+                await asyncio.sleep(delay)
+                await asyncio.sleep(0)
+                return [x]
+
+            async def main():
+                return await asyncio.gather(fetch(1, 0.02), fetch('a', 0.01))
+            '''), namespace)
+
+        loop = namespace['asyncio'].new_event_loop()
+        try:
+            with self.collecting_types():
+                loop.run_until_complete(namespace['main']())
+        finally:
+            loop.close()
+        # exec'd code is reported under '<string>', so look at the raw signatures.
+        assert self.raw_type_comments('fetch') == ['(int, float) -> List[int]',
+                                                   '(str, float) -> List[str]']
+
+    @unittest.skipIf(sys.version_info < (3, 6), 'async generators require Python 3.6')
+    def test_async_generator(self):
+        # type: () -> None
+        namespace = {}  # type: Dict[str, Any]
+        exec(textwrap.dedent('''
+            import asyncio
+
+            async def ticks(n):
+                for i in range(n):
+                    yield i
+
+            async def count(n):
+                return len([i async for i in ticks(n)])
+            '''), namespace)
+
+        loop = namespace['asyncio'].new_event_loop()
+        try:
+            with self.collecting_types():
+                loop.run_until_complete(namespace['count'](3))
+        finally:
+            loop.close()
+        assert self.raw_type_comments('ticks') == ['(int) -> async_generator']
 
     def test_ignoring_c_calls(self):
         # type: () -> None
@@ -595,6 +905,221 @@ class TestCollectTypes(TestBaseClass):
 
         self.assert_type_comments('func_with_unknown_module_types', ['(C) -> C'])
 
+    def test_code_info_is_cached(self):
+        # type: () -> None
+
+        def cached(x):
+            # type: (Any) -> Any
+            return x
+
+        with self.collecting_types():
+            cached(1)
+            info = collect_types._code_info[id(cached.__code__)]
+            cached('')
+            assert collect_types._code_info[id(cached.__code__)] is info
+        assert info.function_key.func_name == 'cached'
+        assert set(collect_types.collected_signatures) == {info.function_key}
+
+    def test_code_info_forgotten_when_code_is_freed(self):
+        # type: () -> None
+        ns = {}  # type: Dict[str, Any]
+        with self.collecting_types():
+            for i in range(10):
+                exec('def generated(x):\n    return x\n', ns)
+                ns['generated'](i)
+            key = id(ns['generated'].__code__)
+            assert key in collect_types._code_info
+            assert key in collect_types.sampling_counters
+            del ns['generated']
+            gc.collect()
+            assert key not in collect_types._code_info
+            assert key not in collect_types.sampling_counters
+
+
+class TestCollectTypesBuffered(TestCollectTypes):
+    """Run the same tests with per-thread event buffers instead of the queue."""
+
+    def setUp(self):
+        # type: () -> None
+        TestBaseClass.setUp(self)
+        collect_types.init_types_collection(flush_size=3)
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestCollectTypesBuffered, self).tearDown()
+        collect_types.init_types_collection()
+        collect_types.stop_types_collection()
+
+    def test_buffer_is_processed_when_full(self):
+        # type: () -> None
+
+        def buffered(x):
+            # type: (Any) -> Any
+            return x
+
+        collect_types.running = True
+        try:
+            for i in range(5):
+                buffered(i)
+                assert len(collect_types._thread_buffer.items) < 3
+        finally:
+            collect_types.running = False
+        collect_types._flush_buffers()
+        assert not collect_types._thread_buffer.items
+
+    def test_buffers_of_dead_threads_are_dropped(self):
+        # type: () -> None
+        with self.collecting_types():
+            t = Thread(target=self.bar_another_thread, args=(100, ['1', '2', '3'],))
+            t.start()
+            t.join()
+        assert t not in [thread for thread, _ in collect_types._buffers]
+        self.assert_type_comments('TestCollectTypes.baz_another_thread',
+                                  ['(List[str]) -> Set[int]'])
+
+
+class TestCollectTypesPerThread(TestCollectTypes):
+    """Run the same tests with per-thread collector state (as without a GIL)."""
+
+    def setUp(self):
+        # type: () -> None
+        TestBaseClass.setUp(self)
+        collect_types.init_types_collection(per_thread=True)
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestCollectTypesPerThread, self).tearDown()
+        collect_types.init_types_collection()
+        collect_types.stop_types_collection()
+
+    def test_per_thread_implies_buffering(self):
+        # type: () -> None
+        assert collect_types._flush_size == collect_types.DEFAULT_FLUSH_SIZE
+        collect_types.init_types_collection(per_thread=True, flush_size=3)
+        assert collect_types._flush_size == 3
+
+    def test_default_depends_on_gil(self):
+        # type: () -> None
+        is_gil_enabled = collect_types._is_gil_enabled
+        try:
+            collect_types._is_gil_enabled = lambda: False
+            collect_types.init_types_collection()
+            assert collect_types._per_thread
+            collect_types._is_gil_enabled = lambda: True
+            collect_types.init_types_collection()
+            assert not collect_types._per_thread
+        finally:
+            collect_types._is_gil_enabled = is_gil_enabled
+
+    def test_sample_cap_across_threads(self):
+        # type: () -> None
+        num_threads = 8
+        calls_per_thread = 1000
+        start = threading.Event()
+
+        def shared(x):
+            # type: (Any) -> Any
+            return x
+
+        def worker():
+            # type: () -> None
+            start.wait(5)
+            for i in range(calls_per_thread):
+                shared(i)
+
+        with self.collecting_types():
+            threads = [Thread(target=worker) for _ in range(num_threads)]
+            for t in threads:
+                t.start()
+            start.set()
+            for t in threads:
+                t.join()
+        [item] = [item for item in self.stats if item['func_name'] == 'shared']
+        # Every call number is sampled at most once, and the lag of the
+        # folded counts only loses a few samples.
+        expected = len([n for n in collect_types.sampling_sequence
+                        if n < num_threads * calls_per_thread])
+        assert expected // 2 <= item['samples'] <= expected
+        folded = collect_types.sampling_counters[id(shared.__code__)]
+        assert 0 <= num_threads * calls_per_thread - folded < (
+            num_threads * collect_types._FOLD_INTERVAL)
+
+
+@unittest.skipUnless(hasattr(sys, 'monitoring'), 'sys.monitoring requires Python 3.12+')
+class TestCollectTypesWithMonitoring(TestCollectTypes):
+    """Run the same tests against the sys.monitoring backend."""
+
+    def setUp(self):
+        # type: () -> None
+        TestBaseClass.setUp(self)
+        collect_types.init_types_collection(backend=collect_types.BACKEND_MONITORING)
+
+    def test_collect_stats(self):
+        # type: () -> None
+
+        def add(x, y):
+            # type: (Any, Any) -> Any
+            return x + y
+
+        collect_types.init_types_collection(backend=collect_types.BACKEND_MONITORING,
+                                            collect_stats=True)
+        try:
+            with self.collecting_types():
+                add(1, 2)
+            stats = collect_types.get_stats()
+        finally:
+            collect_types.init_types_collection(backend=collect_types.BACKEND_MONITORING)
+        # The callbacks see the frame of the function, not that of a wrapper.
+        self.assert_type_comments('add', ['(int, int) -> int'])
+        assert stats['events_seen'] >= 2
+        assert stats['events_sampled'] == 2
+        assert stats['top_functions'][0]['func_name'] == 'add'
+
+    def test_no_return(self):
+        # type: () -> None
+
+        def func_always_fail(x):
+            # type: (Any) -> Any
+            raise ValueError
+
+        def func_sometimes_fail(x):
+            # type: (Any) -> Any
+            if x == 0:
+                raise RuntimeError
+            return x
+
+        with self.collecting_types():
+            for arg in 1, '', 1:
+                try:
+                    func_always_fail(arg)
+                except Exception:
+                    pass
+            for arg in 0, '', 0:
+                try:
+                    func_sometimes_fail(arg)
+                except Exception:
+                    pass
+        # Exceptions are told apart from returning None.
+        self.assert_type_comments('func_always_fail',
+                                  ['(int) -> pyannotate_runtime.collect_types.UnknownType',
+                                   '(str) -> pyannotate_runtime.collect_types.UnknownType'])
+        self.assert_type_comments('func_sometimes_fail',
+                                  ['(int) -> pyannotate_runtime.collect_types.UnknownType',
+                                   '(str) -> str'])
+
+    def test_saturated_function_is_disabled(self):
+        # type: () -> None
+
+        def called_often(x):
+            # type: (Any) -> Any
+            return x
+
+        with self.collecting_types():
+            for i in range(collect_types.LAST_SAMPLE + 10):
+                called_often(i)
+        assert collect_types.sampling_counters[id(called_often.__code__)] is None
+        assert self.stats[0]['samples'] == len(collect_types.sampling_sequence)
+
 
 def foo(arg):
     # type: (Any) -> Any
@@ -619,9 +1144,1264 @@ class TestInitWithFilter(TestBaseClass):
         assert len(self.stats) == 1
         assert self.stats[0]['path'] == 'foo.py'
 
+    def test_bad_flush_size(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.init_types_collection(flush_size=0)
+
+    def test_unknown_backend(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.init_types_collection(backend='nonsense')
+
     def test_init_with_none_filter(self):
         # type: () -> None
         collect_types.init_types_collection(self.always_none)
         with self.collecting_types():
             foo(42)
         assert self.stats == []
+
+
+@collect_types.trace
+def decorated_function(x, y=None):
+    # type: (Any, Any) -> Any
+    return [x]
+
+
+def targeted_function(x, *args, **kwargs):
+    # type: (Any, *Any, **Any) -> Any
+    if x is None:
+        raise ValueError
+    return x
+
+
+def targeted_generator(n):
+    # type: (Any) -> Any
+    for i in range(n):
+        yield i
+
+
+class TargetedClass(object):
+
+    def method(self, x):
+        # type: (Any) -> Any
+        return str(x)
+
+    @staticmethod
+    def static_method(x):
+        # type: (Any) -> Any
+        return x
+
+    @classmethod
+    def class_method(cls, x):
+        # type: (Any) -> Any
+        return cls
+
+    @collect_types.trace
+    def decorated_method(self, x):
+        # type: (Any) -> Any
+        return x
+
+
+class TestTargetedCollection(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestTargetedCollection, self).setUp()
+        collect_types.init_types_collection(backend=collect_types.BACKEND_TARGETED)
+
+    def tearDown(self):
+        # type: () -> None
+        collect_types.untrace_functions()
+        super(TestTargetedCollection, self).tearDown()
+
+    def test_decorator(self):
+        # type: () -> None
+        assert sys.getprofile() is None
+        with self.collecting_types():
+            decorated_function(1)
+            decorated_function('x', y=True)
+            TargetedClass().decorated_method(1.5)
+            foo(1)  # Not traced.
+        self.assert_type_comments('decorated_function', ['(int, None) -> List[int]',
+                                                         '(str, bool) -> List[str]'])
+        self.assert_type_comments('TargetedClass.decorated_method', ['(float) -> float'])
+        assert [item['func_name'] for item in self.stats] == ['decorated_function',
+                                                               'TargetedClass.decorated_method']
+        assert decorated_function.__name__ == 'decorated_function'
+
+    def test_trace_functions(self):
+        # type: () -> None
+        original = TargetedClass.__dict__['static_method']
+        collect_types.trace_functions([
+            __name__ + '.targeted_function',
+            __name__ + '.targeted_generator',
+            __name__ + '.TargetedClass',
+        ])
+        with self.collecting_types():
+            targeted_function(1, 'x', key=1.5)
+            try:
+                targeted_function(None)
+            except ValueError:
+                pass
+            list(targeted_generator(3))
+            TargetedClass().method(1)
+            TargetedClass.static_method('x')
+            TargetedClass.class_method(1)
+        self.assert_type_comments(
+            'targeted_function',
+            ['(int, *str, **float) -> int',
+             '(None) -> pyannotate_runtime.collect_types.UnknownType'])
+        self.assert_type_comments('targeted_generator', ['(int) -> generator'])
+        self.assert_type_comments('TargetedClass.method', ['(int) -> str'])
+        self.assert_type_comments('static_method', ['(str) -> str'])
+        self.assert_type_comments('class_method', ['(int) -> type'])
+        collect_types.untrace_functions()
+        assert TargetedClass.__dict__['static_method'] is original
+        assert not hasattr(targeted_function, '_pyannotate_traced')
+
+    def test_trace_module(self):
+        # type: () -> None
+        collect_types.trace_functions([__name__])
+        assert getattr(targeted_function, '_pyannotate_traced', False)
+        assert getattr(TargetedClass.method, '_pyannotate_traced', False)
+        # Imported from elsewhere.
+        assert not hasattr(namedtuple, '_pyannotate_traced')
+        collect_types.untrace_functions()
+        assert not hasattr(targeted_function, '_pyannotate_traced')
+
+    def test_sampling(self):
+        # type: () -> None
+        collect_types.trace_functions([__name__ + '.targeted_function'])
+        with self.collecting_types():
+            for i in range(collect_types.LAST_SAMPLE + 10):
+                targeted_function(i)
+        [item] = self.stats
+        assert item['samples'] == len(collect_types.sampling_sequence)
+
+    def test_inactive_with_other_backends(self):
+        # type: () -> None
+        collect_types.init_types_collection()
+        with self.collecting_types():
+            decorated_function(1)
+        # Recorded once, by the profiler hook.
+        [item] = [item for item in self.stats if item['func_name'] == 'decorated_function']
+        assert item['samples'] == 1
+
+    def test_bad_names(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.trace_functions(['no_such_module_at_all'])
+        with self.assertRaises(ValueError):
+            collect_types.trace_functions([__name__ + '.no_such_function'])
+        with self.assertRaises(ValueError):
+            collect_types.trace_functions([__name__ + '.MAX_ITEMS'])
+
+
+def scoped_function(x):
+    # type: (Any) -> Any
+    return [x]
+
+
+@unittest.skipIf(collect_types.contextvars is None, 'context scopes require Python 3.7')
+class TestContextScope(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestContextScope, self).setUp()
+        collect_types.collected_args = {}
+        collect_types.collected_signatures = {}
+        collect_types.num_samples = {}
+        collect_types.sampling_counters = {}
+        collect_types.call_pending = set()
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestContextScope, self).tearDown()
+        collect_types.init_types_collection()
+        collect_types.stop_types_collection()
+
+    def load_stats(self):
+        # type: () -> None
+        collect_types.pause()
+        super(TestContextScope, self).load_stats()
+
+    def test_threads(self):
+        # type: () -> None
+        collect_types.init_types_collection(scope=collect_types.SCOPE_CONTEXT)
+        assert sys.getprofile() is None
+        entered = threading.Event()
+        called = threading.Event()
+        profiles = []  # type: List[Any]
+
+        def unscoped():
+            # type: () -> None
+            entered.wait()
+            profiles.append(sys.getprofile())
+            scoped_function('x')
+            called.set()
+
+        t = Thread(target=unscoped)
+        t.start()
+        with collect_types.collect():
+            assert sys.getprofile() is not None
+            entered.set()
+            called.wait()
+            scoped_function(1)
+        t.join()
+        # Only the thread in the scope had the hook, and only its call was collected.
+        assert profiles == [None]
+        assert sys.getprofile() is None
+        self.load_stats()
+        self.assert_type_comments('scoped_function', ['(int) -> List[int]'])
+
+    def test_nested(self):
+        # type: () -> None
+        collect_types.init_types_collection(scope=collect_types.SCOPE_CONTEXT)
+        with collect_types.collect():
+            with collect_types.collect():
+                scoped_function(1)
+            assert sys.getprofile() is not None
+            scoped_function('x')
+        assert sys.getprofile() is None
+        assert collect_types._context_scopes == 0
+        scoped_function(1.5)
+        self.load_stats()
+        self.assert_type_comments('scoped_function', ['(int) -> List[int]',
+                                                      '(str) -> List[str]'])
+
+    def test_asyncio_tasks(self):
+        # type: () -> None
+        collect_types.init_types_collection(scope=collect_types.SCOPE_CONTEXT)
+        namespace = {'collect': collect_types.collect}  # type: Dict[str, Any]
+        exec(textwrap.dedent('''
+            import asyncio
+
+            async def handle(x):
+                await asyncio.sleep(0)
+                await asyncio.sleep(0)
+                return [x]
+
+            async def request(x, traced):
+                if traced:
+                    with collect():
+                        # Tasks created in the scope are in it too.
+                        return await asyncio.ensure_future(handle(x))
+                return await handle(x)
+
+            async def main():
+                return await asyncio.gather(request('a', False), request(1, True),
+                                            request(1.5, False))
+            '''), namespace)
+
+        loop = namespace['asyncio'].new_event_loop()
+        try:
+            loop.run_until_complete(namespace['main']())
+        finally:
+            loop.close()
+        collect_types.pause()
+        assert self.raw_type_comments('handle') == ['(int) -> List[int]']
+
+    def check_tasks_outliving_scope(self):
+        # type: () -> None
+        namespace = {'collect': collect_types.collect}  # type: Dict[str, Any]
+        exec(textwrap.dedent('''
+            import asyncio
+
+            async def handle(x):
+                await asyncio.sleep(0)
+                return [x]
+
+            async def request(x):
+                with collect():
+                    # The task starts running after the scope is exited.
+                    task = asyncio.ensure_future(handle(x))
+                return await task
+            '''), namespace)
+
+        loop = namespace['asyncio'].new_event_loop()
+        try:
+            loop.run_until_complete(namespace['request'](1))
+        finally:
+            loop.close()
+        del loop
+        gc.collect()
+        # Once the task is gone, so is the scope, and the hooks.
+        assert collect_types._context_scopes == 0
+        namespace['handle']('x').close()
+        assert sys.getprofile() is None
+        collect_types.pause()
+        assert self.raw_type_comments('handle') == ['(int) -> List[int]']
+
+    def test_tasks_outliving_scope(self):
+        # type: () -> None
+        collect_types.init_types_collection(scope=collect_types.SCOPE_CONTEXT)
+        self.check_tasks_outliving_scope()
+
+    @unittest.skipIf(collect_types._monitoring is None, 'sys.monitoring requires Python 3.12')
+    def test_tasks_outliving_scope_monitoring(self):
+        # type: () -> None
+        collect_types.init_types_collection(backend=collect_types.BACKEND_MONITORING,
+                                            scope=collect_types.SCOPE_CONTEXT)
+        self.check_tasks_outliving_scope()
+        assert collect_types._monitoring.get_events(collect_types.MONITORING_TOOL_ID) == 0
+
+    def test_process_hooks(self):
+        # type: () -> None
+        collect_types.init_types_collection()
+        scoped_function(1)
+        with collect_types.collect(scope=collect_types.SCOPE_CONTEXT):
+            t = Thread(target=scoped_function, args=(1.5,))
+            t.start()
+            t.join()
+            scoped_function('x')
+        scoped_function(1)
+        self.load_stats()
+        self.assert_type_comments('scoped_function', ['(str) -> List[str]'])
+
+    def test_targeted(self):
+        # type: () -> None
+        collect_types.init_types_collection(backend=collect_types.BACKEND_TARGETED,
+                                            scope=collect_types.SCOPE_CONTEXT)
+        decorated_function(1)
+        with collect_types.collect():
+            decorated_function('x')
+        self.load_stats()
+        self.assert_type_comments('decorated_function', ['(str, None) -> List[str]'])
+
+    @unittest.skipIf(collect_types._monitoring is None, 'sys.monitoring requires Python 3.12')
+    def test_monitoring(self):
+        # type: () -> None
+        collect_types.init_types_collection(backend=collect_types.BACKEND_MONITORING,
+                                            scope=collect_types.SCOPE_CONTEXT)
+        monitoring = collect_types._monitoring
+        tool = collect_types.MONITORING_TOOL_ID
+        assert monitoring.get_events(tool) == 0
+        with collect_types.collect():
+            assert monitoring.get_events(tool) != 0
+            scoped_function(1)
+        assert monitoring.get_events(tool) == 0
+        scoped_function('x')
+        self.load_stats()
+        self.assert_type_comments('scoped_function', ['(int) -> List[int]'])
+
+    def test_unknown_scope(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.init_types_collection(scope='thread')
+        with self.assertRaises(ValueError):
+            with collect_types.collect(scope='thread'):
+                pass
+
+
+class TestPause(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestPause, self).setUp()
+        collect_types.init_types_collection()
+        collect_types.collected_args = {}
+        collect_types.collected_signatures = {}
+        collect_types.num_samples = {}
+        collect_types.sampling_counters = {}
+
+    def test_pause_without_waiting(self):
+        # type: () -> None
+        collect_types.resume()
+        # Hold up the consumer thread.
+        with collect_types._data_lock:
+            scoped_function(1)
+            assert not collect_types.pause(wait=False)
+            assert not collect_types.running
+            start = time.time()
+            assert not collect_types.pause(timeout=0.01)
+            assert time.time() - start < 0.5
+        # Dumping waits for the queued events.
+        self.load_stats()
+        self.assert_type_comments('scoped_function', ['(int) -> List[int]'])
+        assert collect_types.pause(timeout=1)
+
+    def test_pause_timeout_buffered(self):
+        # type: () -> None
+        collect_types.init_types_collection(flush_size=100)
+        try:
+            collect_types.resume()
+            scoped_function(1)
+            with collect_types._data_lock:
+                start = time.time()
+                assert not collect_types.pause(timeout=0.01)
+                assert time.time() - start < 0.5
+            assert collect_types.pause(timeout=1)
+            self.load_stats()
+            self.assert_type_comments('scoped_function', ['(int) -> List[int]'])
+        finally:
+            collect_types.init_types_collection()
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'async with requires Python 3.5')
+    def test_acollect(self):
+        # type: () -> None
+        namespace = {'acollect': collect_types.acollect}  # type: Dict[str, Any]
+        exec(textwrap.dedent('''
+            import asyncio
+
+            async def handle(x):
+                await asyncio.sleep(0)
+                return [x]
+
+            async def main():
+                async with acollect():
+                    await handle(1)
+                await handle('x')
+            '''), namespace)
+
+        loop = namespace['asyncio'].new_event_loop()
+        try:
+            loop.run_until_complete(namespace['main']())
+        finally:
+            loop.close()
+        assert not collect_types.running
+        assert collect_types._task_queue.unfinished_tasks == 0
+        assert self.raw_type_comments('handle') == ['(int) -> List[int]']
+
+    @unittest.skipIf(collect_types.contextvars is None, 'context scopes require Python 3.7')
+    def test_acollect_context(self):
+        # type: () -> None
+        namespace = {'acollect': collect_types.acollect}  # type: Dict[str, Any]
+        exec(textwrap.dedent('''
+            import asyncio
+
+            async def handle(x):
+                await asyncio.sleep(0)
+                return [x]
+
+            async def request(x, traced):
+                if traced:
+                    async with acollect(scope='context'):
+                        return await handle(x)
+                return await handle(x)
+
+            async def main():
+                return await asyncio.gather(request(1, True), request('x', False))
+            '''), namespace)
+
+        loop = namespace['asyncio'].new_event_loop()
+        try:
+            loop.run_until_complete(namespace['main']())
+        finally:
+            loop.close()
+        collect_types.pause()
+        assert self.raw_type_comments('handle') == ['(int) -> List[int]']
+
+    def test_acollect_unknown_scope(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.acollect(scope='thread')
+
+
+class TestSamplingPolicies(TestBaseClass):
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestSamplingPolicies, self).tearDown()
+        collect_types.init_types_collection()
+
+    def test_exponential_backoff(self):
+        # type: () -> None
+        policy = collect_types.ExponentialBackoffPolicy(first=2, factor=3, max_samples=5)
+        assert sorted(policy.sequence) == [0, 1, 6, 18, 54]
+        assert [policy.should_sample(n, None) for n in (0, 2, 6, 54, 55)] == [
+            True, False, True, True, None]
+        with self.assertRaises(ValueError):
+            collect_types.ExponentialBackoffPolicy(factor=1)
+
+    def test_probabilistic(self):
+        # type: () -> None
+        policy = collect_types.ProbabilisticPolicy(10, first=3, max_calls=1000, seed=0)
+        assert [policy.should_sample(n, None) for n in range(3)] == [True, True, True]
+        sampled = sum(bool(policy.should_sample(n, None)) for n in range(3, 1000))
+        assert 50 < sampled < 150
+        assert policy.should_sample(1000, None) is None
+
+    def test_module_rates(self):
+        # type: () -> None
+        never = collect_types.SequenceSamplingPolicy([-1])
+        policy = collect_types.ModuleRatePolicy({'pyannotate_runtime.tests': never})
+        collect_types.init_types_collection(sampling_policy=policy)
+        with self.collecting_types():
+            foo(42)
+        assert self.stats == []
+        this_module = policy.policy_for_filename(foo.__code__.co_filename)
+        assert this_module is never
+        assert policy.policy_for_filename(json.__file__) is policy.default
+
+    def test_overhead_budget(self):
+        # type: () -> None
+        policy = collect_types.OverheadBudgetPolicy(max_fraction=0.5)
+        assert policy.should_sample(0, None)
+        policy.record_overhead(1000.0)
+        assert policy.should_sample(1, None) is False
+        # Calls past the wrapped schedule still finish the function.
+        assert policy.should_sample(collect_types.LAST_SAMPLE + 1, None) is None
+        with self.assertRaises(ValueError):
+            collect_types.OverheadBudgetPolicy(max_fraction=2)
+
+    def test_policy_used_by_hook(self):
+        # type: () -> None
+
+        def sampled_twice(x):
+            # type: (Any) -> Any
+            return x
+
+        policy = collect_types.SequenceSamplingPolicy([0, 3])
+        collect_types.init_types_collection(sampling_policy=policy)
+        with self.collecting_types():
+            for x in (1, 'x', 1.5, None, b'', 2):
+                sampled_twice(x)
+        self.assert_type_comments('sampled_twice', ['(int) -> int', '(None) -> None'])
+        assert collect_types.sampling_counters[id(sampled_twice.__code__)] is None
+
+    def test_unsampled_code_is_forgotten(self):
+        # type: () -> None
+        policy = collect_types.SequenceSamplingPolicy([5])  # Call 0 is not sampled.
+        backends = [collect_types.BACKEND_SETPROFILE]
+        if collect_types._monitoring is not None:
+            backends.append(collect_types.BACKEND_MONITORING)
+        for backend in backends:
+            collect_types.init_types_collection(sampling_policy=policy, backend=backend)
+            ns = {}  # type: Dict[str, Any]
+            with self.collecting_types():
+                exec('def generated(x):\n    return x\n', ns)
+                ns['generated'](1)
+                key = id(ns['generated'].__code__)
+                assert key in collect_types.sampling_counters
+                del ns['generated']
+                gc.collect()
+                # Its counter would otherwise be used by a new code object with the same ID.
+                assert key not in collect_types.sampling_counters
+
+
+def saturating(arg):
+    # type: (Any) -> Any
+    return [arg]
+
+
+class TestSaturation(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestSaturation, self).setUp()
+        collect_types.collected_args = {}
+        collect_types.collected_signatures = {}
+        collect_types.num_samples = {}
+        collect_types.sampling_counters = {}
+        collect_types.call_pending = set()
+
+    def tearDown(self):
+        # type: () -> None
+        # Reset the settings, then remove the hooks.
+        collect_types.init_types_collection()
+        super(TestSaturation, self).tearDown()
+
+    def samples(self):
+        # type: () -> int
+        return sum(samples for key, samples in collect_types.num_samples.items()
+                   if key.func_name == 'saturating')
+
+    def test_stable_signatures(self):
+        # type: () -> None
+        # Buffers of one event are processed right away, so the consumer's
+        # feedback applies to the next call.
+        collect_types.init_types_collection(flush_size=1, stable_samples=2)
+        collect_types.resume()
+        for _ in range(3):
+            saturating(1)
+        saturating('x')  # Not sampled; the signatures were stable.
+        collect_types.pause()
+        assert self.samples() == 3
+        assert self.raw_type_comments('saturating') == ['(int) -> List[int]']
+        assert collect_types.sampling_counters[id(saturating.__code__)] is None
+        # Resuming doesn't forget saturated functions.
+        collect_types.resume()
+        saturating('x')
+        collect_types.pause()
+        assert self.samples() == 3
+
+    def test_new_signature_resets_count(self):
+        # type: () -> None
+        collect_types.init_types_collection(flush_size=1, stable_samples=2)
+        collect_types.resume()
+        for arg in (1, 2, 'x', 'y', 3, 4):
+            saturating(arg)
+        collect_types.pause()
+        assert self.samples() == 5
+        assert self.raw_type_comments('saturating') == ['(int) -> List[int]',
+                                                        '(str) -> List[str]']
+
+    def test_maximum_signatures(self):
+        # type: () -> None
+        policy = collect_types.SequenceSamplingPolicy(range(100))
+        collect_types.init_types_collection(flush_size=1, stable_samples=100,
+                                            sampling_policy=policy)
+        collect_types.resume()
+        for i in range(collect_types.MAX_ITEMS_PER_FUNCTION + 2):
+            saturating((i,) * i)
+        collect_types.pause()
+        assert self.samples() == collect_types.MAX_ITEMS_PER_FUNCTION
+
+    def test_detach_when_saturated(self):
+        # type: () -> None
+        collect_types.init_types_collection(flush_size=1, stable_samples=1,
+                                            detach_when_saturated=True)
+        hook = sys.getprofile()
+        collect_types.resume()
+        saturating(1)
+        saturating(2)
+        # The hook removes itself from this thread on its next event.
+        saturating(3)
+        assert sys.getprofile() is None
+        collect_types.resume()
+        assert sys.getprofile() is hook
+        collect_types.pause()
+        assert self.samples() == 2
+
+    @unittest.skipIf(collect_types._monitoring is None, 'sys.monitoring requires Python 3.12')
+    def test_detach_monitoring(self):
+        # type: () -> None
+        monitoring = collect_types._monitoring
+        tool = collect_types.MONITORING_TOOL_ID
+        collect_types.init_types_collection(backend=collect_types.BACKEND_MONITORING, flush_size=1,
+                                            stable_samples=1, detach_when_saturated=True)
+        collect_types.resume()
+        saturating(1)
+        saturating(2)
+        assert monitoring.get_events(tool) == 0
+        collect_types.resume()
+        assert monitoring.get_events(tool) != 0
+        collect_types.pause()
+        assert self.samples() == 2
+
+    def test_bad_arguments(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.init_types_collection(stable_samples=0)
+        with self.assertRaises(ValueError):
+            collect_types.init_types_collection(detach_when_saturated=True)
+
+
+class TestCollectorStats(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestCollectorStats, self).setUp()
+        collect_types.init_types_collection(collect_stats=True)
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestCollectorStats, self).tearDown()
+        collect_types.init_types_collection()
+
+    def test_get_stats(self):
+        # type: () -> None
+
+        def busy(x):
+            # type: (Any) -> Any
+            return x
+
+        with self.collecting_types():
+            for i in range(collect_types.LAST_SAMPLE + 10):
+                busy(i)
+        stats = collect_types.get_stats()
+        num_sampled = len(collect_types.sampling_sequence)
+        assert stats['events_sampled'] == 2 * num_sampled
+        assert stats['events_seen'] > stats['events_sampled']
+        assert stats['events_skipped_saturated'] > 0
+        assert stats['queue_high_water'] >= 1
+        assert stats['hook_seconds'] >= stats['resolve_type_seconds'] > 0
+        assert stats['memory_bytes']['collected_signatures'] > 0
+        assert stats['num_functions'] == 1
+        top = stats['top_functions'][0]
+        assert top['func_name'] == 'busy'
+        assert top['samples'] == num_sampled
+
+    def test_dump_with_stats(self):
+        # type: () -> None
+        with self.collecting_types():
+            foo(1)
+        data = json.loads(collect_types.dumps_stats(include_stats=True))
+        assert [item['func_name'] for item in data['type_info']] == ['foo']
+        assert data['collector_stats']['events_sampled'] == 2
+
+    def test_write_openmetrics(self):
+        # type: () -> None
+        with self.collecting_types():
+            foo(1)
+        f = tempfile.NamedTemporaryFile(suffix='.prom', delete=False)
+        f.close()
+        try:
+            collect_types.write_openmetrics(f.name)
+            with open(f.name) as f2:
+                lines = f2.read().splitlines()
+        finally:
+            os.remove(f.name)
+        assert 'pyannotate_events_total{outcome="sampled"} 2' in lines
+        assert '# TYPE pyannotate_hook_seconds counter' in lines
+        assert any(line.startswith('pyannotate_function_hook_seconds_total{func_name="foo",')
+                   for line in lines)
+        assert lines[-1] == '# EOF'
+
+
+class TestMemoryBudget(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestMemoryBudget, self).setUp()
+        f = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False)
+        f.close()
+        self.spill_filename = f.name
+        self.evictions = dict(collect_types.evictions)
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestMemoryBudget, self).tearDown()
+        collect_types.set_memory_budget()
+        os.remove(self.spill_filename)
+
+    def sample(self, func_name, arg, samples=1):
+        # type: (str, Any, int) -> None
+        key = collect_types.FunctionKey('pkg/mod.py', 1, func_name)
+        resolved = collect_types.ResolvedTypes(pos_args=[collect_types.resolve_type(arg)],
+                                               varargs=None, kwonly_args=[], kwargs=None)
+        for call_id in range(samples):
+            collect_types._process_call(key, call_id, resolved)
+            collect_types._process_return(key, call_id, collect_types.NONE_TYPE)
+
+    def new_evictions(self, kind):
+        # type: (str) -> int
+        return collect_types.evictions[kind] - self.evictions[kind]
+
+    def test_evict_saturated_and_cold_functions(self):
+        # type: () -> None
+        with self.collecting_types():
+            collect_types.set_memory_budget(max_functions=10,
+                                            spill_filename=self.spill_filename)
+            full = [1, 'x', 1.5, None, b'', (), [1], {1}]
+            for arg in full:
+                self.sample('full', arg)
+            for i in range(10):
+                self.sample('f%d' % i, i, samples=2)
+        assert collect_types.collected_signatures[
+            collect_types.FunctionKey('pkg/mod.py', 1, 'f9')]
+        # The 11th function evicted the saturated one and the coldest ones,
+        # down to 90% of the budget.
+        assert len(collect_types.collected_signatures) == 9
+        assert self.new_evictions('saturated') == 1
+        assert self.new_evictions('cold') == 1
+        assert self.new_evictions('spilled') == 2
+        # Evicted data is merged back when dumping.
+        assert [item['func_name'] for item in self.stats] == (
+            ['f%d' % i for i in range(10)] + ['full'])
+        assert self.stats[0]['samples'] == 2
+        assert self.stats[-1]['samples'] == len(full)
+        assert collect_types.get_stats()['evictions'] == collect_types.evictions
+
+    def test_merge_evicted_function_sampled_again(self):
+        # type: () -> None
+        with self.collecting_types():
+            collect_types.set_memory_budget(max_functions=1,
+                                            spill_filename=self.spill_filename)
+            self.sample('f', 1)
+            self.sample('g', 1)
+            self.sample('f', 'x')
+            self.sample('f', 1)
+        [item] = [item for item in self.stats if item['func_name'] == 'f']
+        assert sorted(item['type_comments']) == ['(int) -> None', '(str) -> None']
+        assert item['samples'] == 3
+
+    def test_compact_spill_file(self):
+        # type: () -> None
+        with self.collecting_types():
+            collect_types.set_memory_budget(max_functions=1,
+                                            spill_filename=self.spill_filename)
+            for arg in 1, 'x', 1.5:
+                self.sample('f', arg)
+                self.sample('g', arg)
+            # Each eviction appended a record.
+            with open(self.spill_filename) as f:
+                assert len(f.readlines()) == 5
+        # Dumping merged the records of each function.
+        with open(self.spill_filename) as f:
+            assert sorted(json.loads(line)['func_name'] for line in f) == ['f', 'g']
+        [item] = [item for item in self.stats if item['func_name'] == 'f']
+        assert item['samples'] == 3
+        stats = self.stats
+        self.load_stats()
+        assert self.stats == stats
+
+    def test_read_spill_file_without_data_lock(self):
+        # type: () -> None
+        read_spilled = collect_types._read_spilled
+        locked = []  # type: List[bool]
+
+        def checked_read_spilled(spill_filename, size):
+            # type: (Optional[str], int) -> Dict[collect_types.FunctionKey, Any]
+            locked.append(collect_types._data_lock.locked())
+            return read_spilled(spill_filename, size)
+
+        collect_types._read_spilled = checked_read_spilled
+        try:
+            with self.collecting_types():
+                collect_types.set_memory_budget(max_functions=1,
+                                                spill_filename=self.spill_filename)
+                self.sample('f', 1)
+                self.sample('g', 1)
+        finally:
+            collect_types._read_spilled = read_spilled
+        assert [item['func_name'] for item in self.stats] == ['f', 'g']
+        assert locked == [False]
+
+    def test_evict_without_spill_file(self):
+        # type: () -> None
+        with self.collecting_types():
+            collect_types.set_memory_budget(max_functions=2)
+            for name in 'abc':
+                self.sample(name, 1)
+        # Evicting down to 90% of the budget leaves just the new function.
+        assert [item['func_name'] for item in self.stats] == ['c']
+        assert self.new_evictions('cold') == 2
+        assert self.new_evictions('spilled') == 0
+
+    def test_byte_budget(self):
+        # type: () -> None
+        with self.collecting_types():
+            collect_types.set_memory_budget(max_bytes=1)
+            for i in range(collect_types._SIZE_CHECK_INTERVAL):
+                self.sample('f%d' % i, i)
+        assert len(collect_types.collected_signatures) < collect_types._SIZE_CHECK_INTERVAL
+
+    def test_bad_budget(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.set_memory_budget(max_functions=0)
+        with self.assertRaises(ValueError):
+            collect_types.set_memory_budget(spill_filename=self.spill_filename)
+
+
+class TestSnapshots(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestSnapshots, self).setUp()
+        collect_types.init_types_collection()
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'types.json')
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestSnapshots, self).tearDown()
+        collect_types.stop_snapshots()
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, filename):
+        # type: (str) -> List[collect_types.FunctionData]
+        with open(filename) as f:
+            return json.load(f)
+
+    def test_snapshots_while_running(self):
+        # type: () -> None
+        with self.collecting_types():
+            collect_types.start_snapshots(self.filename, interval=0.01)
+            foo(1)
+            collect_types._task_queue.join()
+            deadline = time.time() + 10
+            while not os.path.exists(self.filename) and time.time() < deadline:
+                time.sleep(0.01)
+            # Collection keeps running while snapshots are written.
+            assert collect_types.running
+            foo('x')
+            collect_types._task_queue.join()
+            collect_types.stop_snapshots()
+        [item] = self.read(self.filename)
+        assert sorted(item['type_comments']) == ['(int) -> List[int]', '(str) -> List[str]']
+        assert os.listdir(self.tmpdir) == ['types.json']
+
+    def test_delta_snapshots(self):
+        # type: () -> None
+        with self.collecting_types():
+            collect_types.start_snapshots(self.filename, interval=1000, delta=True)
+            foo(1)
+            foo(2)
+            collect_types._task_queue.join()
+            collect_types._write_snapshot(self.filename, delta=True)
+            foo(3)  # No new signature; not written.
+            collect_types._task_queue.join()
+            collect_types._write_snapshot(self.filename, delta=True)
+            foo('x')
+            collect_types._task_queue.join()
+            collect_types.stop_snapshots()
+        assert sorted(os.listdir(self.tmpdir)) == ['types.json.0', 'types.json.1']
+        [first] = self.read(self.filename + '.0')
+        assert first['type_comments'] == ['(int) -> List[int]']
+        assert first['samples'] == 2
+        [second] = self.read(self.filename + '.1')
+        assert sorted(second['type_comments']) == ['(int) -> List[int]', '(str) -> List[str]']
+        assert second['samples'] == 2
+
+    def test_delta_snapshots_keep_earlier_ones(self):
+        # type: () -> None
+        for name in 'types.json.0', 'types.json.3', 'types.json.x', 'types.json.0.1.tmp':
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write('[]')
+        with self.collecting_types():
+            collect_types.start_snapshots(self.filename, interval=1000, delta=True)
+            foo(1)
+            collect_types._task_queue.join()
+            collect_types.stop_snapshots()
+        [item] = self.read(self.filename + '.4')
+        assert item['func_name'] == 'foo'
+        # Restarting continues the numbering too.
+        with self.collecting_types():
+            collect_types.start_snapshots(self.filename, interval=1000, delta=True)
+            foo('x')
+            collect_types._task_queue.join()
+            collect_types.stop_snapshots()
+        assert os.path.exists(self.filename + '.5')
+        assert self.read(self.filename + '.3') == []
+
+    def test_bad_interval(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.start_snapshots(self.filename, interval=0)
+
+
+def bar(arg):
+    # type: (Any) -> Any
+    return [arg]
+
+
+class TestOutputFormats(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestOutputFormats, self).setUp()
+        collect_types.init_types_collection()
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.close()
+        self.filename = f.name
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestOutputFormats, self).tearDown()
+        os.remove(self.filename)
+
+    def read(self):
+        # type: () -> bytes
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def test_jsonl(self):
+        # type: () -> None
+        with self.collecting_types():
+            foo(1)
+            bar('x')
+        collect_types.dump_stats(self.filename, format=collect_types.FORMAT_JSONL)
+        lines = self.read().decode('utf-8').splitlines()
+        assert [json.loads(line) for line in lines] == sorted(
+            self.stats, key=lambda item: item['line'])
+        collect_types.dump_stats(self.filename, include_stats=True,
+                                 format=collect_types.FORMAT_JSONL)
+        lines = self.read().decode('utf-8').splitlines()
+        assert len(lines) == 3
+        assert 'collector_stats' in json.loads(lines[-1])
+
+    def test_binary(self):
+        # type: () -> None
+        with self.collecting_types():
+            foo(1)
+            bar('x')
+        collect_types.dump_stats(self.filename, format=collect_types.FORMAT_BINARY)
+        data = self.read()
+        path = self.stats[0]['path'].encode('utf-8')
+        foo_line = foo.__code__.co_firstlineno
+        bar_line = bar.__code__.co_firstlineno
+        assert foo_line < 128 * 128 and bar_line < 128 * 128
+        expected = (formats.BINARY_MAGIC +
+                    b'\x00' + bytes(bytearray([len(path)])) + path +
+                    bytes(bytearray([foo_line & 0x7f | 0x80, foo_line >> 7])) +
+                    b'\x00\x03foo' +
+                    b'\x01\x00\x12(int) -> List[int]' +
+                    b'\x01' +
+                    # The path is written once and then referenced by index.
+                    b'\x01' +
+                    bytes(bytearray([bar_line & 0x7f | 0x80, bar_line >> 7])) +
+                    b'\x00\x03bar' +
+                    b'\x01\x00\x12(str) -> List[str]' +
+                    b'\x01')
+        assert data == expected
+
+    def test_compressed(self):
+        # type: () -> None
+        with self.collecting_types():
+            foo(1)
+        filename = self.filename + '.gz'
+        try:
+            collect_types.dump_stats(filename)
+            with gzip.open(filename, 'rb') as f:
+                assert json.loads(f.read().decode('utf-8')) == self.stats
+            collect_types.dump_stats(filename, format=collect_types.FORMAT_BINARY)
+            with gzip.open(filename, 'rb') as f:
+                assert f.read().startswith(formats.BINARY_MAGIC)
+        finally:
+            os.remove(filename)
+
+    @unittest.skipIf(formats.lzma is None, "lzma is not available")
+    def test_compressed_lzma(self):
+        # type: () -> None
+        with self.collecting_types():
+            foo(1)
+        filename = self.filename + '.xz'
+        try:
+            collect_types.dump_stats(filename, format=collect_types.FORMAT_JSONL)
+            with formats.lzma.open(filename, 'rb') as f:
+                assert json.loads(f.read().decode('utf-8')) == self.stats[0]
+        finally:
+            os.remove(filename)
+
+    def test_load_stats(self):
+        # type: () -> None
+        with self.collecting_types():
+            foo(1)
+            bar('x')
+        for format in collect_types.FORMAT_JSON, collect_types.FORMAT_JSONL:
+            for include_stats in False, True:
+                collect_types.dump_stats(self.filename, include_stats=include_stats,
+                                         format=format)
+                assert collect_types.load_stats(self.filename) == self.stats
+        collect_types.dump_stats(self.filename, format=collect_types.FORMAT_BINARY)
+        assert collect_types.load_stats(self.filename) == self.stats
+        # Compression is detected from the contents, as by pyannotate_tools.
+        filename = self.filename + '.gz'
+        try:
+            collect_types.dump_stats(filename, format=collect_types.FORMAT_BINARY)
+            os.rename(filename, self.filename)
+            assert collect_types.load_stats(self.filename) == self.stats
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    @unittest.skipIf(store.sqlite3 is None, "sqlite3 is not available")
+    def test_sqlite(self):
+        # type: () -> None
+        with self.collecting_types():
+            foo(1)
+            bar('x')
+        stats = self.stats
+        collect_types.dump_stats(self.filename, format=collect_types.FORMAT_SQLITE)
+        assert self.read().startswith(store.SQLITE_MAGIC)
+        assert collect_types.load_stats(self.filename) == stats
+        # Dumping again merges into the store.
+        collect_types.dump_stats(self.filename, format=collect_types.FORMAT_SQLITE)
+        with self.collecting_types():
+            foo('x')
+        collect_types.dump_stats(self.filename, format=collect_types.FORMAT_SQLITE)
+        foo_stats, bar_stats = collect_types.load_stats(self.filename)
+        assert foo_stats['type_comments'] == ['(int) -> List[int]', '(str) -> List[str]']
+        assert foo_stats['samples'] == 3
+        assert bar_stats['samples'] == 2
+        conn = store.sqlite3.connect(self.filename)
+        try:
+            indexes = [row[0] for row in conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")]
+        finally:
+            conn.close()
+        assert sorted(indexes) == [
+            'CREATE INDEX functions_path ON functions (path)',
+            'CREATE INDEX functions_path_func_name ON functions (path, func_name)',
+        ]
+
+    def test_load_empty_stats(self):
+        # type: () -> None
+        with self.collecting_types():
+            pass
+        for format in collect_types.FORMAT_JSON, collect_types.FORMAT_JSONL:
+            for include_stats in False, True:
+                collect_types.dump_stats(self.filename, include_stats=include_stats,
+                                         format=format)
+                assert collect_types.load_stats(self.filename) == []
+
+    def test_bad_format(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.dump_stats(self.filename, format='xml')
+        with self.assertRaises(ValueError):
+            collect_types.dump_stats(self.filename, include_stats=True,
+                                     format=collect_types.FORMAT_BINARY)
+        with self.assertRaises(ValueError):
+            collect_types.dump_stats(self.filename, include_stats=True,
+                                     format=collect_types.FORMAT_SQLITE)
+        with self.assertRaises(ValueError):
+            collect_types.dump_stats(self.filename + '.gz', format=collect_types.FORMAT_SQLITE)
+
+
+def seeded_full(arg):
+    # type: (Any) -> Any
+    return [arg]
+
+
+def seeded_partial(arg):
+    # type: (Any) -> Any
+    return [arg]
+
+
+class TestWarmStart(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestWarmStart, self).setUp()
+        collect_types.init_types_collection()
+        f = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        f.close()
+        self.filename = f.name
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestWarmStart, self).tearDown()
+        collect_types.init_types_collection()
+        os.remove(self.filename)
+
+    def write_seed(self):
+        # type: () -> None
+        with self.collecting_types():
+            seeded_full(1)
+            seeded_partial(1)
+        for item in self.stats:
+            if item['func_name'] == 'seeded_full':
+                item['type_comments'] = ['(C%d) -> None' % i
+                                         for i in range(collect_types.MAX_ITEMS_PER_FUNCTION)]
+        with open(self.filename, 'w') as f:
+            json.dump(self.stats, f)
+
+    def test_warm_start(self):
+        # type: () -> None
+        self.write_seed()
+        collect_types.init_types_collection(seed=self.filename)
+        with self.collecting_types():
+            seeded_full('x')
+            seeded_partial('x')
+        # The saturated function wasn't sampled at all.
+        assert self.raw_type_comments('seeded_full') == []
+        assert self.raw_type_comments('seeded_partial') == ['(str) -> List[str]']
+        [full] = [item for item in self.stats if item['func_name'] == 'seeded_full']
+        assert full['type_comments'] == ['(C%d) -> None' % i
+                                         for i in range(collect_types.MAX_ITEMS_PER_FUNCTION)]
+        assert full['samples'] == 1
+        self.assert_type_comments('seeded_partial', ['(int) -> List[int]',
+                                                     '(str) -> List[str]'])
+        [partial] = [item for item in self.stats if item['func_name'] == 'seeded_partial']
+        assert partial['samples'] == 2
+
+    def test_no_seed(self):
+        # type: () -> None
+        self.write_seed()
+        collect_types.init_types_collection(seed=self.filename)
+        collect_types.init_types_collection()
+        with self.collecting_types():
+            seeded_full('x')
+        self.assert_type_comments('seeded_full', ['(str) -> List[str]'])
+
+
+def sample_in_worker(arg):
+    # type: (Any) -> Any
+    return foo(arg)
+
+
+@unittest.skipUnless(hasattr(os, 'register_at_fork'), "os.register_at_fork() is not available")
+class TestMultipleProcesses(TestBaseClass):
+
+    def setUp(self):
+        # type: () -> None
+        super(TestMultipleProcesses, self).setUp()
+        collect_types.init_types_collection()
+        self.tmpdir = tempfile.mkdtemp()
+        self.pattern = os.path.join(self.tmpdir, 'types.%(pid)d.json')
+
+    def tearDown(self):
+        # type: () -> None
+        super(TestMultipleProcesses, self).tearDown()
+        collect_types._shard_pattern = None
+        shutil.rmtree(self.tmpdir)
+
+    def read_shards(self):
+        # type: () -> Dict[int, List[collect_types.FunctionData]]
+        shards = {}
+        for name in os.listdir(self.tmpdir):
+            with open(os.path.join(self.tmpdir, name)) as f:
+                shards[int(name.split('.')[1])] = json.load(f)
+        return shards
+
+    def test_fork(self):
+        # type: () -> None
+        filename = os.path.join(self.tmpdir, 'child.json')
+        with self.collecting_types():
+            foo(1)
+            pid = os.fork()
+            if pid == 0:
+                exit_code = 1
+                try:
+                    foo('x')
+                    collect_types.pause()
+                    collect_types.dump_stats(filename)
+                    exit_code = 0
+                finally:
+                    os._exit(exit_code)
+            _, status = os.waitpid(pid, 0)
+        assert status == 0
+        self.assert_type_comments('foo', ['(int) -> List[int]'])
+        with open(filename) as f:
+            [item] = json.load(f)
+        # The child has only the data it collected itself.
+        assert item['type_comments'] == ['(str) -> List[str]']
+        assert item['samples'] == 1
+
+    def test_shards_of_pool_workers(self):
+        # type: () -> None
+        import multiprocessing
+        collect_types.dump_shards_at_exit(self.pattern)
+        with self.collecting_types():
+            # Workers collect types if collection was running when they were forked.
+            pool = multiprocessing.get_context('fork').Pool(2)
+            pool.map(sample_in_worker, [1, 2, 3, 4])
+            pool.close()
+            pool.join()
+        shards = self.read_shards()
+        assert 1 <= len(shards) <= 2
+        assert os.getpid() not in shards
+        samples = 0
+        for shard in shards.values():
+            for item in shard:
+                if item['func_name'] == 'foo':
+                    assert item['type_comments'] == ['(int) -> List[int]']
+                    samples += item['samples']
+        assert samples == 4
+
+    def test_environment_bootstrap(self):
+        # type: () -> None
+        module = os.path.join(self.tmpdir, 'child_module.py')
+        with open(module, 'w') as f:
+            f.write('def child_func(x):\n    return x\n')
+        env = dict(os.environ)
+        env[collect_types.SHARD_ENV_VAR] = self.pattern
+        env['PYTHONPATH'] = os.pathsep.join([collect_types.TOP_DIR, self.tmpdir])
+        code = ('import pyannotate_runtime.collect_types, child_module\n'
+                'child_module.child_func(1)\n')
+        subprocess.check_call([sys.executable, '-c', code], cwd=self.tmpdir, env=env)
+        os.remove(module)
+        [shard] = self.read_shards().values()
+        [item] = [item for item in shard if item['func_name'] == 'child_func']
+        assert item['type_comments'] == ['(int) -> int']
+
+    def test_bad_pattern(self):
+        # type: () -> None
+        with self.assertRaises(ValueError):
+            collect_types.dump_shards_at_exit('types.json')
+        with self.assertRaises(ValueError):
+            collect_types.dump_shards_at_exit('types.%(pod)d.json')
@@ -0,0 +1,163 @@
+"""Tests for import_hook"""
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+)
+
+import ast
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from typing import Any, Dict, List
+
+from pyannotate_runtime import collect_types
+
+if sys.version_info >= (3,):
+    from pyannotate_runtime import import_hook
+
+# pylint:disable=missing-docstring
+
+MODULE_SOURCE = '''\
+"""A module to instrument."""
+from __future__ import print_function
+
+
+def plain(x, y=None):
+    return [x]
+
+
+def gen(n):
+    yield n
+
+
+async def coro(x):
+    return x
+
+
+class Thing(object):
+
+    def method(self, x):
+        def nested(y):
+            return y
+        return nested(x)
+
+    @staticmethod
+    def static(x):
+        return x
+
+    @property
+    def prop(self):
+        return 1.5
+'''
+
+
+@unittest.skipIf(sys.version_info < (3,), 'the import hook requires Python 3')
+class TestInstrument(unittest.TestCase):
+
+    def test_decorators_added(self):
+        # type: () -> None
+        tree = ast.parse(MODULE_SOURCE)
+        assert import_hook.instrument(tree) == 4
+        # The import goes after the docstring and __future__ imports.
+        import_node = tree.body[2]
+        assert isinstance(import_node, ast.ImportFrom)
+        assert import_node.module == 'pyannotate_runtime.collect_types'
+        functions = dict((node.name, node) for node in ast.walk(tree)
+                         if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)))
+
+        def decorators(name):
+            # type: (str) -> List[str]
+            return [ast.dump(d) for d in functions[name].decorator_list]
+
+        trace = ast.dump(ast.Name(id=import_hook.TRACE_NAME, ctx=ast.Load()))
+        assert decorators('plain') == [trace]
+        assert decorators('method') == [trace]
+        assert decorators('static')[-1] == trace
+        assert decorators('prop')[-1] == trace
+        assert decorators('gen') == []
+        assert decorators('coro') == []
+        assert decorators('nested') == []
+
+    def test_nothing_to_instrument(self):
+        # type: () -> None
+        tree = ast.parse('x = 1\n')
+        assert import_hook.instrument(tree) == 0
+        assert len(tree.body) == 1
+
+
+@unittest.skipIf(sys.version_info < (3,), 'the import hook requires Python 3')
+class TestImportHook(unittest.TestCase):
+
+    def setUp(self):
+        # type: () -> None
+        self.tmpdir = tempfile.mkdtemp()
+        for name, source in [('hooktarget/__init__.py', ''),
+                             ('hooktarget/mod.py', MODULE_SOURCE),
+                             ('hookother.py', MODULE_SOURCE)]:
+            path = os.path.join(self.tmpdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(source)
+        sys.path.insert(0, self.tmpdir)
+        collect_types.init_types_collection(backend=collect_types.BACKEND_TARGETED)
+
+    def tearDown(self):
+        # type: () -> None
+        collect_types.stop_types_collection()
+        import_hook.uninstall_import_hook()
+        sys.path.remove(self.tmpdir)
+        for name in list(sys.modules):
+            if name.startswith(('hooktarget', 'hookother')):
+                del sys.modules[name]
+        shutil.rmtree(self.tmpdir)
+
+    def test_import_hook(self):
+        # type: () -> None
+        import_hook.install_import_hook(['hooktarget.*'])
+        namespace = {}  # type: Dict[str, Any]
+        exec('import hooktarget.mod as mod\nimport hookother as other', namespace)
+        mod, other = namespace['mod'], namespace['other']
+        assert getattr(mod.plain, '_pyannotate_traced', False)
+        assert not getattr(other.plain, '_pyannotate_traced', False)
+        collect_types.collected_signatures.clear()
+        collect_types.num_samples.clear()
+        with collect_types.collect():
+            mod.plain(1)
+            mod.Thing().method('x')
+            mod.Thing.static(1.5)
+            assert mod.Thing().prop == 1.5
+            list(mod.gen(1))
+            other.plain(1)
+        stats = json.loads(collect_types.dumps_stats())
+        comments = dict((item['func_name'], item['type_comments']) for item in stats)
+        assert comments == {'plain': ['(int, None) -> List[int]'],
+                            'Thing.method': ['(str) -> str'],
+                            'static': ['(float) -> float'],
+                            'prop': ['() -> float']}
+        assert all(item['path'].endswith(os.path.join('hooktarget', 'mod.py'))
+                   for item in stats)
+        line = MODULE_SOURCE.splitlines().index('def plain(x, y=None):') + 1
+        assert [item['line'] for item in stats if item['func_name'] == 'plain'] == [line]
+
+    def test_exclude(self):
+        # type: () -> None
+        import_hook.install_import_hook(['hooktarget*'], exclude=['hooktarget.mod'])
+        namespace = {}  # type: Dict[str, Any]
+        exec('import hooktarget.mod as mod', namespace)
+        assert not getattr(namespace['mod'].plain, '_pyannotate_traced', False)
+
+    def test_uninstall(self):
+        # type: () -> None
+        finder = import_hook.install_import_hook(['hooktarget.*'])
+        assert finder in sys.meta_path
+        import_hook.uninstall_import_hook()
+        assert finder not in sys.meta_path
+        namespace = {}  # type: Dict[str, Any]
+        exec('import hooktarget.mod as mod', namespace)
+        assert not getattr(namespace['mod'].plain, '_pyannotate_traced', False)
@@ -2,17 +2,22 @@ from __future__ import print_function
 
 import argparse
 import logging
+import sys
 
 from lib2to3.main import StdoutRefactoringTool
 
 from typing import Any, Dict, List, Optional
 
+from pyannotate_tools.annotations import merge
 from pyannotate_tools.annotations.main import generate_annotations_json_string
+from pyannotate_tools.annotations.store import is_store
 from pyannotate_tools.fixes.fix_annotate_json import FixAnnotateJson
 
-parser = argparse.ArgumentParser()
+parser = argparse.ArgumentParser(
+    epilog="Run 'pyannotate merge --help' for merging type_info files.")
 parser.add_argument('--type-info', default='type_info.json', metavar="FILE",
-                    help="JSON input file (default type_info.json)")
+                    help="JSON input file, as written by dump_stats(), possibly "
+                    "compressed, or an SQLite store (default type_info.json)")
 parser.add_argument('-p', '--print-function', action='store_true',
                     help="Assume print is a function")
 parser.add_argument('-w', '--write', action='store_true',
@@ -29,6 +34,11 @@ parser.add_argument('files', nargs='*',
 
 def main(args_override=None):
     # type: (Optional[List[str]]) -> None
+    argv = sys.argv[1:] if args_override is None else args_override
+    if argv[:1] == ['merge']:
+        merge.main(argv[1:])
+        return
+
     # Parse command line.
     args = parser.parse_args(args_override)
     if not args.files:
@@ -38,12 +48,16 @@ def main(args_override=None):
     level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(format='%(message)s', level=level)
 
-    # Run pass 2 with output into a variable.
     infile = args.type_info
-    data = generate_annotations_json_string(infile)  # type: List[Any]
+    if is_store(infile):
+        # Run passes 2 and 3 file by file, querying the store for each file.
+        FixAnnotateJson.init_stub_store(infile, args.files[0])
+    else:
+        # Run pass 2 with output into a variable.
+        data = generate_annotations_json_string(infile)  # type: List[Any]
 
-    # Run pass 3 with input from that variable.
-    FixAnnotateJson.init_stub_json_from_data(data, args.files[0])
+        # Run pass 3 with input from that variable.
+        FixAnnotateJson.init_stub_json_from_data(data, args.files[0])
     fixers = ['pyannotate_tools.fixes.fix_annotate_json']
     flags = {'print_function': args.print_function}
     rt = StdoutRefactoringTool(
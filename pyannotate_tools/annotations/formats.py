@@ -0,0 +1,191 @@
+"""Reading and writing the files dumped by collect_types.dump_stats().
+
+A file holds a JSON list of RawEntry items (or an object with the list
+under 'type_info' and statistics under 'collector_stats'), JSON Lines with
+a RawEntry per line (and maybe a last line with statistics), the binary
+format below, or an SQLite store (see pyannotate_tools.annotations.store).
+Any but a store may be compressed with gzip or lzma.
+
+This is shared by pyannotate_runtime and pyannotate_tools, so that both
+detect formats and compression the same way: from the contents of a file,
+not its name.
+"""
+
+import gzip
+import json
+
+from typing import Any, Dict, Iterable, List, Optional
+try:
+    from typing import Text
+except ImportError:
+    # In Python 3.5.1 stdlib, typing.py does not define Text
+    Text = str  # type: ignore
+try:
+    import lzma
+except ImportError:
+    # Python 2 has no lzma module
+    lzma = None  # type: ignore
+
+from pyannotate_tools.annotations.store import is_store, read_store
+
+# Collect (and merge) at most this many type comments for each function.
+MAX_ITEMS_PER_FUNCTION = 8
+
+# The binary format starts with this header, followed by a record per function:
+# path, line, function name, number of type comments, type comments and
+# samples.  Numbers are unsigned LEB128 varints.  Strings are written as a
+# reference: 0 followed by the length and UTF-8 bytes for a string seen for the
+# first time, or 1 + the index of a string written before.
+BINARY_MAGIC = b'PYANNOTATE\x00\x01'
+
+# Headers of gzip and xz (lzma) compressed files.
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+
+def open_output(path, name=None):
+    # type: (str, Optional[str]) -> Any
+    """Open a file for writing bytes.
+
+    The data is compressed with gzip or lzma if the file name (or name, if
+    given) ends with .gz or .xz.
+    """
+    name = name or path
+    if name.endswith('.gz'):
+        return gzip.open(path, 'wb')
+    elif name.endswith('.xz'):
+        if lzma is None:
+            raise ValueError('lzma compression is not available: %s' % name)
+        return lzma.open(path, 'wb')
+    return open(path, 'wb')
+
+
+def _encode_varint(out, n):
+    # type: (bytearray, int) -> None
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _encode_string(out, strings, s):
+    # type: (bytearray, Dict[Text, int], Text) -> None
+    index = strings.get(s)
+    if index is not None:
+        _encode_varint(out, index + 1)
+    else:
+        strings[s] = len(strings)
+        data = s.encode('utf-8')
+        _encode_varint(out, 0)
+        _encode_varint(out, len(data))
+        out.extend(data)
+
+
+def write_binary(f, items):
+    # type: (Any, Iterable[Dict[str, Any]]) -> None
+    """Write RawEntry items in the binary format to a file opened in binary mode."""
+    f.write(BINARY_MAGIC)
+    strings = {}  # type: Dict[Text, int]
+    for item in items:
+        out = bytearray()
+        _encode_string(out, strings, item['path'])
+        _encode_varint(out, item['line'])
+        _encode_string(out, strings, item['func_name'])
+        _encode_varint(out, len(item['type_comments']))
+        for comment in item['type_comments']:
+            _encode_string(out, strings, comment)
+        _encode_varint(out, item['samples'])
+        f.write(bytes(out))
+
+
+def decode_binary(data):
+    # type: (bytearray) -> List[Dict[str, Any]]
+    """Decode the binary format written by write_binary()."""
+    pos = [len(BINARY_MAGIC)]
+    strings = []  # type: List[Text]
+
+    def varint():
+        # type: () -> int
+        result = shift = 0
+        while True:
+            byte = data[pos[0]]
+            pos[0] += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def string():
+        # type: () -> Text
+        index = varint()
+        if index:
+            return strings[index - 1]
+        length = varint()
+        s = data[pos[0]:pos[0] + length].decode('utf-8')
+        pos[0] += length
+        strings.append(s)
+        return s
+
+    result = []  # type: List[Dict[str, Any]]
+    while pos[0] < len(data):
+        path = string()
+        line = varint()
+        func_name = string()
+        type_comments = [string() for _ in range(varint())]
+        result.append({'path': path,
+                       'line': line,
+                       'func_name': func_name,
+                       'type_comments': type_comments,
+                       'samples': varint()})
+    return result
+
+
+def read_type_info(path):
+    # type: (str) -> bytes
+    """Read a file written by dump_stats(), decompressing it if necessary."""
+    with open(path, 'rb') as f:
+        magic = f.read(len(XZ_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        f = gzip.open(path, 'rb')
+    elif magic.startswith(XZ_MAGIC):
+        if lzma is None:
+            raise ValueError('%s: lzma compression is not available' % path)
+        f = lzma.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    with f:
+        return f.read()
+
+
+def load_entries(path, function_path=None):
+    # type: (str, Optional[str]) -> Any
+    """Load the RawEntry items from a file in any format written by dump_stats().
+
+    Statistics included in the file are ignored.  Only the functions in
+    function_path are read from an SQLite store, if given; the caller
+    filters the other formats.
+    """
+    if is_store(path):
+        return read_store(path, function_path)
+    data = read_type_info(path)
+    if data.startswith(BINARY_MAGIC):
+        return decode_binary(bytearray(data))
+    text = data.decode('utf-8')
+    if not text.strip():
+        # JSON Lines without any function.
+        return []
+    if not text.lstrip().startswith('{'):
+        return json.loads(text)
+    try:
+        obj = json.loads(text)
+    except ValueError:
+        # JSON Lines: one RawEntry per line (and maybe a line with statistics).
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+        return [entry for entry in entries
+                if not (isinstance(entry, dict) and 'collector_stats' in entry)]
+    if isinstance(obj, dict) and 'type_info' in obj:
+        return obj['type_info']
+    # A JSON Lines file with a single line (only statistics if nothing was collected).
+    if isinstance(obj, dict) and 'collector_stats' in obj:
+        return []
+    return [obj]
@@ -2,7 +2,7 @@
 
 import json
 
-from typing import List
+from typing import List, Optional
 from mypy_extensions import TypedDict
 
 from pyannotate_tools.annotations.types import ARG_STAR, ARG_STARSTAR
@@ -22,16 +22,19 @@ FunctionData = TypedDict('FunctionData', {'path': str,
                                           'samples': int})
 
 
-def generate_annotations_json_string(source_path):
-    # type: (str) -> List[FunctionData]
+def generate_annotations_json_string(source_path, function_path=None):
+    # type: (str, Optional[str]) -> List[FunctionData]
     """Produce annotation data JSON file from a JSON file with runtime-collected types.
 
     Data formats:
 
-    * The source JSON is a list of pyannotate_tools.annotations.parse.RawEntry items.
+    * The source JSON is a list of pyannotate_tools.annotations.parse.RawEntry items
+      (or anything else accepted by parse_json(), such as an SQLite store).
     * The output JSON is a list of FunctionData items.
+
+    If function_path is given, only the functions in that file are included.
     """
-    items = parse_json(source_path)
+    items = parse_json(source_path, function_path)
     results = []
     for item in items:
         arg_types, return_type = infer_annotation(item.type_comments)
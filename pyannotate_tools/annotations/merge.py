@@ -0,0 +1,178 @@
+"""Merge type_info files, such as the shards dumped by multiple processes.
+
+Type comments are united per function (up to the same maximum number of
+comments per function as when collecting) and samples are summed.  Only
+the merged data is kept in memory, so memory use is bounded by the number
+of distinct functions rather than by the total size of the input files.
+
+With --format sqlite, the merged data is merged in turn into the SQLite
+store given with -o, which is created if it doesn't exist yet.
+
+Usage: pyannotate merge [-o OUTPUT] [--format FORMAT] [-j N] FILE_OR_DIR ...
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+from typing import IO, Any, Dict, Iterator, List, Optional, Tuple
+
+from pyannotate_tools.annotations.formats import MAX_ITEMS_PER_FUNCTION, open_output
+from pyannotate_tools.annotations.parse import RawEntry, parse_json
+from pyannotate_tools.annotations.store import write_store
+
+# Merged data: (path, line, func_name) -> [type comments, samples]
+FunctionKey = Tuple[str, int, str]
+MergedData = Dict[FunctionKey, List[Any]]
+
+FORMAT_JSON = 'json'
+FORMAT_JSONL = 'jsonl'
+FORMAT_SQLITE = 'sqlite'
+
+
+def merge_function(merged, key, type_comments, samples):
+    # type: (MergedData, FunctionKey, List[str], int) -> None
+    """Merge the type comments and samples of a function into merged."""
+    entry = merged.get(key)
+    if entry is None:
+        entry = merged[key] = [[], 0]
+    comments = entry[0]  # type: List[str]
+    for comment in type_comments:
+        if len(comments) >= MAX_ITEMS_PER_FUNCTION:
+            break
+        if comment not in comments:
+            comments.append(comment)
+    entry[1] += samples
+
+
+def merge_data(merged, other):
+    # type: (MergedData, MergedData) -> None
+    """Merge the result of another merge into merged."""
+    for key, (type_comments, samples) in other.items():
+        merge_function(merged, key, type_comments, samples)
+
+
+def merge_files(paths):
+    # type: (List[str]) -> MergedData
+    """Merge type_info files, in any format read by parse_json()."""
+    merged = {}  # type: MergedData
+    for path in paths:
+        for item in parse_json(path):
+            merge_function(merged, (item.path, item.line, item.func_name),
+                           item.type_comments, item.samples)
+    return merged
+
+
+def merge_type_info(paths, processes=1):
+    # type: (List[str], int) -> MergedData
+    """Merge type_info files, using a pool of processes if processes > 1.
+
+    Each process merges a contiguous run of files, and the partial results
+    are merged in order, so the result doesn't depend on the number of
+    processes (unless more than MAX_ITEMS_PER_FUNCTION distinct comments
+    are found for a function; the first ones in file order are kept).
+    """
+    processes = min(processes, len(paths))
+    if processes <= 1:
+        return merge_files(paths)
+    size = (len(paths) + processes - 1) // processes
+    chunks = [paths[i:i + size] for i in range(0, len(paths), size)]
+    merged = {}  # type: MergedData
+    pool = multiprocessing.Pool(processes)
+    try:
+        for partial in pool.imap(merge_files, chunks):
+            merge_data(merged, partial)
+    finally:
+        pool.close()
+        pool.join()
+    return merged
+
+
+def iter_merged(merged):
+    # type: (MergedData) -> Iterator[RawEntry]
+    """Generate the merged data for each function, sorted by location."""
+    for key in sorted(merged):
+        path, line, func_name = key
+        type_comments, samples = merged[key]
+        yield {
+            'path': path,
+            'line': line,
+            'func_name': func_name,
+            'type_comments': type_comments,
+            'samples': samples,
+        }
+
+
+def write_merged(merged, f, format=FORMAT_JSON):
+    # type: (MergedData, IO[str], str) -> None
+    """Write merged data as a JSON list (one function per line) or as JSON Lines."""
+    # pylint: disable=redefined-builtin
+    if format == FORMAT_JSONL:
+        for item in iter_merged(merged):
+            f.write(json.dumps(item, sort_keys=True) + '\n')
+        return
+    f.write('[')
+    separator = '\n'
+    for item in iter_merged(merged):
+        f.write(separator + json.dumps(item, sort_keys=True))
+        separator = ',\n'
+    f.write('\n]\n')
+
+
+class _EncodingWriter(object):
+    """Write text to a binary (e.g. compressed) file as UTF-8."""
+
+    def __init__(self, f):
+        # type: (Any) -> None
+        self.f = f
+
+    def write(self, text):
+        # type: (str) -> None
+        self.f.write(text.encode('utf-8'))
+
+
+def expand_paths(paths):
+    # type: (List[str]) -> List[str]
+    """Replace directories with the (sorted) files in them."""
+    result = []  # type: List[str]
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                 if os.path.isfile(os.path.join(path, name))))
+        else:
+            result.append(path)
+    return result
+
+
+parser = argparse.ArgumentParser(prog='pyannotate merge',
+                                 description="Merge type_info files (e.g. per-process shards)")
+parser.add_argument('-o', '--output', metavar="FILE",
+                    help="Output file, compressed if it ends with .gz or .xz "
+                    "(default standard output)")
+parser.add_argument('--format', choices=[FORMAT_JSON, FORMAT_JSONL, FORMAT_SQLITE],
+                    default=FORMAT_JSON,
+                    help="Output format (default json); sqlite merges into the "
+                    "output file")
+parser.add_argument('-j', '--processes', type=int, default=1, metavar="N",
+                    help="Use N parallel processes (default no parallelism)")
+parser.add_argument('files', nargs='+',
+                    help="type_info files, and directories containing them")
+
+
+def main(args_override=None):
+    # type: (Optional[List[str]]) -> None
+    args = parser.parse_args(args_override)
+    if args.format == FORMAT_SQLITE and not args.output:
+        parser.error("--format sqlite requires an output file")
+    merged = merge_type_info(expand_paths(args.files), args.processes)
+    if args.format == FORMAT_SQLITE:
+        write_store(args.output, iter_merged(merged), MAX_ITEMS_PER_FUNCTION)
+    elif args.output:
+        with open_output(args.output) as f:
+            write_merged(merged, _EncodingWriter(f), args.format)  # type: ignore
+    else:
+        write_merged(merged, sys.stdout, args.format)
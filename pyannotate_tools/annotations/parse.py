@@ -5,11 +5,10 @@ Parse JSON data and also parse type comment strings into type objects.
 The collect_types tool is in pyannotate_runtime/collect_types.py.
 """
 
-import json
 import re
 import sys
 
-from typing import Any, List, Mapping, Set, Tuple
+from typing import Any, List, Mapping, Optional, Set, Tuple
 try:
     from typing import Text
 except ImportError:
@@ -17,6 +16,7 @@ except ImportError:
     Text = str  # type: ignore
 from mypy_extensions import NoReturn, TypedDict
 
+from pyannotate_tools.annotations.formats import load_entries
 from pyannotate_tools.annotations.types import (
     AbstractType,
     AnyType,
@@ -46,6 +46,7 @@ TYPE_FIXUPS = {
     'long': 'int',
     'unicode': 'Text',
     'generator': 'Iterator',
+    'async_generator': 'AsyncIterator',
     'listiterator': 'Iterator',
     'instancemethod': 'Callable',
     'itertools.imap': 'Iterator',
@@ -90,14 +91,21 @@ class ParseError(Exception):
         self.comment = comment
 
 
-def parse_json(path):
-    # type: (str) -> List[FunctionInfo]
+def parse_json(path, function_path=None):
+    # type: (str, Optional[str]) -> List[FunctionInfo]
     """Deserialize a JSON file containing runtime collected types.
 
-    The input JSON is expected to to have a list of RawEntry items.
+    The input JSON is expected to to have a list of RawEntry items, or an
+    object with such a list under 'type_info' (as written by
+    dump_stats(..., include_stats=True)).  JSON Lines files with a RawEntry
+    per line and the binary format of dump_stats() are also accepted, and
+    any of these may be compressed with gzip or lzma.  So are SQLite stores
+    (see pyannotate_tools.annotations.store).
+
+    If function_path is given, only the functions whose path is
+    function_path are returned (and only those are read from a store).
     """
-    with open(path) as f:
-        data = json.load(f)  # type: List[RawEntry]
+    data = load_entries(path, function_path)
     result = []
 
     def assert_type(value, typ):
@@ -121,6 +129,8 @@ def parse_json(path):
         for comment in item['type_comments']:
             assert_type(comment, Text)
         assert_type(item['samples'], int)
+        if function_path is not None and item['path'] != function_path:
+            continue
         info = FunctionInfo(encode(item['path']),
                             item['line'],
                             encode(item['func_name']),
@@ -247,7 +257,8 @@ class Parser(object):
                     arg_types.append(Argument(arg_type, ARG_STAR))
                     stars_seen.add('*')
             else:
-                if stars_seen:
+                # Keyword-only arguments may follow *args, but nothing follows **kwargs.
+                if '**' in stars_seen:
                     self.fail()
                 arg_type = self.parse_type()
                 arg_types.append(Argument(arg_type, ARG_POS))
@@ -0,0 +1,122 @@
+"""SQLite type stores, as written by dump_stats(..., format=FORMAT_SQLITE).
+
+A store has a row per function in the 'functions' table and a row per type
+comment in the 'signatures' table, so that the functions of a single file
+can be read without loading the rest, and new data can be merged into a
+store in place (type comments are united and samples added).
+"""
+
+try:
+    import sqlite3
+except ImportError:
+    # Python may be built without sqlite3
+    sqlite3 = None  # type: ignore
+
+from typing import Any, Dict, Iterable, List, Optional
+
+# Header of SQLite database files.
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS functions (
+           id INTEGER PRIMARY KEY,
+           path TEXT NOT NULL,
+           line INTEGER NOT NULL,
+           func_name TEXT NOT NULL,
+           samples INTEGER NOT NULL,
+           UNIQUE (path, line, func_name))""",
+    """CREATE TABLE IF NOT EXISTS signatures (
+           function_id INTEGER NOT NULL REFERENCES functions (id),
+           type_comment TEXT NOT NULL,
+           PRIMARY KEY (function_id, type_comment))""",
+    "CREATE INDEX IF NOT EXISTS functions_path ON functions (path)",
+    "CREATE INDEX IF NOT EXISTS functions_path_func_name ON functions (path, func_name)",
+]
+
+# Wait this long (in seconds) for other processes writing to the store.
+TIMEOUT = 60.0
+
+
+def _connect(path):
+    # type: (str) -> Any
+    if sqlite3 is None:
+        raise ValueError('sqlite3 is not available: %s' % path)
+    return sqlite3.connect(path, timeout=TIMEOUT)
+
+
+def is_store(path):
+    # type: (str) -> bool
+    """Return whether the file is an SQLite database."""
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def read_store(path, function_path=None):
+    # type: (str, Optional[str]) -> List[Dict[str, Any]]
+    """Read the functions in a store (only those in function_path, if given) as RawEntry items.
+
+    The type comments of each function are in the order they were added.
+    """
+    query = ("SELECT f.id, f.path, f.line, f.func_name, f.samples, s.type_comment "
+             "FROM functions f LEFT JOIN signatures s ON s.function_id = f.id")
+    params = ()  # type: tuple
+    if function_path is not None:
+        query += " WHERE f.path = ?"
+        params = (function_path,)
+    query += " ORDER BY f.path, f.line, f.func_name, s.rowid"
+    result = []  # type: List[Dict[str, Any]]
+    last_id = None
+    conn = _connect(path)
+    try:
+        for function_id, fpath, line, func_name, samples, comment in conn.execute(query, params):
+            if function_id != last_id:
+                last_id = function_id
+                result.append({'path': fpath,
+                               'line': line,
+                               'func_name': func_name,
+                               'type_comments': [],
+                               'samples': samples})
+            if comment is not None:
+                result[-1]['type_comments'].append(comment)
+    finally:
+        conn.close()
+    return result
+
+
+def upsert(conn, item, max_items):
+    # type: (Any, Dict[str, Any], int) -> None
+    """Merge the data of a function into a store (at most max_items type comments)."""
+    key = (item['path'], item['line'], item['func_name'])
+    row = conn.execute("SELECT id FROM functions WHERE path = ? AND line = ? AND func_name = ?",
+                       key).fetchone()
+    if row is None:
+        function_id = conn.execute(
+            "INSERT INTO functions (path, line, func_name, samples) VALUES (?, ?, ?, ?)",
+            key + (item['samples'],)).lastrowid
+        count = 0
+    else:
+        function_id = row[0]
+        conn.execute("UPDATE functions SET samples = samples + ? WHERE id = ?",
+                     (item['samples'], function_id))
+        count = conn.execute("SELECT COUNT(*) FROM signatures WHERE function_id = ?",
+                             (function_id,)).fetchone()[0]
+    for comment in item['type_comments']:
+        if count >= max_items:
+            break
+        count += conn.execute(
+            "INSERT OR IGNORE INTO signatures (function_id, type_comment) VALUES (?, ?)",
+            (function_id, comment)).rowcount
+
+
+def write_store(path, items, max_items):
+    # type: (str, Iterable[Dict[str, Any]], int) -> None
+    """Merge RawEntry items into a store, creating it if necessary, in a single transaction."""
+    conn = _connect(path)
+    try:
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            for item in items:
+                upsert(conn, item, max_items)
+    finally:
+        conn.close()
@@ -18,6 +18,8 @@ else:
 from typing import Iterator, List
 
 from pyannotate_tools.annotations.__main__ import main as dunder_main
+from pyannotate_tools.annotations.store import write_store
+from pyannotate_tools.fixes.fix_annotate_json import FixAnnotateJson
 
 
 class TestDunderMain(unittest.TestCase):
@@ -54,8 +56,16 @@ class TestDunderMain(unittest.TestCase):
             lines = [line.strip() for line in f.readlines()]
         assert '# type: (int, int) -> int' in lines
 
-    def prototype_test(self, write):
-        # type: (bool) -> None
+    def test_store(self):
+        # type: () -> None
+        self.addCleanup(setattr, FixAnnotateJson, 'stub_store', None)
+        self.prototype_test(write=True, store=True)
+        with open('gcd.py') as f:
+            lines = [line.strip() for line in f.readlines()]
+        assert '# type: (int, int) -> int' in lines
+
+    def prototype_test(self, write, store=False):
+        # type: (bool, bool) -> None
         type_info = [
             {
                 "path": "gcd.py",
@@ -96,9 +106,15 @@ Refactored gcd.py
 Files that were modified:
 gcd.py
 """
-        self.write_file('type_info.json', json.dumps(type_info))
         self.write_file('gcd.py', source_text)
-        args = ['gcd.py']
+        if store:
+            # Only the rows of gcd.py are read from the store.
+            other = dict(type_info[0], path='other.py', type_comments=['(str, str) -> str'])
+            write_store('type_info.sqlite', [type_info[0], other], 8)
+            args = ['--type-info', 'type_info.sqlite', 'gcd.py']
+        else:
+            self.write_file('type_info.json', json.dumps(type_info))
+            args = ['gcd.py']
         if write:
             args.append('-w')
         self.main_test(args,
@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from typing import Any, List
+
+from pyannotate_tools.annotations.__main__ import main as dunder_main
+from pyannotate_tools.annotations.merge import (
+    MAX_ITEMS_PER_FUNCTION,
+    merge_type_info,
+)
+from pyannotate_tools.annotations.store import read_store, write_store
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        # type: () -> None
+        self.tempdirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        # type: () -> None
+        shutil.rmtree(self.tempdirname)
+
+    def write_shard(self, name, items):
+        # type: (str, List[Any]) -> str
+        path = os.path.join(self.tempdirname, name)
+        with open(path, 'w') as f:
+            json.dump(items, f)
+        return path
+
+    def entry(self, func_name, type_comments, samples, line=1):
+        # type: (str, List[str], int, int) -> Any
+        return {'path': 'pkg/mod.py',
+                'line': line,
+                'func_name': func_name,
+                'type_comments': type_comments,
+                'samples': samples}
+
+    def write_shards(self):
+        # type: () -> List[str]
+        return [
+            self.write_shard('a.json', [self.entry('f', ['(int) -> None'], 2),
+                                        self.entry('g', ['() -> str'], 1, line=5)]),
+            self.write_shard('b.json', [self.entry('f', ['(str) -> None', '(int) -> None'], 3)]),
+            self.write_shard('c.json', [self.entry('f', ['(float) -> None'], 1)]),
+        ]
+
+    def test_merge(self):
+        # type: () -> None
+        merged = merge_type_info(self.write_shards())
+        assert merged == {
+            ('pkg/mod.py', 1, 'f'): [['(int) -> None', '(str) -> None', '(float) -> None'], 6],
+            ('pkg/mod.py', 5, 'g'): [['() -> str'], 1],
+        }
+
+    def test_merge_in_parallel(self):
+        # type: () -> None
+        paths = self.write_shards()
+        assert merge_type_info(paths, processes=2) == merge_type_info(paths)
+
+    def test_merge_empty_json_lines(self):
+        # type: () -> None
+        paths = self.write_shards()
+        # JSON Lines shards of processes that collected nothing (with and without statistics).
+        for name, data in [('empty.jsonl', ''), ('stats.jsonl', '{"collector_stats": {}}\n')]:
+            paths.append(os.path.join(self.tempdirname, name))
+            with open(paths[-1], 'w') as f:
+                f.write(data)
+        assert merge_type_info(paths) == merge_type_info(paths[:-2])
+
+    def test_cap_on_type_comments(self):
+        # type: () -> None
+        paths = [self.write_shard('%d.json' % i, [self.entry('f', ['(%d) -> None' % i], 1)])
+                 for i in range(MAX_ITEMS_PER_FUNCTION + 2)]
+        [(comments, samples)] = merge_type_info(paths).values()
+        assert comments == ['(%d) -> None' % i for i in range(MAX_ITEMS_PER_FUNCTION)]
+        assert samples == MAX_ITEMS_PER_FUNCTION + 2
+
+    def test_command_line(self):
+        # type: () -> None
+        self.write_shards()
+        output = os.path.join(self.tempdirname, 'merged.jsonl')
+        dunder_main(['merge', '--format', 'jsonl', '-o', output, self.tempdirname])
+        with open(output) as f:
+            items = [json.loads(line) for line in f]
+        assert items == [self.entry('f', ['(int) -> None', '(str) -> None', '(float) -> None'], 6),
+                         self.entry('g', ['() -> str'], 1, line=5)]
+
+    def test_store(self):
+        # type: () -> None
+        paths = self.write_shards()
+        output = os.path.join(self.tempdirname, 'type_info.sqlite')
+        dunder_main(['merge', '--format', 'sqlite', '-o', output] + paths[:2])
+        # Merging more data updates the store.
+        dunder_main(['merge', '--format', 'sqlite', '-o', output] + paths[1:])
+        assert read_store(output) == [
+            self.entry('f', ['(int) -> None', '(str) -> None', '(float) -> None'], 9),
+            self.entry('g', ['() -> str'], 1, line=5)]
+        assert read_store(output, 'other.py') == []
+        # A store is read like the other formats.
+        [(comments, samples), _] = merge_type_info([output]).values()
+        assert samples == 9
+
+    def test_store_caps(self):
+        # type: () -> None
+        output = os.path.join(self.tempdirname, 'type_info.sqlite')
+        comments = ['(C%d) -> None' % i for i in range(MAX_ITEMS_PER_FUNCTION + 2)]
+        write_store(output, [self.entry('f', comments[:2], 1)], MAX_ITEMS_PER_FUNCTION)
+        write_store(output, [self.entry('f', comments, 1)], MAX_ITEMS_PER_FUNCTION)
+        assert read_store(output) == [self.entry('f', comments[:MAX_ITEMS_PER_FUNCTION], 2)]
+
+    def test_store_requires_output(self):
+        # type: () -> None
+        with self.assertRaises(SystemExit):
+            dunder_main(['merge', '--format', 'sqlite', self.tempdirname])
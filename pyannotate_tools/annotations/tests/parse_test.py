@@ -1,10 +1,18 @@
+import gzip
+import io
 import os
+import shutil
 import tempfile
 import unittest
+try:
+    import lzma
+except ImportError:
+    lzma = None  # type: ignore
 
 from typing import List, Optional, Tuple
 
 from pyannotate_tools.annotations.parse import parse_json, parse_type_comment, ParseError, tokenize
+from pyannotate_tools.annotations.store import write_store
 from pyannotate_tools.annotations.types import (
     AbstractType,
     AnyType,
@@ -24,6 +32,14 @@ class TestParseError(unittest.TestCase):
         assert str(ParseError('(int -> str')) == 'Invalid type comment: (int -> str'
 
 
+def gzip_compress(data):
+    # type: (bytes) -> bytes
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
 class TestParseJson(unittest.TestCase):
     def test_parse_json(self):
         # type: () -> None
@@ -58,6 +74,117 @@ class TestParseJson(unittest.TestCase):
                                       '(str) -> None']
         assert item.samples == 3
 
+    def test_parse_json_with_collector_stats(self):
+        # type: () -> None
+        data = """
+        {
+            "type_info": [
+                {
+                    "path": "pkg/thing.py",
+                    "line": 422,
+                    "func_name": "my_function",
+                    "type_comments": ["(int) -> None"],
+                    "samples": 3
+                }
+            ],
+            "collector_stats": {"events_seen": 10}
+        }
+        """
+        f = None
+        try:
+            with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
+                f.write(data)
+            result = parse_json(f.name)
+        finally:
+            if f is not None:
+                os.remove(f.name)
+        assert [item.func_name for item in result] == ['my_function']
+
+    def parse_data(self, data):
+        # type: (bytes) -> List[Tuple[str, int, str, List[str], int]]
+        f = None
+        try:
+            with tempfile.NamedTemporaryFile(mode='wb', delete=False) as f:
+                f.write(data)
+            result = parse_json(f.name)
+        finally:
+            if f is not None:
+                os.remove(f.name)
+        return [(item.path, item.line, item.func_name, item.type_comments, item.samples)
+                for item in result]
+
+    def test_parse_json_lines(self):
+        # type: () -> None
+        data = (b'{"path": "a.py", "line": 1, "func_name": "f", '
+                b'"type_comments": ["(int) -> None"], "samples": 3}\n'
+                b'{"path": "a.py", "line": 5, "func_name": "g", '
+                b'"type_comments": ["() -> str"], "samples": 1}\n'
+                b'{"collector_stats": {"events_seen": 10}}\n')
+        assert self.parse_data(data) == [('a.py', 1, 'f', ['(int) -> None'], 3),
+                                         ('a.py', 5, 'g', ['() -> str'], 1)]
+        # A single line.
+        assert self.parse_data(data.splitlines()[0]) == [('a.py', 1, 'f', ['(int) -> None'], 3)]
+
+    def test_parse_empty_json_lines(self):
+        # type: () -> None
+        # As written by dump_stats(..., format=FORMAT_JSONL) when nothing was
+        # collected, without and with include_stats=True.
+        assert self.parse_data(b'') == []
+        assert self.parse_data(b' \n') == []
+        assert self.parse_data(b'{"collector_stats": {"events_seen": 0}}\n') == []
+
+    def test_parse_compressed(self):
+        # type: () -> None
+        data = (b'[{"path": "a.py", "line": 1, "func_name": "f", '
+                b'"type_comments": ["(int) -> None"], "samples": 3}]')
+        expected = [('a.py', 1, 'f', ['(int) -> None'], 3)]
+        assert self.parse_data(gzip_compress(data)) == expected
+        if lzma is not None:
+            assert self.parse_data(lzma.compress(data)) == expected
+
+    def test_parse_binary(self):
+        # type: () -> None
+        data = (b'PYANNOTATE\x00\x01' +
+                b'\x00\x04a.py' + b'\x81\x01' + b'\x00\x01f' +
+                b'\x02\x00\x0d(int) -> None\x00\x0a() -> None' + b'\x03' +
+                b'\x01' + b'\x05' + b'\x00\x01g' +
+                b'\x01\x03' + b'\x01')
+        assert self.parse_data(data) == [('a.py', 129, 'f', ['(int) -> None', '() -> None'], 3),
+                                         ('a.py', 5, 'g', ['(int) -> None'], 1)]
+
+    def test_parse_store(self):
+        # type: () -> None
+        items = [{'path': 'b.py', 'line': 3, 'func_name': 'h',
+                  'type_comments': ['() -> None'], 'samples': 1},
+                 {'path': 'a.py', 'line': 1, 'func_name': 'f',
+                  'type_comments': ['(int) -> None', '(str) -> None'], 'samples': 3}]
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'type_info.sqlite')
+            write_store(path, items, 8)
+            result = parse_json(path)
+            assert [(item.path, item.func_name, item.type_comments, item.samples)
+                    for item in result] == [('a.py', 'f', ['(int) -> None', '(str) -> None'], 3),
+                                            ('b.py', 'h', ['() -> None'], 1)]
+            assert [item.func_name for item in parse_json(path, 'b.py')] == ['h']
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_parse_function_path(self):
+        # type: () -> None
+        data = (b'[{"path": "a.py", "line": 1, "func_name": "f", '
+                b'"type_comments": ["(int) -> None"], "samples": 3}, '
+                b'{"path": "b.py", "line": 1, "func_name": "g", '
+                b'"type_comments": ["(int) -> None"], "samples": 3}]')
+        f = None
+        try:
+            with tempfile.NamedTemporaryFile(mode='wb', delete=False) as f:
+                f.write(data)
+            assert [item.func_name for item in parse_json(f.name, 'b.py')] == ['g']
+        finally:
+            if f is not None:
+                os.remove(f.name)
+
 
 class TestTokenize(unittest.TestCase):
     def test_tokenize(self):
@@ -74,6 +201,8 @@ class TestTokenize(unittest.TestCase):
                              'DottedName(Iterator) End()')
         self.assert_tokenize('dictionary-valueiterator',
                              'DottedName(Iterator) End()')
+        self.assert_tokenize('async_generator',
+                             'DottedName(AsyncIterator) End()')
         self.assert_tokenize('foo-bar', 'DottedName(Any) End()')
         self.assert_tokenize('pytz.tzfile.Europe/Amsterdam',
                              'DottedName(datetime.tzinfo) End()')
@@ -163,6 +292,18 @@ class TestParseTypeComment(unittest.TestCase):
                                    Argument(ClassType('str'), ARG_STAR),
                                    Argument(ClassType('bool'), ARG_STARSTAR)], AnyType()))
 
+    def test_keyword_only_args(self):
+        # type: () -> None
+        self.assert_type_comment('(int, *str, bool) -> Any',
+                                 ([class_arg('int'),
+                                   Argument(ClassType('str'), ARG_STAR),
+                                   class_arg('bool')], AnyType()))
+        self.assert_type_comment('(int, *str, bool, **float) -> Any',
+                                 ([class_arg('int'),
+                                   Argument(ClassType('str'), ARG_STAR),
+                                   class_arg('bool'),
+                                   Argument(ClassType('float'), ARG_STARSTAR)], AnyType()))
+
     def test_function(self):
         # type: () -> None
         self.assert_type_comment('(function) -> Any',
@@ -186,7 +327,6 @@ class TestParseTypeComment(unittest.TestCase):
                     '(Union[]) -> None',
                     '(List[int) -> None',
                     '(*int, *str) -> None',
-                    '(*int, int) -> None',
                     '(**int, *str) -> None',
                     '(**int, str) -> None',
                     '(**int, **str) -> None']:
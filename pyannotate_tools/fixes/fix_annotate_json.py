@@ -1,6 +1,7 @@
 """Fixer that inserts mypy annotations from json file into code.
 
-This fixer consumes json from TYPE_COLLECTION_JSON env variable in the following format:
+This fixer consumes json from TYPE_COLLECTION_JSON env variable in the following format
+(or an SQLite store of runtime-collected types, see pyannotate_tools.annotations.store):
 
 [
     {
@@ -33,6 +34,9 @@ except ImportError:
     # In Python 3.5.1 stdlib, typing.py does not define Text
     Text = str  # type: ignore
 
+from pyannotate_tools.annotations.main import generate_annotations_json_string
+from pyannotate_tools.annotations.store import is_store
+
 from .fix_annotate import FixAnnotate
 
 # Taken from mypy codebase:
@@ -186,21 +190,47 @@ class FixAnnotateJson(FixAnnotate):
     stub_json_file = os.getenv('TYPE_COLLECTION_JSON')
     # JSON data for the current file
     stub_json = None  # type: List[Dict[str, Any]]
+    # Or an SQLite store, queried for each file (instead of holding all the data)
+    stub_store = None  # type: Optional[str]
+    # The file last queried from the store, and its JSON data
+    stub_store_data = (None, [])  # type: Tuple[Optional[str], List[Dict[str, Any]]]
 
     @classmethod
     def init_stub_json_from_data(cls, data, filename):
         cls.stub_json = data
+        cls.stub_store = None
+        cls.top_dir, _ = crawl_up(os.path.abspath(filename))
+
+    @classmethod
+    def init_stub_store(cls, store, filename):
+        cls.stub_json = None
+        cls.stub_store = store
+        cls.stub_store_data = (None, [])
         cls.top_dir, _ = crawl_up(os.path.abspath(filename))
 
     def init_stub_json(self):
+        if is_store(self.__class__.stub_json_file):
+            self.__class__.init_stub_store(self.__class__.stub_json_file, self.filename)
+            return
         with open(self.__class__.stub_json_file) as f:
             data = json.load(f)
         self.__class__.init_stub_json_from_data(data, self.filename)
 
-    def get_annotation_from_stub(self, node, results, funcname):
-        if not self.__class__.stub_json:
+    def get_stub_data(self):
+        cls = self.__class__
+        if not cls.stub_json and cls.stub_store is None:
             self.init_stub_json()
-        data = self.__class__.stub_json
+        if cls.stub_store is None:
+            return cls.stub_json
+        filename = os.path.abspath(self.filename)
+        if cls.stub_store_data[0] != filename:
+            path = os.path.relpath(filename, cls.top_dir)
+            cls.stub_store_data = (filename,
+                                   generate_annotations_json_string(cls.stub_store, path))
+        return cls.stub_store_data[1]
+
+    def get_annotation_from_stub(self, node, results, funcname):
+        data = self.get_stub_data()
         # We are using relative paths in the JSON.
         items = [it for it in data
                  if it['func_name'] == funcname and
@@ -12,7 +12,10 @@ setup(name='pyannotate',
       platforms=['POSIX'],
       packages=['pyannotate_runtime', 'pyannotate_tools',
                 'pyannotate_tools.annotations', 'pyannotate_tools.fixes'],
-      entry_points={'console_scripts': ['pyannotate=pyannotate_tools.annotations.__main__:main']},
+      entry_points={'console_scripts': [
+          'pyannotate=pyannotate_tools.annotations.__main__:main',
+          'pyannotate-aggregator=pyannotate_runtime.aggregator:main',
+      ]},
       classifiers=[
           'Development Status :: 3 - Alpha',
           'Environment :: Console',